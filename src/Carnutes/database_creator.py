@@ -1,85 +1,106 @@
 #! python3
 
-import ZODB
-import open3d as o3d
-import ZODB.FileStorage
-
 import os
-import sys
-import transaction
-import BTrees.OOBTree
 
-import utils.tree as tree
+import utils.database_reader as database_reader
+import utils.database_ingestion as database_ingestion
+import utils.geometrical_operations as geometrical_operations
 
 
-def create_database(voxel_size=0.05):
+def create_database(
+    voxel_size=0.05,
+    circle_fitting_method=geometrical_operations.CircleFittingMethod.RANSAC,
+    n_workers=1,
+    cache_dir="database/cache",
+):
     """
     Create a database of trees from the point cloud dataset.
+    The scans are processed in parallel and committed to the database as they come, see utils.database_ingestion.
 
     :param voxel_size: float, optional
         The size of the voxel grid used for downsampling the point cloud. The default is 0.05.
+    :param circle_fitting_method: CircleFittingMethod, optional
+        The method used to fit the circles of the skeletons. The default is RANSAC, ALGEBRAIC is much faster.
+    :param n_workers: int, optional
+        The number of processes used to process the scans, None for the number of cpus. The default is 1, see utils.database_ingestion.ingest_scans.
+    :param cache_dir: str, optional
+        The folder of the cache of processed scans. None to process all the scans again.
     """
     database_folder = "database"
     if not os.path.exists(database_folder):
         os.makedirs(database_folder)
 
-    storage = ZODB.FileStorage.FileStorage("database/tree_database.fs")
-    db = ZODB.DB(storage)
-    connection = db.open()
-    root = connection.root
-    root.trees = BTrees.OOBTree.BTree()
-    i = 0
-    for pc_file in os.listdir("dataset"):
-
-        if pc_file.endswith(".ply"):
-            print(f"Processing {pc_file}")
-            pc = o3d.io.read_point_cloud(f"dataset/{pc_file}")
-            pc = pc.voxel_down_sample(voxel_size)
-
-            tree_pc_as_pt_list = []
-            tree_colors_as_list = []
-
-            for j in range(len(pc.points)):
-                tree_pc_as_pt_list.append(
-                    [
-                        float(pc.points[j][0]),
-                        float(pc.points[j][1]),
-                        float(pc.points[j][2]),
-                    ]
-                )
-                tree_colors_as_list.append(
-                    [
-                        float(pc.colors[j][0]),
-                        float(pc.colors[j][1]),
-                        float(pc.colors[j][2]),
-                    ]
-                )
-
-            tree_for_db = tree.Tree(
-                len(root.trees),
-                f"tree_{i}",
-                tree.Pointcloud(tree_pc_as_pt_list, tree_colors_as_list),
-            )
-            tree_for_db.compute_skeleton()
-
-            root.trees[tree_for_db.id] = tree_for_db
-            i += 1
-
-    root.n_trees = len(root.trees)
-
-    transaction.commit()
-    connection.close()
-
-    db.close()
-    storage.close()
-
-
-def augment_database():
+    reader = database_reader.DatabaseReader("database/tree_database.fs")
+    reader.clear()
+    scans = (
+        (i, f"tree_{i}", f"dataset/{pc_file}")
+        for i, pc_file in enumerate(
+            pc_file for pc_file in os.listdir("dataset") if pc_file.endswith(".ply")
+        )
+    )
+    database_ingestion.ingest_scans(
+        reader,
+        scans,
+        voxel_size,
+        circle_fitting_method=circle_fitting_method,
+        n_workers=n_workers,
+        cache_dir=cache_dir,
+    )
+    reader.close()
+
+
+def augment_database(
+    voxel_size=0.05,
+    circle_fitting_method=geometrical_operations.CircleFittingMethod.RANSAC,
+    n_workers=1,
+    cache_dir="database/cache",
+):
     """
-    Augment the database with new trees. To be implemented.
+    Augment the database with the new scans of the dataset folder.
+    A scan is new if its content hash is not recorded in the database (see utils.database_ingestion), the others are skipped.
+    The new trees get the ids following the largest id of the database.
+
+    :param voxel_size: float, optional
+        The size of the voxel grid used for downsampling the point cloud. The default is 0.05.
+    :param circle_fitting_method: CircleFittingMethod, optional
+        The method used to fit the circles of the skeletons. The default is RANSAC.
+    :param n_workers: int, optional
+        The number of processes used to process the scans, None for the number of cpus. The default is 1, see utils.database_ingestion.ingest_scans.
+    :param cache_dir: str, optional
+        The folder of the cache of processed scans. None to process all the new scans.
+
+    :return: n_new_trees: int
+        The number of trees added to the database
     """
-    pass
+    reader = database_reader.DatabaseReader("database/tree_database.fs")
+    ingested_scans = reader.root.scans if hasattr(reader.root, "scans") else {}
+    new_scans = []
+    for pc_file in os.listdir("dataset"):
+        if pc_file.endswith(".ply"):
+            scan_path = f"dataset/{pc_file}"
+            scan_hash = database_ingestion.compute_scan_hash(scan_path)
+            if scan_hash not in ingested_scans:
+                new_scans.append(scan_path)
+
+    # ids of trees entirely used up are not given again
+    first_id = reader.get_next_tree_id()
+    scans = [
+        (tree_id, f"tree_{tree_id}", scan_path)
+        for tree_id, scan_path in enumerate(new_scans, start=first_id)
+    ]
+    print(f"{len(scans)} new scans to add to the database")
+    n_new_trees = database_ingestion.ingest_scans(
+        reader,
+        scans,
+        voxel_size,
+        circle_fitting_method=circle_fitting_method,
+        n_workers=n_workers,
+        cache_dir=cache_dir,
+    )
+    reader.close()
+    return n_new_trees
 
 
 if __name__ == "__main__":
-    create_database(voxel_size=0.03)
+    # run from a command line, the scans can be processed on all the cpus
+    create_database(voxel_size=0.03, n_workers=None)
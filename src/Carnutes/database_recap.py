@@ -27,13 +27,10 @@ def recap_database():
     reader = database_reader.DatabaseReader(database_path)
     n_trees = reader.get_num_trees()
     message = []
-    diameters = []
-    heights = []
-    # get individual info about each tree
-    for i in range(n_trees):
-        current_tree = reader.get_tree(i)
-        diameters.append(current_tree.mean_diameter)
-        heights.append(current_tree.height)
+    # get individual info about each tree from the feature index, as the ids are not contiguous once trees are used or split
+    features = reader.get_feature_index()
+    diameters = features["mean_diameter"].tolist()
+    heights = features["height"].tolist()
 
     diameters, heights = zip(*sorted(zip(diameters, heights)))
 
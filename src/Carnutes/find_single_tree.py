@@ -7,6 +7,7 @@ This is a dummy function, to test out the bones of the project.
 # r: open3d==0.18.0
 # r: ZODB==6.0
 # r: igraph==0.11.6
+# r: scipy==1.13.1
 
 import os
 import copy
@@ -22,34 +23,6 @@ import Rhino
 import scriptcontext
 
 
-def crop(tree: tree, bounding_volume: Rhino.Geometry.Brep):
-    """
-    Crop the tree to a bounding volume
-    Used to be a method of the tree class but has been moved out to make the Tree class available for testing outside of rhino.
-
-
-    :param bounding_volume: closed Brep
-        The bounding Brep to crop the tree to
-    """
-    indexes_to_remove = []
-    for i in range(len(tree.point_cloud.points)):
-        point = tree.point_cloud.points[i]
-        if not bounding_volume.IsPointInside(
-            Rhino.Geometry.Point3d(point[0], point[1], point[2]), 0.01, True
-        ):
-            indexes_to_remove.append(i)
-    tree.point_cloud.points = [
-        point
-        for i, point in enumerate(tree.point_cloud.points)
-        if i not in indexes_to_remove
-    ]
-    tree.point_cloud.colors = [
-        color
-        for i, color in enumerate(tree.point_cloud.colors)
-        if i not in indexes_to_remove
-    ]
-
-
 def main():
     """
     1) create the model
@@ -111,9 +84,8 @@ def main():
     # Align it using o3d's ransac, then crop it to the bounding box of the element
     my_tree.align_to_skeleton(reference_skeleton)
 
-    # Brep to crop the point cloud
-    cylinder = target.create_bounding_cylinder(radius=1)
-    crop(my_tree, cylinder)
+    # Crop the point cloud around the axis of the element
+    my_tree.crop(target.get_axis_polyline(), radius=1)
     my_tree.create_mesh()
 
     tree_mesh = conversions.convert_carnutes_mesh_to_rhino_mesh(my_tree.mesh)
@@ -121,5 +93,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        packing_combinatorics.shutdown_pools()
     print("Done")
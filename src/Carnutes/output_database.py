@@ -27,28 +27,26 @@ def main():
     database_path = os.path.join(current_dir, "database", "tree_database.fs")
     reader = db_reader.DatabaseReader(database_path)
 
-    n_tree = reader.get_num_trees()
-    for i in range(n_tree):
-        tree = reader.get_tree(i)
+    # the ids are not contiguous once trees are used or split into offcuts
+    for tree_id in list(reader.root.trees.keys()):
+        tree = reader.get_tree(tree_id)
         if tree is None:
             continue
+        tree.load_point_cloud()
         tree = copy.deepcopy(tree)
         rh_pointcloud = Rhino.Geometry.PointCloud()
         rh_skeleton = Rhino.Geometry.PointCloud()
         skeleton_polyline_list = []
 
-        for j in range(len(tree.point_cloud.points)):
+        points = tree.point_cloud.points_array
+        colors = tree.point_cloud.colors_array
+        for j in range(len(points)):
             rh_pointcloud.Add(
                 Rhino.Geometry.Point3d(
-                    tree.point_cloud.points[j][0],
-                    tree.point_cloud.points[j][1],
-                    tree.point_cloud.points[j][2],
+                    float(points[j][0]), float(points[j][1]), float(points[j][2])
                 ),
                 System.Drawing.Color.FromArgb(
-                    255,
-                    int(tree.point_cloud.colors[j][0] * 255),
-                    int(tree.point_cloud.colors[j][1] * 255),
-                    int(tree.point_cloud.colors[j][2] * 255),
+                    255, int(colors[j][0]), int(colors[j][1]), int(colors[j][2])
                 ),
             )
         for point in tree.skeleton.points:
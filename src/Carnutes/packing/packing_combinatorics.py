@@ -3,24 +3,122 @@ This module contains the code for tree combinatorics.
 """
 
 import os
+import atexit
 import copy
-from typing import List, Tuple
+import enum
+import concurrent.futures
+from dataclasses import dataclass
+from typing import List, Tuple, Union
 import transaction
 
 import utils.database_reader as db_reader
+import utils.feature_index
 import utils.geometry
+import utils.geometrical_operations
 import utils.tree
+import utils.window_index
 from . import packing_manipulations
 
 import open3d as o3d
 import numpy as np
 
+# The number of candidate trees scored together (per worker). find_best_tree_unoptimized stops after the batch in which a good enough tree was found.
+CANDIDATE_BATCH_SIZE = 8
+
+# The fraction of the candidate trees kept at each coarse level of the coarse to fine search
+COARSE_TO_FINE_KEEP_FRACTION = 0.5
+
+# The number of windows retrieved from the window index for a model element by the nearest windows search
+NEAREST_WINDOWS = 128
+
+# The maximum number of windows registered in a single batch by compute_best_elements_trees_matching
+KABSCH_BATCH_SIZE = 2**16
+
+
+class Executor(enum.Enum):
+    """
+    Enum for the way candidate trees are scored: on the main thread, on a pool of threads, or on a pool of processes.
+    """
+
+    SERIAL = 1
+    THREADS = 2
+    PROCESSES = 3
+
+
+class AllocationMode(enum.Enum):
+    """
+    Enum for the way elements are allocated to trees: one after the other (see allocate_elements),
+    all together with a global assignment (see allocate_elements_globally),
+    or packed several per tree as in a cutting-stock problem (see pack_elements_on_trees).
+    """
+
+    GREEDY = 1
+    GLOBAL = 2
+    PACKING = 3
+
+
+class SearchStrategy(enum.Enum):
+    """
+    Enum for the way the candidate trees of an element are searched: all of them are scored with their full skeletons,
+    or they are first ranked at the coarse levels of the skeleton pyramid of the feature index, and only the best ones are scored (see rank_candidates_coarse_to_fine),
+    or only the windows of the window index closest to the element are scored, without scanning the database (see retrieve_nearest_windows).
+    """
+
+    EXHAUSTIVE = 1
+    COARSE_TO_FINE = 2
+    NEAREST_WINDOWS = 3
+
+
+class PackingStrategy(enum.Enum):
+    """
+    Enum for the choice of the tree an element is cut from in pack_elements_on_trees:
+    the first tree already cut that can host it, or the one whose free interval fits it most tightly.
+    """
+
+    FIRST_FIT = 1
+    BEST_FIT = 2
+
+
+# The pools are kept between calls, so the workers are only started once per script.
+# The entry scripts stop them with shutdown_pools when they are done: Rhino keeps the interpreter alive between scripts,
+# so the pools registered to be stopped at exit would otherwise keep their workers for the whole session.
+_pools = {}
+
+
+def _get_pool(executor: Executor, n_workers: int) -> concurrent.futures.Executor:
+    """
+    Get (or start) the pool of workers corresponding to the executor.
+    """
+    if (executor, n_workers) not in _pools:
+        if executor == Executor.THREADS:
+            _pools[(executor, n_workers)] = concurrent.futures.ThreadPoolExecutor(
+                n_workers
+            )
+        else:
+            _pools[(executor, n_workers)] = concurrent.futures.ProcessPoolExecutor(
+                n_workers
+            )
+    return _pools[(executor, n_workers)]
+
+
+def shutdown_pools():
+    """
+    Stop the pools of workers started by the parallel scoring of candidate trees.
+    """
+    for pool in _pools.values():
+        pool.shutdown()
+    _pools.clear()
+
+
+atexit.register(shutdown_pools)
+
 
 def compute_best_tree_element_matching(
     model_element: utils.geometry.Pointcloud,
     reference_diameter: float,
-    tree: utils.tree.Tree,
+    tree: utils.tree.TreeSkeleton,
     minimum_rmse: float,
+    registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.KABSCH,
 ) -> Tuple[utils.geometry.Pointcloud, utils.geometry.Pointcloud]:
     """
     Compute the best matching between the reference and the target point clouds.
@@ -41,10 +139,12 @@ def compute_best_tree_element_matching(
         The model element point cloud to align to
     :param reference_diameter: float
         The diameter of the model element which we want to match to
-    :param tree: Tree
-        the tree whose skeleton we want to match to the model element
+    :param tree: TreeSkeleton
+        the skeleton-only view of the tree we want to match to the model element. Its skeleton is modified in place.
     :param minimum_rmse: float
         The minimum rmse to consider the alignment as valid
+    :param registration_method: RegistrationMethod
+        The registration method. KABSCH (default) solves the four orientations at once, ICP uses open3d for each of them.
 
     :return: best_skeleton: Pointcloud
         The best fitting segment of the skeleton point cloud
@@ -53,6 +153,11 @@ def compute_best_tree_element_matching(
     :return: best_init_rotation: np.array
         The rotation that was applied to the target skeleton to match the reference once both are reset to the origin
     """
+    if registration_method == packing_manipulations.RegistrationMethod.KABSCH:
+        return compute_best_trees_element_matching(
+            model_element, reference_diameter, [tree], minimum_rmse
+        )[0]
+
     best_rmse = minimum_rmse
     best_skeleton = None
     best_init_rotation = None
@@ -96,12 +201,784 @@ def compute_best_tree_element_matching(
     return best_skeleton, best_rmse, best_init_rotation
 
 
+def compute_best_trees_element_matching(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    trees: List[utils.tree.TreeSkeleton],
+    minimum_rmse: float,
+    registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.KABSCH,
+    window_step: float = None,
+    return_offsets: bool = False,
+    offsets: np.ndarray = None,
+) -> List[Tuple[utils.geometry.Pointcloud, float, np.ndarray]]:
+    """
+    Compute the best matching between the model element and each of the given trees, as compute_best_tree_element_matching does for one tree.
+    With the KABSCH registration method, the skeletons of all the trees are resampled and registered in the four orientations at once,
+    with a single batched svd. The adapted skeletons returned correspond point to point to the model element, in its given order.
+
+    By default the model element is anchored at one end of the skeleton. With a window_step, every window starting
+    at a multiple of window_step along the skeleton is evaluated as well, in the same batch, and the best one is kept.
+
+    ```
+    anchored:        sliding window:
+    p  <- element    p
+    |                |
+    p                p  <- element, at offset o
+    |                |
+    p                p
+    ```
+
+    :param model_element: Pointcloud
+        The model element point cloud to align to
+    :param reference_diameter: float
+        The diameter of the model element which we want to match to
+    :param trees: list of TreeSkeleton
+        The skeleton-only views of the trees we want to match to the model element
+    :param minimum_rmse: float
+        The minimum rmse to consider the alignment as valid
+    :param registration_method: RegistrationMethod
+        The registration method. With ICP, compute_best_tree_element_matching is called for each tree.
+    :param window_step: float, optional
+        The step between the start offsets of the windows along the skeletons, in meters. None (default) only evaluates the anchored windows.
+        Only available with the KABSCH registration method.
+    :param return_offsets: bool
+        Whether to add the offset of the best window to each matching.
+    :param offsets: np.array (n_trees, n_windows), optional
+        Explicit start offsets of the windows along each skeleton, from its first point, padded with NaN. Replaces window_step.
+        Both orientations of the model element are evaluated on the skeleton in its stored direction only, which covers the same windows.
+        Only available with the KABSCH registration method.
+
+    :return: matchings: list of tuples (best_skeleton, best_rmse, best_init_rotation)
+        For each tree, the output of compute_best_tree_element_matching. (None, None, None) if the tree does not match.
+        If return_offsets is True, the arc length from the first point of the tree skeleton to the start of the best window is added to each tuple.
+    """
+    if registration_method == packing_manipulations.RegistrationMethod.ICP:
+        if window_step is not None or return_offsets or offsets is not None:
+            raise ValueError(
+                "The sliding window mode is only available with the KABSCH registration method."
+            )
+        return [
+            compute_best_tree_element_matching(
+                model_element,
+                reference_diameter,
+                tree,
+                minimum_rmse,
+                registration_method=registration_method,
+            )
+            for tree in trees
+        ]
+    if len(trees) == 0:
+        return []
+
+    element_windows = _match_element_windows(
+        model_element, reference_diameter, trees, window_step, offsets
+    )
+    window_rmse, window_transformations = (
+        packing_manipulations.perform_kabsch_registration(
+            model_element, element_windows.skeletons
+        )
+    )
+    return _select_best_windows(
+        element_windows,
+        window_rmse,
+        window_transformations,
+        minimum_rmse,
+        return_offsets,
+    )
+
+
+@dataclass
+class _ElementWindows:
+    """
+    The windows of the tree skeletons matched to a model element by _match_element_windows, before their registration.
+
+    :param skeletons: np.array (n_valid, n_element_points, 3)
+        The adapted skeletons of the windows that passed the checks, corresponding point to point to the model element
+    :param is_valid: np.array (4, n_trees, n_windows)
+        Whether each window, for each of the four orientations, passed the length and diameter checks
+    :param offsets: np.array (n_trees, n_windows)
+        The start offsets of the windows along the skeletons
+    :param skeleton_lengths: np.array (n_trees,)
+        The lengths of the skeletons
+    :param element_length: float
+        The length of the model element
+    """
+
+    skeletons: np.ndarray
+    is_valid: np.ndarray
+    offsets: np.ndarray
+    skeleton_lengths: np.ndarray
+    element_length: float
+
+
+def _match_element_windows(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    trees: List[utils.tree.TreeSkeleton],
+    window_step: float = None,
+    offsets: np.ndarray = None,
+) -> _ElementWindows:
+    """
+    Resample the windows of the tree skeletons in the four orientations to the model element, and check their length and diameter,
+    the first step of compute_best_trees_element_matching. Only the windows that passed the checks are kept for the registration.
+    """
+    element_points = np.asarray(model_element.points, dtype=np.float64)
+    element_length = utils.geometrical_operations.compute_polyline_length(
+        element_points
+    )
+    skeletons, n_points = packing_manipulations.stack_skeletons(
+        [tree.skeleton for tree in trees]
+    )
+    skeleton_lengths = np.nansum(
+        np.linalg.norm(np.diff(skeletons, axis=1), axis=2), axis=1
+    )
+    n_circles = np.array([len(tree.skeleton_circles) for tree in trees], dtype=int)
+    radii = np.full((len(trees), max(n_circles.max(), 1)), np.nan)
+    for i, tree in enumerate(trees):
+        radii[i, : n_circles[i]] = [circle[1] for circle in tree.skeleton_circles]
+
+    skeleton_variants = [(skeletons, radii)]
+    if offsets is not None:
+        offsets = np.asarray(offsets, dtype=np.float64).reshape(len(trees), -1)
+    else:
+        if window_step is None:
+            offsets = np.zeros(1)
+        else:
+            n_windows = int(
+                np.floor((np.max(skeleton_lengths) - element_length) / window_step)
+            )
+            offsets = window_step * np.arange(max(n_windows, 0) + 1)
+        skeleton_variants.append(
+            (_reverse_padded(skeletons, n_points), _reverse_padded(radii, n_circles))
+        )
+    offsets = np.broadcast_to(offsets, (len(trees), offsets.shape[-1]))
+
+    # the four orientations: skeleton forward or reversed, times model element forward or reversed
+    adapted_skeletons = []
+    is_valid = []
+    for skeleton_variant, radii_variant in skeleton_variants:
+        range_tables = utils.feature_index.build_range_tables(radii_variant)
+        for element_variant in (element_points, element_points[::-1]):
+            (
+                resampled_points,
+                first_segments,
+                last_segments,
+                is_long_enough,
+            ) = packing_manipulations.match_skeleton_windows(
+                element_variant, skeleton_variant, n_points, offsets
+            )
+            if element_variant is not element_points:
+                # we keep the point to point correspondence with the model element in its given order
+                resampled_points = resampled_points[:, :, ::-1]
+            # the diameter of the segments within the window must be within 25% of the reference,
+            # read from the range tables of the radii in O(1) per window
+            minima, maxima = utils.feature_index.query_range_tables(
+                *range_tables, first_segments, last_segments
+            )
+            adapted_skeletons.append(resampled_points)
+            is_valid.append(
+                is_long_enough
+                & utils.feature_index.is_in_diameter_band(
+                    minima, maxima, reference_diameter
+                )
+            )
+    is_valid = np.stack(is_valid)
+    return _ElementWindows(
+        np.stack(adapted_skeletons)[is_valid],
+        is_valid,
+        offsets,
+        skeleton_lengths,
+        element_length,
+    )
+
+
+def _select_best_windows(
+    element_windows: _ElementWindows,
+    window_rmse: np.ndarray,
+    window_transformations: np.ndarray,
+    minimum_rmse: float,
+    return_offsets: bool = False,
+) -> List[Tuple[utils.geometry.Pointcloud, float, np.ndarray]]:
+    """
+    Keep the best registered window of each tree, the last step of compute_best_trees_element_matching.
+
+    :param element_windows: _ElementWindows
+        The windows matched to the model element
+    :param window_rmse: np.array (n_valid,)
+        The rmse of the registration of each window that passed the checks
+    :param window_transformations: np.array (n_valid, 4, 4)
+        The transformation of the registration of each window that passed the checks
+    """
+    is_valid = element_windows.is_valid
+    n_variants, n_trees, n_windows = is_valid.shape
+    rmse = np.full(is_valid.shape, np.inf)
+    rmse[is_valid] = window_rmse
+    window_positions = np.zeros(is_valid.shape, dtype=int)
+    window_positions[is_valid] = np.arange(len(window_rmse))
+
+    matchings = []
+    for i in range(n_trees):
+        best_variant, best_window = np.unravel_index(
+            np.argmin(rmse[:, i]), (n_variants, n_windows)
+        )
+        best_rmse = rmse[best_variant, i, best_window]
+        if not best_rmse < minimum_rmse:
+            matchings.append(
+                (None, None, None, None) if return_offsets else (None, None, None)
+            )
+            continue
+        best_position = window_positions[best_variant, i, best_window]
+        matching = (
+            utils.geometry.Pointcloud(
+                element_windows.skeletons[best_position].tolist()
+            ),
+            float(best_rmse),
+            window_transformations[best_position],
+        )
+        if return_offsets:
+            # the offsets of the reversed skeletons are measured from its other end
+            offset = element_windows.offsets[i, best_window]
+            if best_variant >= 2:
+                offset = (
+                    element_windows.skeleton_lengths[i]
+                    - offset
+                    - element_windows.element_length
+                )
+            matching += (float(offset),)
+        matchings.append(matching)
+    return matchings
+
+
+def compute_best_trees_element_matching_in_parallel(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    trees: List[utils.tree.TreeSkeleton],
+    minimum_rmse: float,
+    executor: Executor = Executor.SERIAL,
+    n_workers: int = None,
+    **kwargs,
+) -> List[Tuple[utils.geometry.Pointcloud, float, np.ndarray]]:
+    """
+    Spread compute_best_trees_element_matching over a pool of workers.
+    The trees are split in one chunk per worker. Only their skeleton-only views are sent to the workers.
+
+    :param model_element: Pointcloud
+        The model element point cloud to align to
+    :param reference_diameter: float
+        The diameter of the model element which we want to match to
+    :param trees: list of TreeSkeleton
+        The skeleton-only views of the trees we want to match to the model element
+    :param minimum_rmse: float
+        The minimum rmse to consider the alignment as valid
+    :param executor: Executor
+        How the trees are scored. SERIAL (default) calls compute_best_trees_element_matching directly.
+    :param n_workers: int, optional
+        The number of workers. Defaults to the number of cpus.
+    :param kwargs:
+        The other arguments of compute_best_trees_element_matching (registration_method, window_step, return_offsets, offsets).
+        Explicit offsets are split along with the trees.
+
+    :return: matchings: list of tuples
+        The matchings, in the order of the trees. See compute_best_trees_element_matching.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if executor == Executor.SERIAL or n_workers < 2 or len(trees) < 2:
+        return compute_best_trees_element_matching(
+            model_element, reference_diameter, trees, minimum_rmse, **kwargs
+        )
+
+    pool = _get_pool(executor, n_workers)
+    chunk_size = int(np.ceil(len(trees) / n_workers))
+    offsets = kwargs.pop("offsets", None)
+    futures = [
+        pool.submit(
+            compute_best_trees_element_matching,
+            model_element,
+            reference_diameter,
+            trees[chunk_start : chunk_start + chunk_size],
+            minimum_rmse,
+            offsets=(
+                None
+                if offsets is None
+                else offsets[chunk_start : chunk_start + chunk_size]
+            ),
+            **kwargs,
+        )
+        for chunk_start in range(0, len(trees), chunk_size)
+    ]
+    matchings = []
+    for future in futures:
+        matchings.extend(future.result())
+    return matchings
+
+
+def compute_best_elements_trees_matching(
+    model_elements: List[utils.geometry.Pointcloud],
+    reference_diameters: List[float],
+    element_trees: List[List[utils.tree.TreeSkeleton]],
+    minimum_rmse: float,
+    window_step: float = None,
+) -> List[List[Tuple[utils.geometry.Pointcloud, float, np.ndarray]]]:
+    """
+    Compute the best matching between several model elements and the trees given for each of them,
+    as compute_best_trees_element_matching does for one element with the KABSCH registration method.
+    The windows of all the pairs (element, tree) are registered together, in batches of at most KABSCH_BATCH_SIZE windows,
+    the elements with fewer points being padded (see packing_manipulations.perform_kabsch_registration_pairs).
+
+    :param model_elements: list of Pointcloud
+        The model element point clouds to align to
+    :param reference_diameters: list of float
+        The diameter of each model element
+    :param element_trees: list of lists of TreeSkeleton
+        For each model element, the skeleton-only views of the trees to match to it
+    :param minimum_rmse: float
+        The minimum rmse to consider the alignment as valid
+    :param window_step: float, optional
+        The step between the start offsets of the windows along the skeletons, see compute_best_trees_element_matching
+
+    :return: element_matchings: list of lists of tuples (best_skeleton, best_rmse, best_init_rotation)
+        For each model element, the matchings of its trees, in their order. See compute_best_trees_element_matching.
+    """
+    element_matchings = [[] for _ in model_elements]
+    pending_windows = {}
+
+    def register_pending_windows():
+        element_points = {
+            i: np.asarray(model_elements[i].points, dtype=np.float64)
+            for i in pending_windows
+        }
+        n_windows = [len(windows.skeletons) for windows in pending_windows.values()]
+        n_points = np.repeat(
+            [len(points) for points in element_points.values()], n_windows
+        )
+        max_points = max(len(points) for points in element_points.values())
+        source_skeletons = np.full((len(n_points), max_points, 3), np.nan)
+        target_skeletons = np.full((len(n_points), max_points, 3), np.nan)
+        window_start = 0
+        for i, windows in pending_windows.items():
+            window_slice = slice(window_start, window_start + len(windows.skeletons))
+            source_skeletons[window_slice, : len(element_points[i])] = windows.skeletons
+            target_skeletons[window_slice, : len(element_points[i])] = element_points[i]
+            window_start = window_slice.stop
+        rmse, transformations = packing_manipulations.perform_kabsch_registration_pairs(
+            target_skeletons, source_skeletons, n_points
+        )
+        window_starts = np.cumsum([0] + n_windows)
+        for (i, windows), window_start, window_stop in zip(
+            pending_windows.items(), window_starts[:-1], window_starts[1:]
+        ):
+            element_matchings[i] = _select_best_windows(
+                windows,
+                rmse[window_start:window_stop],
+                transformations[window_start:window_stop],
+                minimum_rmse,
+            )
+        pending_windows.clear()
+
+    for i, (model_element, reference_diameter, trees) in enumerate(
+        zip(model_elements, reference_diameters, element_trees)
+    ):
+        if len(trees) == 0:
+            continue
+        pending_windows[i] = _match_element_windows(
+            model_element, reference_diameter, trees, window_step
+        )
+        if (
+            sum(len(windows.skeletons) for windows in pending_windows.values())
+            >= KABSCH_BATCH_SIZE
+        ):
+            register_pending_windows()
+    if len(pending_windows) > 0:
+        register_pending_windows()
+    return element_matchings
+
+
+def compute_best_elements_trees_matching_in_parallel(
+    model_elements: List[utils.geometry.Pointcloud],
+    reference_diameters: List[float],
+    element_trees: List[List[utils.tree.TreeSkeleton]],
+    minimum_rmse: float,
+    executor: Executor = Executor.SERIAL,
+    n_workers: int = None,
+    window_step: float = None,
+) -> List[List[Tuple[utils.geometry.Pointcloud, float, np.ndarray]]]:
+    """
+    Spread compute_best_elements_trees_matching over a pool of workers.
+    The trees of each model element are split in one chunk per worker, so that each worker registers its pairs in one batch.
+
+    :param executor: Executor
+        How the pairs are scored. SERIAL (default) calls compute_best_elements_trees_matching directly.
+    :param n_workers: int, optional
+        The number of workers. Defaults to the number of cpus.
+
+    :return: element_matchings: list of lists of tuples
+        For each model element, the matchings of its trees, in their order. See compute_best_elements_trees_matching.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if executor == Executor.SERIAL or n_workers < 2:
+        return compute_best_elements_trees_matching(
+            model_elements,
+            reference_diameters,
+            element_trees,
+            minimum_rmse,
+            window_step=window_step,
+        )
+
+    pool = _get_pool(executor, n_workers)
+    chunk_sizes = [int(np.ceil(len(trees) / n_workers)) for trees in element_trees]
+    futures = [
+        pool.submit(
+            compute_best_elements_trees_matching,
+            model_elements,
+            reference_diameters,
+            [
+                trees[worker * chunk_size : (worker + 1) * chunk_size]
+                for trees, chunk_size in zip(element_trees, chunk_sizes)
+            ],
+            minimum_rmse,
+            window_step=window_step,
+        )
+        for worker in range(n_workers)
+    ]
+    element_matchings = [[] for _ in model_elements]
+    for future in futures:
+        for matchings, chunk_matchings in zip(element_matchings, future.result()):
+            matchings.extend(chunk_matchings)
+    return element_matchings
+
+
+def _reverse_padded(padded_arrays: np.ndarray, n_values: np.ndarray) -> np.ndarray:
+    """
+    Reverse the valid part of each row of a NaN-padded array, as built by stack_skeletons.
+    """
+    n_columns = padded_arrays.shape[1]
+    indices = n_values[:, np.newaxis] - 1 - np.arange(n_columns)[np.newaxis]
+    reversed_arrays = padded_arrays[
+        np.arange(len(padded_arrays))[:, np.newaxis], np.maximum(indices, 0)
+    ]
+    reversed_arrays[indices < 0] = np.nan
+    return reversed_arrays
+
+
+def rank_candidates_coarse_to_fine(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    feature_index: np.ndarray,
+    candidate_ids: np.ndarray,
+    window_step: float = None,
+    keep_fraction: float = COARSE_TO_FINE_KEEP_FRACTION,
+    min_kept: int = CANDIDATE_BATCH_SIZE,
+) -> np.ndarray:
+    """
+    Rank the candidate trees of a model element at the coarse levels of the skeleton pyramid of the feature index, from the coarsest,
+    keeping the best @keep_fraction of them at each level. No tree is loaded from the database.
+    At each level, the model element is registered with the KABSCH method to the same windows, in the same four orientations,
+    as compute_best_trees_element_matching, with the points of the windows interpolated from the level.
+    The windows are located and checked against the diameter band with the range tables of the index.
+    The kept trees are then meant to be scored at full resolution, so the rmse of the selected tree is not approximated.
+
+    ```
+    level 3:  ○ ○ ○ ○ ○ ○ ○ ○   all the candidates
+    level 6:  ○   ○ ○     ○     the best fraction of them
+    full:       ○ ○             the best fraction of those, scored with their skeletons
+    ```
+
+    :param model_element: Pointcloud
+        The model element point cloud to align to
+    :param reference_diameter: float
+        The diameter of the model element
+    :param feature_index: np.ndarray
+        The feature index of the database
+    :param candidate_ids: np.ndarray
+        The ids of the candidate trees, see utils.feature_index.select_candidates
+    :param window_step: float, optional
+        The step between the start offsets of the windows, see compute_best_trees_element_matching. None (default) for the anchored windows only.
+    :param keep_fraction: float, optional
+        The fraction of the trees kept at each level. The default is COARSE_TO_FINE_KEEP_FRACTION.
+    :param min_kept: int, optional
+        The minimum number of trees kept at each level. The default is CANDIDATE_BATCH_SIZE.
+
+    :return: kept_ids: np.ndarray
+        The ids of the kept trees, from the best match at the last coarse level. Trees without any valid window are discarded.
+    """
+    features = feature_index[np.isin(feature_index["id"], candidate_ids)]
+    element_points = np.asarray(model_element.points, dtype=np.float64)
+    element_arc_lengths = packing_manipulations.compute_arc_lengths(element_points)
+    element_length = element_arc_lengths[-1]
+    window_starts, is_valid = utils.feature_index.locate_windows_in_diameter_band(
+        features, reference_diameter, element_length, window_step
+    )
+    # from each window start, the model element is matched forwards or backwards along the skeleton,
+    # which covers the four orientations of the full matching
+    element_arc_lengths = np.stack(
+        [element_arc_lengths, element_length - element_arc_lengths]
+    )
+
+    for n_points in utils.feature_index.SKELETON_PYRAMID_LEVELS:
+        if len(features) <= min_kept:
+            break
+        arc_lengths = (
+            window_starts[:, :, np.newaxis, np.newaxis]
+            + element_arc_lengths[np.newaxis, np.newaxis]
+        )
+        window_points = utils.feature_index.interpolate_skeleton_pyramid(
+            features, n_points, arc_lengths
+        )
+        is_window_valid = np.broadcast_to(
+            is_valid[:, :, np.newaxis], arc_lengths.shape[:3]
+        )
+        rmse = np.full(arc_lengths.shape[:3], np.inf)
+        if np.any(is_window_valid):
+            _, rmse[is_window_valid] = utils.geometrical_operations.kabsch_registration(
+                window_points[is_window_valid], element_points
+            )
+        scores = np.min(rmse.reshape(len(features), -1), axis=1)
+        n_kept = max(min_kept, int(np.ceil(keep_fraction * len(features))))
+        kept = np.argsort(scores, kind="stable")[:n_kept]
+        # the trees with less than 2 skeleton points have NaN scores, and can't be matched
+        kept = kept[np.isfinite(scores[kept])]
+        features = features[kept]
+        window_starts = window_starts[kept]
+        is_valid = is_valid[kept]
+    return features["id"]
+
+
+def _open_database(
+    database: Union[str, db_reader.DatabaseReader],
+) -> Tuple[db_reader.DatabaseReader, bool]:
+    """
+    Get a DatabaseReader from a path to the database, or from an already open DatabaseReader session.
+
+    :return: reader: DatabaseReader
+        The reader to use
+    :return: is_session: bool
+        True if the reader was given as a session, in which case it must be left open
+    """
+    if isinstance(database, db_reader.DatabaseReader):
+        return database, True
+    return db_reader.DatabaseReader(database), False
+
+
+def _close_database(reader: db_reader.DatabaseReader, is_session: bool):
+    """
+    Close the reader, unless it is a session opened by the caller.
+    """
+    if not is_session:
+        reader.close()
+
+
+def _check_commit(
+    database: Union[str, db_reader.DatabaseReader], update_database: bool, commit: bool
+):
+    """
+    Check that an update of the database which is not committed can be committed by the caller,
+    i.e. that the database is an open DatabaseReader session and not a path, whose reader is closed before returning.
+    """
+    if (
+        update_database
+        and not commit
+        and not isinstance(database, db_reader.DatabaseReader)
+    ):
+        raise ValueError(
+            "commit=False requires an open DatabaseReader session: the update of a database given by its path would be lost when closing it."
+        )
+
+
+def retrieve_nearest_windows(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    window_index: utils.window_index.WindowIndex,
+    feature_index: np.ndarray,
+    n_windows: int = NEAREST_WINDOWS,
+    window_step: float = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Retrieve the windows of the window index whose descriptors are the closest to those of a model element, in logarithmic time
+    (see utils.window_index). Among them, the windows of the trees too different in mean diameter from the reference, or too short, are skipped.
+    The element is placed on each window at the same relative position along the skeleton, so that the windows anchored
+    at the ends of the skeletons stay anchored:
+
+    ```
+    window of the index:    window of the element:
+    |        p              |        p
+    |        |  <- start    |        p  <- offset = start * (skeleton - element) / (skeleton - window)
+    |        |              |        |
+    |        p              |        p
+    ```
+
+    :param model_element: Pointcloud
+        The model element point cloud to align to
+    :param reference_diameter: float
+        The diameter of the model element
+    :param window_index: WindowIndex
+        The window index of the database, see DatabaseReader.get_window_index
+    :param feature_index: np.ndarray
+        The feature index of the database
+    :param n_windows: int, optional
+        The number of windows to retrieve. The default is NEAREST_WINDOWS.
+    :param window_step: float, optional
+        If given, the element is also placed every window_step meters around each window, up to halfway to the next windows of the index
+        (see utils.window_index.WINDOW_STEP_RATIO). None (default) only places it once per window.
+
+    :return: candidate_ids: np.ndarray
+        The ids of the trees of the windows, from the tree of the closest window
+    :return: offsets: np.array (n_trees, n_tree_windows)
+        The start offsets of the element along the skeleton of each tree, padded with NaN, see compute_best_trees_element_matching
+    """
+    element_points = np.asarray(model_element.points, dtype=np.float64)
+    element_length = utils.geometrical_operations.compute_polyline_length(
+        element_points
+    )
+    descriptors = utils.window_index.compute_element_descriptors(
+        element_points, reference_diameter
+    )
+    tree_ids, starts, lengths, _ = window_index.query(descriptors, n_windows)
+    rows = np.minimum(
+        np.searchsorted(feature_index["id"], tree_ids), len(feature_index) - 1
+    )
+    features = feature_index[rows]
+    is_candidate = (
+        (features["id"] == tree_ids)
+        & (features["mean_diameter"] >= 0.75 * reference_diameter)
+        & (features["mean_diameter"] <= 1.25 * reference_diameter)
+        & (features["skeleton_length"] >= element_length)
+    )
+    tree_ids = tree_ids[is_candidate]
+    skeleton_lengths = features["skeleton_length"][is_candidate]
+    starts, lengths = starts[is_candidate], lengths[is_candidate]
+    relative_starts = np.divide(
+        starts,
+        skeleton_lengths - lengths,
+        out=np.zeros(len(tree_ids)),
+        where=skeleton_lengths > lengths,
+    )
+    window_offsets = np.clip(relative_starts, 0.0, 1.0) * (
+        skeleton_lengths - element_length
+    )
+    if window_step is not None:
+        n_steps = int(
+            np.floor(
+                0.5
+                * utils.window_index.WINDOW_STEP_RATIO
+                * np.max(lengths, initial=0.0)
+                / window_step
+            )
+        )
+        steps = window_step * np.arange(-n_steps, n_steps + 1)
+        is_close = np.abs(steps) <= (
+            0.5 * utils.window_index.WINDOW_STEP_RATIO * lengths[:, np.newaxis]
+        )
+        window_offsets = np.clip(
+            window_offsets[:, np.newaxis] + steps,
+            0.0,
+            (skeleton_lengths - element_length)[:, np.newaxis],
+        )
+        window_offsets[~is_close] = np.nan
+        tree_ids = np.repeat(tree_ids, len(steps))
+        window_offsets = window_offsets.reshape(-1)
+
+    candidate_ids, first_windows = np.unique(tree_ids, return_index=True)
+    candidate_ids = candidate_ids[np.argsort(first_windows)]
+    tree_offsets = [
+        np.unique(window_offsets[(tree_ids == i) & ~np.isnan(window_offsets)])
+        for i in candidate_ids
+    ]
+    offsets = np.full(
+        (len(candidate_ids), max((len(o) for o in tree_offsets), default=0)), np.nan
+    )
+    for i, tree_offset in enumerate(tree_offsets):
+        offsets[i, : len(tree_offset)] = tree_offset
+    return candidate_ids, offsets
+
+
+def _select_search_candidates(
+    model_element: utils.geometry.Pointcloud,
+    reference_diameter: float,
+    reader: db_reader.DatabaseReader,
+    registration_method: packing_manipulations.RegistrationMethod,
+    window_step: float,
+    search_strategy: SearchStrategy,
+    min_kept: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select the candidate trees of a find_best_tree search, following its search strategy.
+    With the COARSE_TO_FINE strategy, at least @min_kept of them are kept.
+
+    :return: candidate_ids: np.ndarray
+        The ids of the candidate trees
+    :return: offsets: np.ndarray or None
+        The start offsets of the windows to score on each candidate tree, padded with NaN,
+        or None to score the windows given by window_step
+    """
+    if (
+        search_strategy != SearchStrategy.EXHAUSTIVE
+        and registration_method != packing_manipulations.RegistrationMethod.KABSCH
+    ):
+        raise ValueError(
+            f"The {search_strategy.name} search is only available with the KABSCH registration method."
+        )
+    if search_strategy == SearchStrategy.NEAREST_WINDOWS:
+        return retrieve_nearest_windows(
+            model_element,
+            reference_diameter,
+            reader.get_window_index(),
+            reader.get_feature_index(),
+            window_step=window_step,
+        )
+
+    # we avoid considering trees that are too different in mean diameter from the reference, too short,
+    # or without any window within the diameter band, in one pass over the feature index of the database
+    candidate_ids = utils.feature_index.select_candidates(
+        reader.get_feature_index(),
+        reference_diameter,
+        utils.geometrical_operations.compute_polyline_length(model_element.points),
+        window_step=window_step,
+        check_windows=registration_method
+        == packing_manipulations.RegistrationMethod.KABSCH,
+    )
+    if search_strategy == SearchStrategy.COARSE_TO_FINE:
+        candidate_ids = rank_candidates_coarse_to_fine(
+            model_element,
+            reference_diameter,
+            reader.get_feature_index(),
+            candidate_ids,
+            window_step=window_step,
+            keep_fraction=COARSE_TO_FINE_KEEP_FRACTION,
+            min_kept=min_kept,
+        )
+    return candidate_ids, None
+
+
+def _get_candidate_skeletons(
+    reader: db_reader.DatabaseReader, tree_ids: np.ndarray, from_index: bool = False
+) -> List[utils.tree.TreeSkeleton]:
+    """
+    Get the skeleton-only views of candidate trees, loaded from the database or created from its feature index
+    (see utils.feature_index.get_skeleton_views). The trees missing from the database are skipped.
+    """
+    if not from_index:
+        trees = [reader.get_tree_skeleton(int(i)) for i in tree_ids]
+        return [tree for tree in trees if tree is not None]
+    features = reader.get_feature_index()
+    rows = np.minimum(np.searchsorted(features["id"], tree_ids), len(features) - 1)
+    rows = rows[features["id"][rows] == tree_ids]
+    return utils.feature_index.get_skeleton_views(features[rows])
+
+
 def find_best_tree_unoptimized(
     model_element: utils.geometry.Pointcloud,
     reference_diameter: float,
-    database_path: str,
+    database_path: Union[str, db_reader.DatabaseReader],
     return_rmse: bool = False,
     update_database: bool = True,
+    registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.KABSCH,
+    window_step: float = None,
+    executor: Executor = Executor.SERIAL,
+    n_workers: int = None,
+    commit: bool = True,
+    search_strategy: SearchStrategy = SearchStrategy.EXHAUSTIVE,
 ):
     """
     performs icp registrations bewteen the reference skeleton and the list of targets,
@@ -113,12 +990,31 @@ def find_best_tree_unoptimized(
         The reference skeleton to align to
     :param reference_diameter: float
         The diameter of the reference skeleton
-    :param database_path: str
-        The path to the database. The database is updated by removing from it the part of the best fitting skeleton.
+    :param database_path: str or DatabaseReader
+        The path to the database, or an open DatabaseReader session, which is then left open.
+        The database is updated by removing from it the part of the best fitting skeleton.
     :param return_rmse: bool
         Whether to return the rmse of the best fitting tree. This is for evaluation purposes.
     :param update_database: bool
         Whether to update the database by removing the best fitting tree from it.
+    :param registration_method: RegistrationMethod
+        The method used to register the skeletons. KABSCH (default) scores all the candidate trees in one batch, ICP is kept for comparison.
+    :param window_step: float, optional
+        If given, the model element is also matched to windows starting every window_step meters along the skeletons, not only at their ends.
+    :param executor: Executor
+        Whether the candidate trees are scored serially (default), on threads or on processes. The database is only read and updated by the main process.
+    :param n_workers: int, optional
+        The number of workers of the executor. Defaults to the number of cpus.
+    :param commit: bool
+        Whether to commit the update of the database. If False, the trim is only applied in memory, and the caller commits it (see allocate_elements).
+        This requires @database_path to be an open DatabaseReader session, otherwise the trim would be lost when the database is closed.
+    :param search_strategy: SearchStrategy
+        EXHAUSTIVE (default) scores all the candidate trees with their full skeletons.
+        COARSE_TO_FINE first ranks them at the coarse levels of the skeleton pyramid, and only scores the best ones, with skeleton-only views
+        created from the feature index (see rank_candidates_coarse_to_fine).
+        NEAREST_WINDOWS only scores the windows of the window index closest to the model element, instead of those given by window_step,
+        without scanning the database (see retrieve_nearest_windows).
+        Only available with the KABSCH registration method.
 
     :return: best_tree: Tree
         The best fitting tree for which the skeleton was cropped to the best fitting segment
@@ -127,49 +1023,70 @@ def find_best_tree_unoptimized(
     :return: rmse: float
         The rmse of the best fitting tree. Only returned if return_rmse is True.
     """
+    _check_commit(database_path, update_database, commit)
     # unpack the database:
-    reader = db_reader.DatabaseReader(database_path)
-    n_tree = reader.get_num_trees()
+    reader, is_session = _open_database(database_path)
     best_tree = None
     best_init_rotation = None
 
+    candidate_ids, candidate_offsets = _select_search_candidates(
+        model_element,
+        reference_diameter,
+        reader,
+        registration_method,
+        window_step,
+        search_strategy,
+        CANDIDATE_BATCH_SIZE,
+    )
+
     # initiallize the best rmse to infinity before the first iteration
     best_db_level_rmse = np.inf
-    # iterate over the trees in the database
-    for i in range(n_tree):
-        tree = reader.get_tree(i)
-        if tree is not None:
-            tree = copy.deepcopy(tree)
-        else:
-            continue
-        if (
-            tree.mean_diameter < 0.75 * reference_diameter
-            or tree.mean_diameter
-            > 1.25
-            * reference_diameter  # we avoid considering trees that are too different in mean diameter from the references
-        ):
-            continue
-        (
+    # work on the skeletons of the candidate trees, batch by batch. Full trees are only loaded for the best one.
+    batch_size = CANDIDATE_BATCH_SIZE
+    if executor != Executor.SERIAL:
+        batch_size *= n_workers if n_workers is not None else os.cpu_count()
+    for batch_start in range(0, len(candidate_ids), batch_size):
+        candidate_trees = _get_candidate_skeletons(
+            reader,
+            candidate_ids[batch_start : batch_start + batch_size],
+            from_index=search_strategy != SearchStrategy.EXHAUSTIVE,
+        )
+        matchings = compute_best_trees_element_matching_in_parallel(
+            model_element,
+            reference_diameter,
+            candidate_trees,
+            np.inf,
+            executor=executor,
+            n_workers=n_workers,
+            registration_method=registration_method,
+            window_step=window_step,
+            offsets=(
+                None
+                if candidate_offsets is None
+                else candidate_offsets[batch_start : batch_start + batch_size]
+            ),
+        )
+
+        for tree, (
             best_skeleton_segment,
             best_tree_level_rmse,
             init_rotation,
-        ) = compute_best_tree_element_matching(
-            model_element, reference_diameter, tree, np.inf
-        )
-
-        if (
-            best_tree_level_rmse is not None
-            and best_tree_level_rmse < best_db_level_rmse
-        ):
-            best_tree_id = i
-            best_db_level_rmse = best_tree_level_rmse
-            best_tree = tree
-            best_skeleton = best_skeleton_segment
-            best_init_rotation = init_rotation
+        ) in zip(candidate_trees, matchings):
+            if (
+                best_tree_level_rmse is not None
+                and best_tree_level_rmse < best_db_level_rmse
+            ):
+                best_tree_id = tree.id
+                best_db_level_rmse = best_tree_level_rmse
+                best_tree = tree
+                best_skeleton = best_skeleton_segment
+                best_init_rotation = init_rotation
 
-        if (
-            best_db_level_rmse < 0.01
-        ):  # if the RMSE is under 1 cm, we can break the loop
+            if (
+                best_db_level_rmse < 0.01
+            ):  # if the RMSE is under 1 cm, we can break the loop
+                break
+        if best_db_level_rmse < 0.01:
             break
 
     if best_tree is not None:
@@ -178,36 +1095,29 @@ def find_best_tree_unoptimized(
             f"Best tree is {best_tree.id} with rmse {best_db_level_rmse} and height {best_tree.height}"
         )
 
+        # only the winning tree is loaded and copied with its point cloud
+        best_tree = copy.deepcopy(reader.get_tree(best_tree_id))
         selected_tree = copy.deepcopy(best_tree)
         selected_tree.skeleton = best_skeleton
-        best_tree.trim(best_skeleton)
+        offcuts = best_tree.trim(best_skeleton)
 
         if update_database:
-            # remove the tree from the database if its skeleton is a single point, or empty.
-            if len(best_tree.skeleton.points) < 2:
-                reader.root.trees.pop(best_tree_id)
-                reader.root.n_trees -= 1
-                transaction.commit()
-                reader.close()
-
             # update the database, as done in https://zodb.org/en/latest/articles/ZODB1.html#a-simple-example
-            else:
-                trees_in_db = reader.root.trees
-                trees_in_db[best_tree_id] = best_tree
-                reader.root.trees = trees_in_db
+            _store_trimmed_tree(reader, best_tree_id, best_tree, offcuts)
+            if commit:
                 transaction.commit()
-            # close the database
-            reader.close()
+        # close the database
+        _close_database(reader, is_session)
         if return_rmse:
             return (
                 selected_tree,
-                best_skeleton_segment,
+                best_skeleton,
                 best_db_level_rmse,
                 best_init_rotation,
             )
         return selected_tree
     else:
-        reader.close()
+        _close_database(reader, is_session)
         print("No tree found in find_best_tree, returning None")
         return None, None, None, None
 
@@ -215,10 +1125,16 @@ def find_best_tree_unoptimized(
 def find_best_tree_optimized(
     model_element: utils.geometry.Pointcloud,
     reference_diameter: float,
-    database_path: str,
+    database_path: Union[str, db_reader.DatabaseReader],
     optimisation_basis: int,
     return_rmse: bool = False,
     update_database: bool = True,
+    registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.KABSCH,
+    window_step: float = None,
+    executor: Executor = Executor.SERIAL,
+    n_workers: int = None,
+    commit: bool = True,
+    search_strategy: SearchStrategy = SearchStrategy.EXHAUSTIVE,
 ):
     """
     performs icp registrations bewteen the reference skeleton and the list of targets,
@@ -231,14 +1147,33 @@ def find_best_tree_optimized(
         The reference skeleton to align to
     :param reference_diameter: float
         The diameter of the reference skeleton
-    :param database_path: str
-        The path to the database. The database is updated by removing from it the part of the best fitting skeleton.
+    :param database_path: str or DatabaseReader
+        The path to the database, or an open DatabaseReader session, which is then left open.
+        The database is updated by removing from it the part of the best fitting skeleton.
     :param optimisation_basis: int
         The number of elements to consider for the optimisation
     :param return_rmse: bool
         Whether to return the rmse of the best fitting tree. This is for evaluation purposes.
     :param update_database: bool
         Whether to update the database by removing the best fitting tree from it.
+    :param registration_method: RegistrationMethod
+        The method used to register the skeletons. KABSCH (default) scores all the candidate trees in one batch, ICP is kept for comparison.
+    :param window_step: float, optional
+        If given, the model element is also matched to windows starting every window_step meters along the skeletons, not only at their ends.
+    :param executor: Executor
+        Whether the candidate trees are scored serially (default), on threads or on processes. The database is only read and updated by the main process.
+    :param n_workers: int, optional
+        The number of workers of the executor. Defaults to the number of cpus.
+    :param commit: bool
+        Whether to commit the update of the database. If False, the trim is only applied in memory, and the caller commits it (see allocate_elements).
+        This requires @database_path to be an open DatabaseReader session, otherwise the trim would be lost when the database is closed.
+    :param search_strategy: SearchStrategy
+        EXHAUSTIVE (default) scores all the candidate trees with their full skeletons.
+        COARSE_TO_FINE first ranks them at the coarse levels of the skeleton pyramid, and only scores the best ones, with skeleton-only views
+        created from the feature index (see rank_candidates_coarse_to_fine).
+        NEAREST_WINDOWS only scores the windows of the window index closest to the model element, instead of those given by window_step,
+        without scanning the database (see retrieve_nearest_windows).
+        Only available with the KABSCH registration method.
 
     :return: best_tree: Tree
         The best fitting tree for which the skeleton was cropped to the best fitting segment
@@ -251,9 +1186,9 @@ def find_best_tree_optimized(
     :return: best_init_rotation: np.array
         The best initial rotation that was applied to the target skeleton to match the reference once both are reset to the origin
     """
+    _check_commit(database_path, update_database, commit)
     # unpack the database:
-    reader = db_reader.DatabaseReader(database_path)
-    n_tree = reader.get_num_trees()
+    reader, is_session = _open_database(database_path)
     best_tree = None
     # initiallize the best rmse to infinity before the first iteration
 
@@ -263,35 +1198,48 @@ def find_best_tree_optimized(
     tree_ids = []
     best_init_rotations = []
 
-    # iterate over the trees in the database
-    for i in range(n_tree):
-        tree = reader.get_tree(i)
-        if tree is not None:
-            tree = copy.deepcopy(tree)
-        else:
-            continue
-        if (
-            tree.mean_diameter < 0.75 * reference_diameter
-            or tree.mean_diameter > 1.25 * reference_diameter
-        ):
-            continue
-        (
-            best_skeleton_segment,
-            best_tree_level_rmse,
-            best_init_rotation,
-        ) = compute_best_tree_element_matching(
-            model_element, reference_diameter, tree, np.inf
-        )
+    candidate_ids, candidate_offsets = _select_search_candidates(
+        model_element,
+        reference_diameter,
+        reader,
+        registration_method,
+        window_step,
+        search_strategy,
+        max(CANDIDATE_BATCH_SIZE, optimisation_basis),
+    )
+
+    # work on the skeletons of the candidate trees. Full trees are only loaded for the best one.
+    candidate_trees = _get_candidate_skeletons(
+        reader,
+        candidate_ids,
+        from_index=search_strategy != SearchStrategy.EXHAUSTIVE,
+    )
+    matchings = compute_best_trees_element_matching_in_parallel(
+        model_element,
+        reference_diameter,
+        candidate_trees,
+        np.inf,
+        executor=executor,
+        n_workers=n_workers,
+        registration_method=registration_method,
+        window_step=window_step,
+        offsets=candidate_offsets,
+    )
 
+    for tree, (
+        best_skeleton_segment,
+        best_tree_level_rmse,
+        best_init_rotation,
+    ) in zip(candidate_trees, matchings):
         if best_tree_level_rmse is not None and best_tree_level_rmse is not np.inf:
             rmse.append(best_tree_level_rmse)
             trees.append(tree)
             skeleton_segments.append(best_skeleton_segment)
             best_init_rotations.append(best_init_rotation)
-            tree_ids.append(i)
+            tree_ids.append(tree.id)
 
     if len(rmse) == 0:
-        reader.close()
+        _close_database(reader, is_session)
         print(
             f"No tree were found in the database, but {optimisation_basis} are required"
         )
@@ -305,7 +1253,7 @@ def find_best_tree_optimized(
     ) = zip(
         *sorted(
             zip(rmse, trees, skeleton_segments, tree_ids, best_init_rotations),
-            key=lambda x: rmse,
+            key=lambda x: x[0],
         )
     )
     n_best_trees = sorted_trees[:optimisation_basis]
@@ -344,42 +1292,818 @@ def find_best_tree_optimized(
             f"Best tree is {best_tree.id} with rmse {best_db_level_rmse} and height {best_tree.height}"
         )
 
+        # only the winning tree is loaded and copied with its point cloud
+        best_tree = copy.deepcopy(reader.get_tree(best_tree_id))
         selected_tree = copy.deepcopy(best_tree)
         selected_tree.skeleton = best_skeleton
-        best_tree.trim(best_skeleton)
+        offcuts = best_tree.trim(best_skeleton)
 
         if update_database:
-            # remove the tree from the database if its skeleton is a single point, or empty.
-            if len(best_tree.skeleton.points) < 2:
-                reader.root.trees.pop(best_tree_id)
-                reader.root.n_trees -= 1
-                transaction.commit()
-
             # update the database, as done in https://zodb.org/en/latest/articles/ZODB1.html#a-simple-example
-            else:
-                trees_in_db = reader.root.trees
-                trees_in_db[best_tree_id] = best_tree
-                reader.root.trees = trees_in_db
+            _store_trimmed_tree(reader, best_tree_id, best_tree, offcuts)
+            if commit:
                 transaction.commit()
-
-            # close the database
-            reader.close()
+        # close the database
+        _close_database(reader, is_session)
         if return_rmse:
             return (
                 selected_tree,
-                best_skeleton_segment,
+                best_skeleton,
                 best_db_level_rmse,
                 best_init_rotation,
             )
-        reader.close()
         return selected_tree
 
     else:
-        reader.close()
+        _close_database(reader, is_session)
         print("No tree found in find_best_tree, returning None")
         return None, None, None, None, None
 
 
+class CostMatrix(object):
+    """
+    The costs of allocating each model element to each tree of the database, computed in one scan of the database.
+    For each pair (element, tree), the best matching of compute_best_trees_element_matching is kept:
+    its rmse (inf if the tree can't host the element), the best segment of the skeleton and the initial rotation.
+    The windows of all the pairs are registered together, see compute_best_elements_trees_matching.
+    When a tree is trimmed, only its column is recomputed (see update_tree), lazily: the stale entries of a row
+    are recomputed together, in one batch, when the row is needed (see refresh).
+
+    :param model_elements: list of Pointcloud
+        The model elements, one row of the matrix each
+    :param reference_diameters: list of float
+        The diameter of each model element
+    :param reader: DatabaseReader
+        The open database, one column of the matrix per tree of its feature index
+    :param registration_method: RegistrationMethod
+        The method used to register the skeletons, see compute_best_trees_element_matching
+    :param window_step: float, optional
+        If given, the model elements are also matched to windows starting every window_step meters along the skeletons
+    :param executor: Executor
+        How the candidate trees are scored, see compute_best_trees_element_matching_in_parallel
+    :param n_workers: int, optional
+        The number of workers of the executor. Defaults to the number of cpus.
+    """
+
+    def __init__(
+        self,
+        model_elements: List[utils.geometry.Pointcloud],
+        reference_diameters: List[float],
+        reader: db_reader.DatabaseReader,
+        registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.KABSCH,
+        window_step: float = None,
+        executor: Executor = Executor.SERIAL,
+        n_workers: int = None,
+    ):
+        self.model_elements = list(model_elements)
+        self.reference_diameters = list(reference_diameters)
+        self.element_lengths = np.array(
+            [
+                utils.geometrical_operations.compute_polyline_length(element.points)
+                for element in self.model_elements
+            ]
+        )
+        self.registration_method = registration_method
+        self.window_step = window_step
+        self.executor = executor
+        self.n_workers = n_workers
+
+        features = reader.get_feature_index()
+        self.tree_ids = features["id"].copy()
+        self.heights = features["height"].copy()
+        self.skeleton_lengths = features["skeleton_length"].copy()
+        shape = (len(self.model_elements), len(self.tree_ids))
+        self.rmse = np.full(shape, np.inf)
+        self.skeleton_segments = np.empty(shape, dtype=object)
+        self.init_rotations = np.empty(shape, dtype=object)
+        self.is_stale = np.zeros(shape, dtype=bool)
+        self._updated_trees = {}
+
+        # the feature index discards most pairs, and each candidate skeleton is loaded once for all the elements
+        is_candidate = np.stack(
+            [self._select_candidates(features, i) for i in range(shape[0])]
+        ).reshape(shape)
+        trees = {}
+        for column in np.flatnonzero(np.any(is_candidate, axis=0)):
+            tree = reader.get_tree_skeleton(int(self.tree_ids[column]))
+            if tree is not None:
+                trees[column] = tree
+        self._compute(
+            range(shape[0]),
+            [
+                [
+                    column
+                    for column in np.flatnonzero(is_candidate[i])
+                    if column in trees
+                ]
+                for i in range(shape[0])
+            ],
+            trees,
+        )
+
+    @property
+    def is_feasible(self) -> np.ndarray:
+        """
+        Whether each tree can host each element, as an array of bool (n_elements, n_trees).
+        """
+        return np.isfinite(self.rmse)
+
+    @property
+    def leftover_lengths(self) -> np.ndarray:
+        """
+        The length of skeleton left on each tree if each element is cut from it, as an array (n_elements, n_trees).
+        """
+        return self.skeleton_lengths[np.newaxis] - self.element_lengths[:, np.newaxis]
+
+    def _select_candidates(self, features: np.ndarray, element_index: int):
+        """
+        Whether the trees of the feature index are candidates for an element, see utils.feature_index.select_candidates.
+        """
+        return np.isin(
+            features["id"],
+            utils.feature_index.select_candidates(
+                features,
+                self.reference_diameters[element_index],
+                self.element_lengths[element_index],
+                window_step=self.window_step,
+                check_windows=self.registration_method
+                == packing_manipulations.RegistrationMethod.KABSCH,
+            ),
+        )
+
+    def _compute(
+        self,
+        element_indices: List[int],
+        element_columns: List[List[int]],
+        trees: dict,
+    ):
+        """
+        Score some elements against some trees, and store the results in the given columns of their rows.
+        With the KABSCH registration method, all the pairs are registered together, see compute_best_elements_trees_matching.
+
+        :param element_indices: list of int
+            The rows to compute
+        :param element_columns: list of lists of int
+            For each row, the columns to compute
+        :param trees: dict
+            The tree of each column to compute
+        """
+        element_trees = [
+            [trees[column] for column in columns] for columns in element_columns
+        ]
+        if self.registration_method == packing_manipulations.RegistrationMethod.KABSCH:
+            element_matchings = compute_best_elements_trees_matching_in_parallel(
+                [self.model_elements[i] for i in element_indices],
+                [self.reference_diameters[i] for i in element_indices],
+                element_trees,
+                np.inf,
+                executor=self.executor,
+                n_workers=self.n_workers,
+                window_step=self.window_step,
+            )
+        else:
+            element_matchings = [
+                compute_best_trees_element_matching_in_parallel(
+                    self.model_elements[i],
+                    self.reference_diameters[i],
+                    element_trees_i,
+                    np.inf,
+                    executor=self.executor,
+                    n_workers=self.n_workers,
+                    registration_method=self.registration_method,
+                    window_step=self.window_step,
+                )
+                for i, element_trees_i in zip(element_indices, element_trees)
+            ]
+        for element_index, columns, matchings in zip(
+            element_indices, element_columns, element_matchings
+        ):
+            for column, (skeleton_segment, rmse, init_rotation) in zip(
+                columns, matchings
+            ):
+                if rmse is None:
+                    continue
+                self.rmse[element_index, column] = rmse
+                self.skeleton_segments[element_index, column] = skeleton_segment
+                self.init_rotations[element_index, column] = init_rotation
+
+    def update_tree(
+        self, tree: utils.tree.TreeSkeleton, element_indices: List[int] = None
+    ):
+        """
+        Mark the column of a tree as stale after it changed, e.g. after a trim. It is recomputed by refresh.
+
+        :param tree: TreeSkeleton
+            The tree in its new state. Its id must be one of the columns.
+        :param element_indices: list of int, optional
+            The rows to recompute, e.g. the elements not allocated yet. The other rows are left as they are. All by default.
+        """
+        if element_indices is None:
+            element_indices = range(len(self.model_elements))
+        column = int(np.flatnonzero(self.tree_ids == tree.id)[0])
+        features = utils.feature_index.compute_tree_features(tree)
+        self.heights[column] = tree.height
+        self.skeleton_lengths[column] = features["skeleton_length"][0]
+        self._updated_trees[column] = (tree, features)
+        element_indices = np.asarray(element_indices, dtype=int)
+        self.rmse[element_indices, column] = np.inf
+        self.skeleton_segments[element_indices, column] = None
+        self.init_rotations[element_indices, column] = None
+        self.is_stale[element_indices, column] = True
+
+    def add_tree(
+        self, tree: utils.tree.TreeSkeleton, element_indices: List[int] = None
+    ):
+        """
+        Add a column for a tree added to the database, e.g. an offcut. It is computed by refresh.
+
+        :param tree: TreeSkeleton
+            The new tree
+        :param element_indices: list of int, optional
+            The rows to compute, e.g. the elements not allocated yet. The other rows are not feasible. All by default.
+        """
+        n_elements = len(self.model_elements)
+        self.tree_ids = np.append(self.tree_ids, tree.id)
+        self.heights = np.append(self.heights, tree.height)
+        self.skeleton_lengths = np.append(self.skeleton_lengths, 0.0)
+        self.rmse = np.hstack([self.rmse, np.full((n_elements, 1), np.inf)])
+        self.skeleton_segments = np.hstack(
+            [self.skeleton_segments, np.empty((n_elements, 1), dtype=object)]
+        )
+        self.init_rotations = np.hstack(
+            [self.init_rotations, np.empty((n_elements, 1), dtype=object)]
+        )
+        self.is_stale = np.hstack(
+            [self.is_stale, np.zeros((n_elements, 1), dtype=bool)]
+        )
+        self.update_tree(tree, element_indices)
+
+    def remove_tree(self, tree_id: int):
+        """
+        Mark a tree removed from the database as not feasible for any element.
+        """
+        column = np.flatnonzero(self.tree_ids == tree_id)[0]
+        self.rmse[:, column] = np.inf
+        self.skeleton_segments[:, column] = None
+        self.init_rotations[:, column] = None
+        self.is_stale[:, column] = False
+        self.skeleton_lengths[column] = 0.0
+        self._updated_trees.pop(column, None)
+
+    def refresh(self, element_indices: List[int] = None):
+        """
+        Recompute the stale entries of some rows, all in one batch.
+
+        :param element_indices: list of int, optional
+            The rows to refresh. All by default.
+        """
+        if element_indices is None:
+            element_indices = range(len(self.model_elements))
+        element_indices = list(element_indices)
+        self._compute(
+            element_indices,
+            [
+                [
+                    column
+                    for column in np.flatnonzero(self.is_stale[i])
+                    if self._select_candidates(self._updated_trees[column][1], i)[0]
+                ]
+                for i in element_indices
+            ],
+            {column: tree for column, (tree, _) in self._updated_trees.items()},
+        )
+        self.is_stale[element_indices] = False
+
+    def select_tree(self, element_index: int, optimisation_basis: int = None) -> int:
+        """
+        Select the tree to allocate to an element, as find_best_tree_unoptimized and find_best_tree_optimized do.
+
+        :param element_index: int
+            The row of the element
+        :param optimisation_basis: int, optional
+            If given, the smallest tree among the @optimisation_basis trees with the lowest rmse is selected.
+            Otherwise the tree with the lowest rmse is selected.
+        :return: column: int
+            The column of the selected tree, or None if no tree can host the element
+        """
+        self.refresh([element_index])
+        rmse = self.rmse[element_index]
+        columns = np.flatnonzero(np.isfinite(rmse))
+        if len(columns) == 0:
+            return None
+        columns = columns[np.argsort(rmse[columns], kind="stable")]
+        if optimisation_basis is None:
+            return int(columns[0])
+        columns = columns[:optimisation_basis]
+        return int(columns[np.argmin(self.heights[columns])])
+
+
+def _store_trimmed_tree(
+    reader: db_reader.DatabaseReader,
+    tree_id: int,
+    trimmed_tree: utils.tree.Tree,
+    offcuts: List[utils.tree.Tree],
+) -> utils.tree.Tree:
+    """
+    Store a trimmed tree in the database, and add its offcuts as new trees (see Tree.trim).
+    The tree is removed from the database if what is left of its skeleton is a single point, or empty.
+    The changes are only saved at the next transaction.commit().
+
+    :return: trimmed_tree: Tree
+        The trimmed tree, or None if it was removed
+    """
+    for offcut in offcuts:
+        reader.add_tree(offcut)
+        print(f"Offcut of tree {tree_id} added as tree {offcut.id}")
+    if len(trimmed_tree.skeleton.points) < 2:
+        reader.remove_tree(tree_id)
+        return None
+    reader.set_tree(tree_id, trimmed_tree)
+    return trimmed_tree
+
+
+def _trim_allocated_tree(
+    reader: db_reader.DatabaseReader,
+    tree_id: int,
+    best_skeleton: utils.geometry.Pointcloud,
+) -> Tuple[utils.tree.Tree, utils.tree.Tree, List[utils.tree.Tree]]:
+    """
+    Cut the segment allocated to an element from a tree of the database, in memory.
+    The tree is removed from the database if what is left of its skeleton is a single point, or empty,
+    and its offcuts are added as new trees.
+
+    :return: selected_tree: Tree
+        A copy of the tree, with the allocated segment as its skeleton
+    :return: trimmed_tree: Tree
+        What is left of the tree, as stored in the database, or None if it was removed
+    :return: offcuts: list of Tree
+        The offcuts added to the database
+    """
+    trimmed_tree = copy.deepcopy(reader.get_tree(tree_id))
+    selected_tree = copy.deepcopy(trimmed_tree)
+    selected_tree.skeleton = best_skeleton
+    offcuts = trimmed_tree.trim(best_skeleton)
+    trimmed_tree = _store_trimmed_tree(reader, tree_id, trimmed_tree, offcuts)
+    return selected_tree, trimmed_tree, offcuts
+
+
+def allocate_elements(
+    model_elements: List[utils.geometry.Pointcloud],
+    reference_diameters: List[float],
+    database_path: Union[str, db_reader.DatabaseReader],
+    optimisation_basis: int = None,
+    commit_every: int = None,
+    **kwargs,
+) -> List[Tuple[utils.tree.Tree, utils.geometry.Pointcloud, float, np.ndarray]]:
+    """
+    Allocate trees to a list of model elements in one batch, e.g. all the elements of a model.
+    The elements are scored against all the trees once, in a CostMatrix, and allocated one after the other in the given order,
+    as find_best_tree_unoptimized (or find_best_tree_optimized) would. After each trim, only the column of the trimmed tree is recomputed.
+    The trims are applied in memory and committed once at the end, or every @commit_every elements.
+    A savepoint is made after each element, so ZODB can move the trimmed trees out of memory before the commit.
+    If an element fails, everything since the last commit is rolled back and the error is raised again.
+
+    :param model_elements: list of Pointcloud
+        The model elements to allocate trees to, in the order of allocation
+    :param reference_diameters: list of float
+        The diameter of each model element
+    :param database_path: str or DatabaseReader
+        The path to the database, or an open DatabaseReader session, which is then left open.
+    :param optimisation_basis: int, optional
+        If given, the smallest of the @optimisation_basis best fitting trees is selected, as in find_best_tree_optimized.
+        Otherwise the best fitting tree is selected, as in find_best_tree_unoptimized.
+    :param commit_every: int, optional
+        The number of elements after which the changes are committed. By default, they are committed once at the end.
+    :param kwargs:
+        The other arguments of CostMatrix (registration_method, window_step, executor, n_workers)
+
+    :return: allocations: list of tuples (selected_tree, best_skeleton, rmse, init_rotation)
+        For each model element, what the find_best_tree_* functions return with return_rmse=True. Only None values if no tree was found.
+    """
+    reader, is_session = _open_database(database_path)
+    allocations = []
+    try:
+        costs = CostMatrix(model_elements, reference_diameters, reader, **kwargs)
+        for i in range(len(costs.model_elements)):
+            column = costs.select_tree(i, optimisation_basis)
+            if column is None:
+                print("No tree found in allocate_elements, returning None")
+                allocations.append((None, None, None, None))
+            else:
+                tree_id = int(costs.tree_ids[column])
+                best_skeleton = costs.skeleton_segments[i, column]
+                print(
+                    f"Best tree is {tree_id} with rmse {costs.rmse[i, column]} and height {costs.heights[column]}"
+                )
+                selected_tree, trimmed_tree, offcuts = _trim_allocated_tree(
+                    reader, tree_id, best_skeleton
+                )
+                allocations.append(
+                    (
+                        selected_tree,
+                        best_skeleton,
+                        float(costs.rmse[i, column]),
+                        costs.init_rotations[i, column],
+                    )
+                )
+                remaining = range(i + 1, len(costs.model_elements))
+                if trimmed_tree is None:
+                    costs.remove_tree(tree_id)
+                else:
+                    costs.update_tree(trimmed_tree.get_skeleton_view(), remaining)
+                for offcut in offcuts:
+                    costs.add_tree(offcut.get_skeleton_view(), remaining)
+
+            if commit_every is not None and (i + 1) % commit_every == 0:
+                transaction.commit()
+            else:
+                transaction.savepoint(optimistic=True)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        raise
+    finally:
+        _close_database(reader, is_session)
+    return allocations
+
+
+def allocate_elements_globally(
+    model_elements: List[utils.geometry.Pointcloud],
+    reference_diameters: List[float],
+    database_path: Union[str, db_reader.DatabaseReader],
+    stock_weight: float = 0.0,
+    leftover_weight: float = 0.0,
+    max_rounds: int = None,
+    **kwargs,
+) -> Tuple[
+    List[Tuple[utils.tree.Tree, utils.geometry.Pointcloud, float, np.ndarray]],
+    float,
+    float,
+]:
+    """
+    Allocate trees to a list of model elements with a global assignment instead of element after element.
+    In each round, the elements not allocated yet are assigned to trees with scipy.optimize.linear_sum_assignment
+    on the CostMatrix, so that the sum of the costs is minimal. Each tree is offered as many slots as the shortest
+    remaining element fits in its length, so that one tree can serve several elements.
+    The elements assigned to a tree are then cut from it in increasing rmse order. After each cut, the next element is
+    matched again to what is left of the tree, and goes back to the next round if it does not fit anymore.
+    The rounds go on until no remaining element can be hosted.
+
+    The cost of a pair is its rmse, plus @stock_weight times the skeleton length of the tree if it was not cut yet
+    (the stock consumed by using it), plus @leftover_weight times the length of skeleton left on the tree after the cut.
+    The changes are committed once at the end, or rolled back if something fails.
+
+    :param model_elements: list of Pointcloud
+        The model elements to allocate trees to
+    :param reference_diameters: list of float
+        The diameter of each model element
+    :param database_path: str or DatabaseReader
+        The path to the database, or an open DatabaseReader session, which is then left open.
+    :param stock_weight: float
+        The weight of the stock consumption (in meters) against the rmse (in meters). 0 (default) only minimizes the rmse.
+    :param leftover_weight: float
+        The weight of the leftover length (in meters) against the rmse (in meters). 0 by default.
+    :param max_rounds: int, optional
+        The maximum number of rounds. Unlimited by default.
+    :param kwargs:
+        The other arguments of CostMatrix (registration_method, window_step, executor, n_workers)
+
+    :return: allocations: list of tuples (selected_tree, best_skeleton, rmse, init_rotation)
+        For each model element, as returned by allocate_elements. Only None values if no tree was found.
+    :return: total_rmse: float
+        The sum of the rmse of the allocated elements
+    :return: stock_length: float
+        The stock consumption: the sum of the skeleton lengths of the trees used, before they were cut
+    """
+    import scipy.optimize
+
+    reader, is_session = _open_database(database_path)
+    allocations = [(None, None, None, None)] * len(model_elements)
+    try:
+        costs = CostMatrix(model_elements, reference_diameters, reader, **kwargs)
+        initial_skeleton_lengths = costs.skeleton_lengths.copy()
+        is_used = np.zeros(len(costs.tree_ids), dtype=bool)
+        remaining = np.arange(len(costs.model_elements))
+        n_rounds = 0
+        while len(remaining) > 0 and (max_rounds is None or n_rounds < max_rounds):
+            costs.refresh(remaining)
+            is_feasible = costs.is_feasible[remaining]
+            if not np.any(is_feasible):
+                break
+            n_rounds += 1
+            round_costs = (
+                costs.rmse[remaining]
+                + stock_weight * np.where(is_used, 0.0, costs.skeleton_lengths)
+                + leftover_weight * costs.leftover_lengths[remaining]
+            )
+
+            # the slots of the trees: the columns of the assignment
+            columns = np.flatnonzero(np.any(is_feasible, axis=0))
+            n_slots = np.clip(
+                np.floor(
+                    costs.skeleton_lengths[columns]
+                    / np.max([np.min(costs.element_lengths[remaining]), 1e-3])
+                ).astype(int),
+                1,
+                len(remaining),
+            )
+            slot_columns = np.repeat(columns, n_slots)
+            slot_costs = round_costs[:, slot_columns]
+            is_slot_feasible = is_feasible[:, slot_columns]
+            # infeasible pairs get a cost higher than any feasible assignment, and are discarded afterwards
+            infeasible_cost = 1.0 + len(remaining) * np.max(
+                np.abs(slot_costs[is_slot_feasible])
+            )
+            rows, slots = scipy.optimize.linear_sum_assignment(
+                np.where(is_slot_feasible, slot_costs, infeasible_cost)
+            )
+            is_assigned = is_slot_feasible[rows, slots]
+            assigned_elements = remaining[rows[is_assigned]]
+            assigned_columns = slot_columns[slots[is_assigned]]
+
+            n_allocated = 0
+            for column in np.unique(assigned_columns):
+                tree_elements = assigned_elements[assigned_columns == column]
+                tree_elements = tree_elements[
+                    np.argsort(costs.rmse[tree_elements, column], kind="stable")
+                ]
+                for i in tree_elements:
+                    # the elements after the first one are matched again to what is left of the tree
+                    costs.refresh([i])
+                    if not costs.is_feasible[i, column]:
+                        continue
+                    tree_id = int(costs.tree_ids[column])
+                    best_skeleton = costs.skeleton_segments[i, column]
+                    selected_tree, trimmed_tree, offcuts = _trim_allocated_tree(
+                        reader, tree_id, best_skeleton
+                    )
+                    allocations[i] = (
+                        selected_tree,
+                        best_skeleton,
+                        float(costs.rmse[i, column]),
+                        costs.init_rotations[i, column],
+                    )
+                    is_used[column] = True
+                    n_allocated += 1
+                    remaining = remaining[remaining != i]
+                    for offcut in offcuts:
+                        costs.add_tree(offcut.get_skeleton_view(), remaining)
+                        # the offcuts come from a tree already used, they don't consume more stock
+                        is_used = np.append(is_used, True)
+                        initial_skeleton_lengths = np.append(
+                            initial_skeleton_lengths, 0.0
+                        )
+                    if trimmed_tree is None:
+                        costs.remove_tree(tree_id)
+                        break
+                    costs.update_tree(trimmed_tree.get_skeleton_view(), remaining)
+            print(f"Round {n_rounds}: {n_allocated} elements allocated")
+            transaction.savepoint(optimistic=True)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        raise
+    finally:
+        _close_database(reader, is_session)
+
+    total_rmse = float(
+        sum(allocation[2] for allocation in allocations if allocation[2] is not None)
+    )
+    stock_length = float(np.sum(initial_skeleton_lengths[is_used]))
+    print(
+        f"Allocated {len(allocations) - len(remaining)} elements out of {len(allocations)} "
+        f"from {np.count_nonzero(is_used)} trees, with a total rmse of {total_rmse} and {stock_length} m of stock used"
+    )
+    return allocations, total_rmse, stock_length
+
+
+def _compute_packing_offsets(
+    free_intervals: List[Tuple[float, float]],
+    element_length: float,
+    window_step: float = None,
+) -> List[float]:
+    """
+    Get the start offsets of the windows of an element within the free intervals of a skeleton:
+    at both ends of each interval long enough for the element, and every window_step meters in between.
+    """
+    offsets = []
+    for start, end in free_intervals:
+        last_offset = end - element_length - utils.feature_index.ARC_LENGTH_TOLERANCE
+        if last_offset < start:
+            continue
+        offsets.extend([start, last_offset])
+        if window_step is not None:
+            offsets.extend(np.arange(start + window_step, last_offset, window_step))
+    return sorted(set(offsets))
+
+
+def _find_free_interval(
+    free_intervals: List[Tuple[float, float]], offset: float, element_length: float
+) -> int:
+    """
+    Get the index of the free interval containing the window of an element.
+    """
+    for k, (start, end) in enumerate(free_intervals):
+        if (
+            start <= offset + utils.feature_index.ARC_LENGTH_TOLERANCE
+            and offset + element_length
+            <= end + utils.feature_index.ARC_LENGTH_TOLERANCE
+        ):
+            return k
+    raise ValueError(f"No free interval contains the window at offset {offset}")
+
+
+def pack_elements_on_trees(
+    model_elements: List[utils.geometry.Pointcloud],
+    reference_diameters: List[float],
+    database_path: Union[str, db_reader.DatabaseReader],
+    strategy: PackingStrategy = PackingStrategy.BEST_FIT,
+    maximum_rmse: float = np.inf,
+    window_step: float = None,
+    executor: Executor = Executor.SERIAL,
+    n_workers: int = None,
+) -> List[Tuple[utils.tree.Tree, utils.geometry.Pointcloud, float, np.ndarray]]:
+    """
+    Allocate trees to a list of model elements by packing several elements along each tree, as in a cutting-stock problem.
+    Each skeleton is a bar of stock, described by the free intervals of arc length left on it.
+    The elements are placed from the longest to the shortest (first-fit decreasing), each in a window at one end of
+    a free interval (or every window_step meters within it), and each placement is checked with its own matching
+    (diameter band and rmse). Trees already cut are tried first; a new tree is only cut when none of them can host the element.
+    The trees are read once, and each tree used is trimmed and written once, after all the elements are placed,
+    along with the offcuts it is split into.
+
+    ```
+    tree skeleton, as a bar:  |-- element 1 --|-- element 3 --|-------- free --------|-- element 2 --|
+    ```
+
+    :param model_elements: list of Pointcloud
+        The model elements to allocate trees to
+    :param reference_diameters: list of float
+        The diameter of each model element
+    :param database_path: str or DatabaseReader
+        The path to the database, or an open DatabaseReader session, which is then left open.
+    :param strategy: PackingStrategy
+        FIRST_FIT places an element on the first tree already cut that can host it, and otherwise cuts the best fitting new tree.
+        BEST_FIT (default) places it in the free interval, or on the new tree, that leaves the least free length around it.
+    :param maximum_rmse: float
+        The rmse above which a placement is rejected. No limit by default.
+    :param window_step: float, optional
+        If given, the windows also start every window_step meters within the free intervals, not only at their ends.
+    :param executor: Executor
+        How the candidate trees are scored, see compute_best_trees_element_matching_in_parallel
+    :param n_workers: int, optional
+        The number of workers of the executor. Defaults to the number of cpus.
+
+    :return: allocations: list of tuples (selected_tree, best_skeleton, rmse, init_rotation)
+        For each model element, as returned by allocate_elements. Only None values if no tree was found.
+    """
+    reader, is_session = _open_database(database_path)
+    allocations = [(None, None, None, None)] * len(model_elements)
+    element_lengths = np.array(
+        [
+            packing_manipulations.compute_arc_lengths(element.points)[-1]
+            for element in model_elements
+        ]
+    )
+    features = reader.get_feature_index()
+    skeleton_lengths = dict(zip(features["id"].tolist(), features["skeleton_length"]))
+    tree_skeletons = {}
+    # the free intervals of the trees already cut, in the order they were cut
+    free_intervals = {}
+    # the elements placed on each tree, with their skeleton segments
+    placements = {}
+
+    def place(i, tree_ids, intervals):
+        """
+        Find the best placement of element i among the given trees, or None.
+        """
+        offsets = [
+            _compute_packing_offsets(intervals[k], element_lengths[i], window_step)
+            for k in range(len(tree_ids))
+        ]
+        is_placeable = [len(tree_offsets) > 0 for tree_offsets in offsets]
+        tree_ids = [tree_id for tree_id, ok in zip(tree_ids, is_placeable) if ok]
+        intervals = [interval for interval, ok in zip(intervals, is_placeable) if ok]
+        offsets = [tree_offsets for tree_offsets in offsets if len(tree_offsets) > 0]
+        if len(tree_ids) == 0:
+            return None
+        padded_offsets = np.full((len(offsets), max(map(len, offsets))), np.nan)
+        for k, tree_offsets in enumerate(offsets):
+            padded_offsets[k, : len(tree_offsets)] = tree_offsets
+        for tree_id in tree_ids:
+            if tree_id not in tree_skeletons:
+                tree_skeletons[tree_id] = reader.get_tree_skeleton(tree_id)
+        matchings = compute_best_trees_element_matching_in_parallel(
+            model_elements[i],
+            reference_diameters[i],
+            [tree_skeletons[tree_id] for tree_id in tree_ids],
+            maximum_rmse,
+            executor=executor,
+            n_workers=n_workers,
+            return_offsets=True,
+            offsets=padded_offsets,
+        )
+        best_placement = None
+        best_key = None
+        for tree_id, tree_intervals, matching in zip(tree_ids, intervals, matchings):
+            if matching[0] is None:
+                continue
+            offset = matching[3]
+            interval_index = _find_free_interval(
+                tree_intervals, offset, element_lengths[i]
+            )
+            start, end = tree_intervals[interval_index]
+            if strategy == PackingStrategy.FIRST_FIT and tree_id in free_intervals:
+                # the trees already cut are given in the order they were cut
+                return tree_id, interval_index, matching
+            key = (
+                (end - start - element_lengths[i], matching[1])
+                if strategy == PackingStrategy.BEST_FIT
+                else (matching[1],)
+            )
+            if best_key is None or key < best_key:
+                best_key = key
+                best_placement = tree_id, interval_index, matching
+        return best_placement
+
+    try:
+        for i in np.argsort(-element_lengths, kind="stable"):
+            candidate_ids = set(
+                utils.feature_index.select_candidates(
+                    features,
+                    reference_diameters[i],
+                    element_lengths[i],
+                    check_windows=False,
+                ).tolist()
+            )
+            # the trees already cut are tried first
+            cut_ids = [
+                tree_id for tree_id in free_intervals if tree_id in candidate_ids
+            ]
+            placement = place(i, cut_ids, [free_intervals[k] for k in cut_ids])
+            if placement is None:
+                new_ids = sorted(candidate_ids.difference(free_intervals))
+                placement = place(
+                    i, new_ids, [[(0.0, skeleton_lengths[k])] for k in new_ids]
+                )
+            if placement is None:
+                print(f"No tree found for element {i}")
+                continue
+
+            tree_id, interval_index, (best_skeleton, rmse, init_rotation, offset) = (
+                placement
+            )
+            print(f"Element {i} placed on tree {tree_id} at {offset} with rmse {rmse}")
+            tree_intervals = free_intervals.get(
+                tree_id, [(0.0, skeleton_lengths[tree_id])]
+            )
+            start, end = tree_intervals[interval_index]
+            tree_intervals[interval_index : interval_index + 1] = [
+                (interval_start, interval_end)
+                for interval_start, interval_end in (
+                    (start, offset),
+                    (offset + element_lengths[i], end),
+                )
+                if interval_end - interval_start
+                > utils.feature_index.ARC_LENGTH_TOLERANCE
+            ]
+            free_intervals[tree_id] = tree_intervals
+            placements.setdefault(tree_id, []).append(i)
+            allocations[i] = (None, best_skeleton, rmse, init_rotation)
+
+        # each tree used is trimmed and written once. A cut can split it, so each cut is applied to all its parts.
+        for tree_id, placed_elements in placements.items():
+            tree = reader.get_tree(tree_id)
+            parts = [copy.deepcopy(tree)]
+            for i in placed_elements:
+                selected_tree = copy.deepcopy(tree)
+                selected_tree.skeleton = allocations[i][1]
+                allocations[i] = (selected_tree,) + allocations[i][1:]
+                trimmed_parts = []
+                for part in parts:
+                    trimmed_parts.append(part)
+                    trimmed_parts.extend(part.trim(allocations[i][1]))
+                parts = trimmed_parts
+            _store_trimmed_tree(
+                reader,
+                tree_id,
+                parts[0],
+                [part for part in parts[1:] if len(part.skeleton.points) >= 2],
+            )
+            transaction.savepoint(optimistic=True)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        raise
+    finally:
+        _close_database(reader, is_session)
+    print(
+        f"Packed {sum(allocation[0] is not None for allocation in allocations)} elements "
+        f"out of {len(model_elements)} on {len(placements)} trees"
+    )
+    return allocations
+
+
 def element_based_iterative_matching(
     model_elements: List[utils.geometry.Pointcloud], database_path: str
 ):
@@ -4,6 +4,8 @@ This module contains the tree manipulation code for tree combinatorics.
 
 import os
 import copy
+import typing
+import enum
 
 import utils.database_reader as db_reader
 import utils.geometry
@@ -14,6 +16,17 @@ import open3d as o3d
 import numpy as np
 
 
+class RegistrationMethod(enum.Enum):
+    """
+    Enum for the method used to register the adapted skeletons to the model elements.
+    ICP uses open3d's icp registration, one pair of skeletons at a time.
+    KABSCH uses the point-to-point correspondences given by match_skeletons and solves all pairs at once.
+    """
+
+    ICP = 1
+    KABSCH = 2
+
+
 def match_skeletons(
     model_element: utils.geometry.Pointcloud,
     original_skeleton: utils.geometry.Pointcloud,
@@ -22,6 +35,7 @@ def match_skeletons(
     match the two skeletons by adapting the target skeleton to the reference skeleton,
     so the distances between the corresponding points are identical.
     The number of points in the target_skeleton is thus matched to the number of points in the reference_skeleton.
+    This is done by resampling the target skeleton at the cumulative arc lengths of the model element, see batch_resample_skeletons.
 
     :param model_element: Pointcloud
         The model element that gives the relative distances between the points
@@ -46,57 +60,197 @@ def match_skeletons(
     p             p               p
     ```
     """
-    list_of_reference_distances = []
-    for i in range(len(model_element.points) - 1):
-        dist = np.linalg.norm(
-            np.array(model_element.points[i]) - np.array(model_element.points[i + 1])
-        )
-        list_of_reference_distances.append(dist)
-    list_of_target_distances = []
-    for i in range(len(original_skeleton.points) - 1):
-        dist = np.linalg.norm(
-            np.array(original_skeleton.points[i])
-            - np.array(original_skeleton.points[i + 1])
-        )
-        list_of_target_distances.append(dist)
-    new_skeleton_as_list = [
-        [
-            original_skeleton.points[0][0],
-            original_skeleton.points[0][1],
-            original_skeleton.points[0][2],
-        ]
-    ]
-
-    if np.sum(list_of_target_distances) < np.sum(list_of_reference_distances):
+    reference_arc_lengths = compute_arc_lengths(model_element.points)
+    (
+        adapted_points,
+        segment_indices,
+        is_valid,
+    ) = batch_resample_skeletons(
+        np.asarray(original_skeleton.points, dtype=np.float64)[np.newaxis],
+        np.array([len(original_skeleton.points)]),
+        reference_arc_lengths,
+    )
+    if not is_valid[0]:
         return None, None
 
-    else:
-        for i in range(len(list_of_reference_distances)):
-            reference_cummulative_distance = np.sum(
-                list_of_reference_distances[: i + 1]
-            )
-            for j in range(len(list_of_target_distances)):
-                target_cummulative_distance = np.sum(list_of_target_distances[: j + 1])
-                if reference_cummulative_distance < target_cummulative_distance:
-                    break
-            ratio = (
-                np.sum(list_of_reference_distances[: i + 1])
-                - np.sum(list_of_target_distances[:j])
-            ) / list_of_target_distances[j]
-            new_point = [
-                original_skeleton.points[j][0]
-                + ratio
-                * (original_skeleton.points[j + 1][0] - original_skeleton.points[j][0]),
-                original_skeleton.points[j][1]
-                + ratio
-                * (original_skeleton.points[j + 1][1] - original_skeleton.points[j][1]),
-                original_skeleton.points[j][2]
-                + ratio
-                * (original_skeleton.points[j + 1][2] - original_skeleton.points[j][2]),
-            ]
-            new_skeleton_as_list.append(new_point)
-        adapted_skeleton = utils.geometry.Pointcloud(new_skeleton_as_list)
-        return adapted_skeleton, j
+    adapted_skeleton = utils.geometry.Pointcloud(adapted_points[0].tolist())
+    return adapted_skeleton, int(segment_indices[0, -1])
+
+
+def compute_arc_lengths(points: typing.List[typing.List[float]]) -> np.ndarray:
+    """
+    Compute the cumulative arc lengths of a polyline at each of its points.
+
+    :param points: list of list of float, or np.array (n, 3)
+        The points of the polyline
+
+    :return: arc_lengths: np.array (n,)
+        The arc length from the first point to each point. The first value is 0.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    segment_lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    return np.concatenate([[0.0], np.cumsum(segment_lengths)])
+
+
+def stack_skeletons(
+    skeletons: typing.List[utils.geometry.Pointcloud],
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Stack skeletons of different lengths into a single array, padded with NaN.
+
+    :param skeletons: list of Pointcloud
+        The skeletons to stack
+
+    :return: stacked_skeletons: np.array (n_skeletons, max_n_points, 3)
+        The points of the skeletons, padded with NaN
+    :return: n_points: np.array (n_skeletons,)
+        The number of points of each skeleton
+    """
+    n_points = np.array([len(skeleton.points) for skeleton in skeletons], dtype=int)
+    max_n_points = n_points.max() if len(skeletons) > 0 else 0
+    stacked_skeletons = np.full((len(skeletons), max_n_points, 3), np.nan)
+    for i, skeleton in enumerate(skeletons):
+        if n_points[i] > 0:
+            stacked_skeletons[i, : n_points[i]] = skeleton.points
+    return stacked_skeletons, n_points
+
+
+def batch_resample_skeletons(
+    skeletons: np.ndarray, n_points: np.ndarray, arc_lengths: np.ndarray
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Resample many skeletons at given arc lengths in a single call.
+    For each skeleton, the segment containing each arc length is found with np.searchsorted on the cumulative
+    segment lengths, and the point is interpolated along that segment.
+
+    :param skeletons: np.array (n_skeletons, max_n_points, 3)
+        The skeletons to resample, padded with NaN (see stack_skeletons)
+    :param n_points: np.array (n_skeletons,)
+        The number of points of each skeleton
+    :param arc_lengths: np.array (n_samples,) or (n_skeletons, n_samples)
+        The arc lengths at which to resample the skeletons, in increasing order. A single row is used for all skeletons.
+
+    :return: resampled_points: np.array (n_skeletons, n_samples, 3)
+        The resampled points
+    :return: segment_indices: np.array (n_skeletons, n_samples)
+        The index of the skeleton segment each resampled point lies on
+    :return: is_valid: np.array (n_skeletons,)
+        False for the skeletons that are shorter than the last arc length
+    """
+    skeletons = np.asarray(skeletons, dtype=np.float64)
+    n_points = np.asarray(n_points, dtype=int)
+    n_skeletons, max_n_points = skeletons.shape[:2]
+    arc_lengths = np.broadcast_to(
+        np.asarray(arc_lengths, dtype=np.float64),
+        (n_skeletons, np.shape(arc_lengths)[-1]),
+    )
+    n_samples = arc_lengths.shape[1]
+    if max_n_points < 2:
+        return (
+            np.full((n_skeletons, n_samples, 3), np.nan),
+            np.zeros((n_skeletons, n_samples), dtype=int),
+            np.zeros(n_skeletons, dtype=bool),
+        )
+    n_segments = max_n_points - 1
+
+    segment_lengths = np.linalg.norm(np.diff(skeletons, axis=1), axis=2)
+    is_real_segment = np.arange(n_segments)[np.newaxis] < (n_points - 1)[:, np.newaxis]
+    segment_lengths = np.where(is_real_segment, segment_lengths, 0.0)
+    cumulative_lengths = np.cumsum(segment_lengths, axis=1)
+    total_lengths = cumulative_lengths[:, -1]
+
+    # a single searchsorted call for all skeletons: each row is shifted so the rows don't overlap
+    row_span = max(np.max(cumulative_lengths), np.max(arc_lengths)) + 1.0
+    row_offsets = row_span * np.arange(n_skeletons)[:, np.newaxis]
+    segment_indices = (
+        np.searchsorted(
+            (cumulative_lengths + row_offsets).ravel(),
+            (arc_lengths + row_offsets).ravel(),
+            side="right",
+        ).reshape(n_skeletons, n_samples)
+        - n_segments * np.arange(n_skeletons)[:, np.newaxis]
+    )
+    segment_indices = np.clip(
+        segment_indices, 0, np.maximum(n_points - 2, 0)[:, np.newaxis]
+    )
+
+    rows = np.arange(n_skeletons)[:, np.newaxis]
+    segment_starts = np.concatenate(
+        [np.zeros((n_skeletons, 1)), cumulative_lengths], axis=1
+    )[rows, segment_indices]
+    lengths_of_segments = segment_lengths[rows, segment_indices]
+    ratios = np.divide(
+        arc_lengths - segment_starts,
+        lengths_of_segments,
+        out=np.zeros_like(arc_lengths),
+        where=lengths_of_segments > 0,
+    )
+    first_points = skeletons[rows, segment_indices]
+    second_points = skeletons[rows, segment_indices + 1]
+    resampled_points = first_points + ratios[..., np.newaxis] * (
+        second_points - first_points
+    )
+    is_valid = (n_points >= 2) & (total_lengths >= arc_lengths[:, -1])
+    return resampled_points, segment_indices, is_valid
+
+
+def match_skeleton_windows(
+    model_element_points: np.ndarray,
+    skeletons: np.ndarray,
+    n_points: np.ndarray,
+    offsets: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match a model element to windows of many skeletons, each window starting at a given arc length along its skeleton.
+    This is match_skeletons with the model element anchored at an offset instead of at the first point of the skeleton,
+    evaluated for all skeletons and all offsets with a single call to batch_resample_skeletons.
+
+    :param model_element_points: np.array (n_element_points, 3)
+        The points of the model element
+    :param skeletons: np.array (n_skeletons, max_n_points, 3)
+        The skeletons to match, padded with NaN (see stack_skeletons)
+    :param n_points: np.array (n_skeletons,)
+        The number of points of each skeleton
+    :param offsets: np.array (n_windows,) or (n_skeletons, n_windows)
+        The arc lengths at which the windows start. NaN offsets are marked as not valid.
+
+    :return: adapted_skeletons: np.array (n_skeletons, n_windows, n_element_points, 3)
+        The adapted skeletons of each window
+    :return: first_segments: np.array (n_skeletons, n_windows)
+        The index of the skeleton segment on which each window starts
+    :return: last_segments: np.array (n_skeletons, n_windows)
+        The index of the skeleton segment on which each window ends
+    :return: is_valid: np.array (n_skeletons, n_windows)
+        False for the windows that go beyond the end of their skeleton
+    """
+    n_skeletons = len(skeletons)
+    offsets = np.broadcast_to(
+        np.asarray(offsets, dtype=np.float64), (n_skeletons, np.shape(offsets)[-1])
+    )
+    n_windows = offsets.shape[1]
+    element_arc_lengths = compute_arc_lengths(model_element_points)
+    is_offset_valid = np.isfinite(offsets)
+    arc_lengths = (
+        np.where(is_offset_valid, offsets, 0.0)[..., np.newaxis]
+        + element_arc_lengths[np.newaxis, np.newaxis]
+    )
+
+    resampled_points, segment_indices, is_valid = batch_resample_skeletons(
+        np.repeat(skeletons, n_windows, axis=0),
+        np.repeat(n_points, n_windows),
+        arc_lengths.reshape(n_skeletons * n_windows, -1),
+    )
+    resampled_points = resampled_points.reshape(
+        n_skeletons, n_windows, len(element_arc_lengths), 3
+    )
+    segment_indices = segment_indices.reshape(n_skeletons, n_windows, -1)
+    is_valid = is_valid.reshape(n_skeletons, n_windows) & is_offset_valid
+    return (
+        resampled_points,
+        segment_indices[..., 0],
+        segment_indices[..., -1],
+        is_valid,
+    )
 
 
 def perform_icp_registration(
@@ -150,3 +304,68 @@ def perform_icp_registration(
         criteria=convergence_criteria,
     )
     return result, result.transformation
+
+
+def perform_kabsch_registration(
+    target_skeleton: utils.geometry.Pointcloud,
+    source_skeletons: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Perform a closed-form rigid registration between many source skeletons and one target skeleton,
+    using the point-to-point correspondences given by match_skeletons.
+    As in perform_icp_registration, both skeletons are first translated so their first point is at the origin.
+
+    :param target_skeleton: Pointcloud
+        The target skeleton to align to
+    :param source_skeletons: np.array (n_skeletons, n_points, 3)
+        The source skeletons to align, each with as many points as the target skeleton
+
+    :return: rmse: np.array (n_skeletons,)
+        The rmse of each registration
+    :return: transformations: np.array (n_skeletons, 4, 4)
+        The transformations aligning each source skeleton to the target once both have been re-located to the origin.
+    """
+    target_points = np.asarray(target_skeleton.points, dtype=np.float64)
+    source_skeletons = np.asarray(source_skeletons, dtype=np.float64)
+    (
+        transformations,
+        rmse,
+    ) = utils.geometrical_operations.kabsch_registration(
+        source_skeletons - source_skeletons[:, :1],
+        target_points - target_points[0],
+    )
+    return rmse, transformations
+
+
+def perform_kabsch_registration_pairs(
+    target_skeletons: np.ndarray,
+    source_skeletons: np.ndarray,
+    n_points: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Perform the registration of perform_kabsch_registration for pairs of skeletons, each with its own target, in a single batch.
+    Pairs with fewer points are padded to the same number of points.
+
+    :param target_skeletons: np.array (n_pairs, n_points, 3)
+        The target skeleton of each pair, padded
+    :param source_skeletons: np.array (n_pairs, n_points, 3)
+        The source skeleton of each pair, padded, each with as many points as its target
+    :param n_points: np.array (n_pairs,)
+        The number of points of each pair
+
+    :return: rmse: np.array (n_pairs,)
+        The rmse of each registration
+    :return: transformations: np.array (n_pairs, 4, 4)
+        The transformations aligning each source skeleton to its target once both have been re-located to the origin.
+    """
+    target_skeletons = np.asarray(target_skeletons, dtype=np.float64)
+    source_skeletons = np.asarray(source_skeletons, dtype=np.float64)
+    (
+        transformations,
+        rmse,
+    ) = utils.geometrical_operations.kabsch_registration(
+        source_skeletons - source_skeletons[:, :1],
+        target_skeletons - target_skeletons[:, :1],
+        n_points,
+    )
+    return rmse, transformations
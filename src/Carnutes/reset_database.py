@@ -7,23 +7,33 @@ This function resets the database by overwriting the existing database with a ne
 # r: open3d==0.18.0
 # r: ZODB==6.0
 # r: igraph==0.11.6
-
-import ZODB
-import ZODB.FileStorage
-import open3d as o3d
+# r: scipy==1.13.1
 
 # import Rhino
 
 import os
-import transaction
-import BTrees.OOBTree
 import time
 
-import utils.tree as tree
 import utils.database_reader as database_reader
-
-
-def main(voxel_size=0.03, working_dir=os.path.dirname(os.path.realpath(__file__))):
+import utils.database_ingestion as database_ingestion
+import utils.geometrical_operations as geometrical_operations
+
+
+def main(
+    voxel_size=0.03,
+    working_dir=os.path.dirname(os.path.realpath(__file__)),
+    circle_fitting_method=geometrical_operations.CircleFittingMethod.RANSAC,
+    n_workers=1,
+    use_cache=True,
+):
+    """
+    Reset the database with the scans of the dataset folder.
+    All the trees are removed first, including the offcuts added by the allocations, and the ids start again from 0.
+    Processed scans are cached in database/cache, keyed by their content and the processing parameters,
+    so that only the scans that changed are processed again. Set @use_cache to False to process all of them.
+    The scans are processed in the current process by default, as this script runs inside Rhino.
+    @n_workers processes (None for the number of cpus) can only be used from a command line, see utils.database_ingestion.ingest_scans.
+    """
     database_folder = os.path.join(working_dir, "database")
     if not os.path.exists(database_folder):
         os.makedirs(database_folder)
@@ -31,48 +41,25 @@ def main(voxel_size=0.03, working_dir=os.path.dirname(os.path.realpath(__file__)
     db_reader = database_reader.DatabaseReader(
         os.path.join(working_dir, "database/tree_database.fs")
     )
+    # the offcuts added since the last reset have ids following the scans, they are removed too
+    db_reader.clear()
+
+    # the scans are processed in parallel and committed as they come, see utils.database_ingestion
+    scans = (
+        (i, pc_file[:-4], os.path.join(working_dir, f"dataset/{pc_file}"))
+        for i, pc_file in enumerate(os.listdir(os.path.join(working_dir, "dataset")))
+        if pc_file.endswith(".ply")
+    )
+    database_ingestion.ingest_scans(
+        db_reader,
+        scans,
+        voxel_size,
+        remove_outliers=True,
+        circle_fitting_method=circle_fitting_method,
+        n_workers=n_workers,
+        cache_dir=os.path.join(database_folder, "cache") if use_cache else None,
+    )
 
-    for i, pc_file in enumerate(os.listdir(os.path.join(working_dir, "dataset"))):
-
-        if pc_file.endswith(".ply"):
-            print(f"Processing {pc_file}")
-            pc = o3d.io.read_point_cloud(
-                os.path.join(working_dir, f"dataset/{pc_file}")
-            )
-            pc = pc.voxel_down_sample(voxel_size)
-            pc, indexes = pc.remove_statistical_outlier(nb_neighbors=20, std_ratio=2.0)
-
-            tree_pc_as_pt_list = []
-            tree_colors_as_list = []
-
-            for j in range(len(pc.points)):
-                tree_pc_as_pt_list.append(
-                    [
-                        float(pc.points[j][0]),
-                        float(pc.points[j][1]),
-                        float(pc.points[j][2]),
-                    ]
-                )
-                tree_colors_as_list.append(
-                    [
-                        float(pc.colors[j][0]),
-                        float(pc.colors[j][1]),
-                        float(pc.colors[j][2]),
-                    ]
-                )
-
-            tree_for_db = tree.Tree(
-                i,
-                pc_file[:-4],
-                tree.Pointcloud(tree_pc_as_pt_list, tree_colors_as_list),
-            )
-            tree_for_db.compute_skeleton()
-
-            db_reader.root.trees[tree_for_db.id] = tree_for_db
-
-    db_reader.root.n_trees = len(db_reader.root.trees)
-
-    transaction.commit()
     db_reader.pack()  # We dont' want to keep previous revisions. We only want the latest one.
     db_reader.close()
     db_reader.delete_old()  # We don't want to keep the fs.old file either.
@@ -0,0 +1,313 @@
+"""
+Module for the ingestion of point cloud scans into the tree database.
+The scans are processed (read, downsampled, skeletonized) in a pool of processes, and written to the database by a single writer,
+the process that owns the DatabaseReader, with a commit every few trees.
+Processed scans can be cached on disk, keyed by the content of the scan and the processing parameters,
+so that resetting a database only processes the scans that changed.
+"""
+
+#! python3
+
+import concurrent.futures
+import hashlib
+import os
+import typing
+
+import BTrees.OOBTree
+import numpy as np
+import open3d as o3d
+import transaction
+
+import utils.database_reader as database_reader
+import utils.geometrical_operations as geometrical_operations
+import utils.tree as tree
+
+# Bump this when the processing of the scans changes, to invalidate the cached scans
+CACHE_VERSION = 3
+
+# The parameters of the removal of the statistical outliers of the scans
+OUTLIER_NEIGHBORS = 20
+OUTLIER_STD_RATIO = 2.0
+
+
+def compute_scan_hash(scan_path: str) -> str:
+    """
+    Compute the sha256 hash of the content of a scan.
+
+    :param scan_path: str
+        The path to the scan
+    :return: str
+        The hexadecimal hash
+    """
+    file_hash = hashlib.sha256()
+    with open(scan_path, "rb") as scan_file:
+        for chunk in iter(lambda: scan_file.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def compute_cache_key(
+    scan_hash: str,
+    voxel_size: float,
+    remove_outliers: bool,
+    circle_fitting_method: geometrical_operations.CircleFittingMethod,
+    robust_iterations: int = 0,
+) -> str:
+    """
+    Compute the key of a processed scan in the cache, from the hash of the scan and all the processing parameters,
+    including the constants read by the outlier removal and Tree.compute_skeleton.
+
+    :return: str
+        The hexadecimal key
+    """
+    processing = [voxel_size, remove_outliers, circle_fitting_method.name]
+    if remove_outliers:
+        processing += [OUTLIER_NEIGHBORS, OUTLIER_STD_RATIO]
+    processing.append(tree.SKELETON_LENGTH)
+    if circle_fitting_method == geometrical_operations.CircleFittingMethod.ALGEBRAIC:
+        processing.append(robust_iterations)
+    else:
+        processing += [
+            tree.RANSAC_DISTANCE_THRESHOLD,
+            tree.RANSAC_N,
+            tree.RANSAC_ITERATIONS,
+        ]
+    parameters = "-".join([scan_hash, *map(repr, processing), str(CACHE_VERSION)])
+    return hashlib.sha256(parameters.encode()).hexdigest()
+
+
+def _save_cached_tree(cache_path: str, tree_for_db: tree.Tree):
+    """
+    Save the processed point cloud and skeleton of a tree to the cache.
+    The file is written under a temporary name and then renamed, so that concurrent processes never read a partial file.
+    Missing colors are saved as an empty array: np.savez would save None as an object array, which np.load refuses to read.
+    """
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+    colors = tree_for_db.point_cloud.colors_array
+    if colors is None:
+        colors = np.zeros((0, 3), dtype=np.uint8)
+    np.savez(
+        temporary_path,
+        points=tree_for_db.point_cloud.points_array,
+        colors=colors,
+        segment_offsets=tree_for_db.point_cloud.segment_offsets,
+        skeleton=np.asarray(tree_for_db.skeleton.points, dtype=np.float64),
+        circle_centers=np.array([circle[0] for circle in tree_for_db.skeleton_circles]),
+        circle_radii=np.array([circle[1] for circle in tree_for_db.skeleton_circles]),
+        height=tree_for_db.height,
+        mean_diameter=tree_for_db.mean_diameter,
+    )
+    os.replace(temporary_path, cache_path)
+
+
+def _load_cached_tree(cache_path: str, tree_id: int, name: str) -> tree.Tree:
+    """
+    Create a tree from a processed scan of the cache.
+    """
+    with np.load(cache_path) as cached:
+        colors = cached["colors"]
+        tree_for_db = tree.Tree(
+            tree_id,
+            name,
+            tree.ArrayPointcloud(
+                cached["points"],
+                colors if len(colors) > 0 else None,
+                cached["segment_offsets"],
+            ),
+        )
+        tree_for_db.skeleton = tree.Pointcloud(list(cached["skeleton"]))
+        tree_for_db.skeleton_circles = [
+            (center, radius)
+            for center, radius in zip(cached["circle_centers"], cached["circle_radii"])
+        ]
+        tree_for_db.height = cached["height"][()]
+        tree_for_db.mean_diameter = cached["mean_diameter"][()]
+    return tree_for_db
+
+
+def process_scan(
+    tree_id: int,
+    name: str,
+    scan_path: str,
+    voxel_size: float,
+    remove_outliers: bool = False,
+    circle_fitting_method: geometrical_operations.CircleFittingMethod = geometrical_operations.CircleFittingMethod.RANSAC,
+    cache_dir: str = None,
+    robust_iterations: int = 0,
+) -> tree.Tree:
+    """
+    Turn a point cloud scan into a Tree with its skeleton. This is the work done by the processes of the pool.
+    The hash of the scan is stored in the scan_hash attribute of the tree.
+
+    :param tree_id: int
+        The id of the tree
+    :param name: str
+        The name of the tree
+    :param scan_path: str
+        The path to the scan (.ply file)
+    :param voxel_size: float
+        The size of the voxel grid used for downsampling the point cloud
+    :param remove_outliers: bool, optional
+        Whether to remove the statistical outliers of the downsampled point cloud. The default is False.
+    :param circle_fitting_method: CircleFittingMethod, optional
+        The method used to fit the circles of the skeleton. The default is RANSAC.
+    :param cache_dir: str, optional
+        The folder of the cache of processed scans. The scan is only processed if it is not in the cache yet. No cache by default.
+    :param robust_iterations: int, optional
+        The number of reweighted fits of the ALGEBRAIC circle fitting method. The default is 0.
+
+    :return: Tree
+        The tree, not yet stored in the database
+    """
+    scan_hash = compute_scan_hash(scan_path)
+    cache_path = None
+    if cache_dir is not None:
+        cache_key = compute_cache_key(
+            scan_hash,
+            voxel_size,
+            remove_outliers,
+            circle_fitting_method,
+            robust_iterations,
+        )
+        cache_path = os.path.join(cache_dir, f"{cache_key}.npz")
+        if os.path.exists(cache_path):
+            tree_for_db = _load_cached_tree(cache_path, tree_id, name)
+            tree_for_db.scan_hash = scan_hash
+            return tree_for_db
+
+    pc = o3d.io.read_point_cloud(scan_path)
+    pc = pc.voxel_down_sample(voxel_size)
+    if remove_outliers:
+        pc, indexes = pc.remove_statistical_outlier(
+            nb_neighbors=OUTLIER_NEIGHBORS, std_ratio=OUTLIER_STD_RATIO
+        )
+
+    tree_for_db = tree.Tree(
+        tree_id,
+        name,
+        tree.ArrayPointcloud(np.asarray(pc.points), np.asarray(pc.colors)),
+    )
+    tree_for_db.compute_skeleton(circle_fitting_method, robust_iterations)
+    tree_for_db.scan_hash = scan_hash
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_cached_tree(cache_path, tree_for_db)
+    return tree_for_db
+
+
+def ingest_scans(
+    reader: database_reader.DatabaseReader,
+    scans: typing.Iterable[typing.Tuple[int, str, str]],
+    voxel_size: float,
+    remove_outliers: bool = False,
+    circle_fitting_method: geometrical_operations.CircleFittingMethod = geometrical_operations.CircleFittingMethod.RANSAC,
+    n_workers: int = 1,
+    max_in_flight: int = None,
+    commit_every: int = 10,
+    cache_dir: str = None,
+    robust_iterations: int = 0,
+) -> int:
+    """
+    Process scans in parallel and store the resulting trees in the database.
+    The hash of each scan is recorded in root.scans (hash -> tree id), so that augment_database can skip the scans already ingested.
+    At most @max_in_flight scans are processed or waiting to be written at any time, and the trees written are committed
+    (then evicted from the object cache) every @commit_every trees, so the memory used does not depend on the number of scans.
+    The trees are stored without updating the feature and window indexes. They are removed beforehand, the feature index
+    is built once after the last tree (see DatabaseReader.build_indexes), and the window index on its next use.
+    If the ingestion fails, both are built again from the trees committed on their next use.
+
+    :param reader: DatabaseReader
+        The open database to write the trees to. Trees with the same id are replaced.
+    :param scans: iterable of tuples (tree_id, name, scan_path)
+        The scans to ingest. It is consumed lazily.
+    :param voxel_size: float
+        The size of the voxel grid used for downsampling the point clouds
+    :param remove_outliers: bool, optional
+        Whether to remove the statistical outliers of the point clouds. The default is False.
+    :param circle_fitting_method: CircleFittingMethod, optional
+        The method used to fit the circles of the skeletons. The default is RANSAC.
+    :param n_workers: int, optional
+        The number of processes, None for the number of cpus. The default is 1: the scans are processed in the current process.
+        Only use more from a command line: inside Rhino, sys.executable is Rhino itself, so worker processes can't be started.
+    :param max_in_flight: int, optional
+        The maximum number of scans submitted and not yet written. Defaults to twice the number of processes.
+    :param commit_every: int, optional
+        The number of trees written between two commits. The default is 10.
+    :param cache_dir: str, optional
+        The folder of the cache of processed scans, see process_scan. No cache by default.
+    :param robust_iterations: int, optional
+        The number of reweighted fits of the ALGEBRAIC circle fitting method. The default is 0.
+
+    :return: n_ingested: int
+        The number of trees written to the database
+    """
+    if not hasattr(reader.root, "trees"):
+        reader.root.trees = BTrees.OOBTree.BTree()
+    if not hasattr(reader.root, "scans"):
+        reader.root.scans = BTrees.OOBTree.BTree()
+    for index_name in ("features", "feature_index", "window_index"):
+        if hasattr(reader.root, index_name):
+            delattr(reader.root, index_name)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    scan_arguments = (
+        (
+            tree_id,
+            name,
+            scan_path,
+            voxel_size,
+            remove_outliers,
+            circle_fitting_method,
+            cache_dir,
+            robust_iterations,
+        )
+        for tree_id, name, scan_path in scans
+    )
+
+    n_ingested = 0
+
+    def write(tree_for_db):
+        nonlocal n_ingested
+        print(f"Writing tree {tree_for_db.id} ({tree_for_db.name})")
+        reader.set_tree(tree_for_db.id, tree_for_db, update_indexes=False)
+        reader.root.scans[tree_for_db.scan_hash] = tree_for_db.id
+        n_ingested += 1
+        if n_ingested % commit_every == 0:
+            _commit(reader)
+
+    try:
+        if n_workers == 1:
+            for arguments in scan_arguments:
+                write(process_scan(*arguments))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+                in_flight = set()
+                for arguments in scan_arguments:
+                    if len(in_flight) >= max_in_flight:
+                        done, in_flight = concurrent.futures.wait(
+                            in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            write(future.result())
+                    in_flight.add(pool.submit(process_scan, *arguments))
+                for future in concurrent.futures.as_completed(in_flight):
+                    write(future.result())
+        reader.build_indexes()
+        _commit(reader)
+    except Exception:
+        # the trees committed so far are kept
+        transaction.abort()
+        raise
+    return n_ingested
+
+
+def _commit(reader: database_reader.DatabaseReader):
+    """
+    Commit the trees written so far, and evict them from the object cache of the connection.
+    """
+    reader.root.n_trees = len(reader.root.trees)
+    transaction.commit()
+    reader.connection.cacheMinimize()
@@ -5,9 +5,18 @@ Main module for reading the database, containing the DatabaseReader class.
 #! python3
 
 import os
+import shutil
+import sys
 
+import BTrees.OOBTree
 import ZODB
 import ZODB.FileStorage
+import ZODB.DemoStorage
+import ZODB.MappingStorage
+import transaction
+
+import utils.feature_index as feature_index
+import utils.window_index as window_index
 
 
 class DatabaseReader:
@@ -16,6 +25,18 @@ class DatabaseReader:
     This class is used to read the database created by the database_creator.py script.
 
     :param database_path: str , The path to the database file (ends with .fs)
+    :param cache_size: int , optional. The number of objects kept in the ZODB object cache of the connection. The default is 400.
+    :param in_memory: bool , optional. If True, the database file is opened read-only and the changes are kept in an in-memory MappingStorage,
+        so they are never written to the file. Useful for throwaway runs (e.g. evaluations) that start from the same inventory. The default is False.
+
+    A DatabaseReader can be kept open as a session for a whole model allocation, and passed to the search functions instead of a path,
+    so the database is opened once and the object cache stays warm. It can be used as a context manager:
+
+    ```
+    with DatabaseReader(database_path) as reader:
+        for element in elements:
+            find_best_tree_unoptimized(element, diameter, reader)
+    ```
 
     Attributes:
         storage: ZODB.FileStorage.FileStorage
@@ -25,13 +46,22 @@ class DatabaseReader:
         connection: ZODB.connection
             The connection object that is used to connect to the database.
         root: ZODB.persistent.mapping.PersistentMapping
-            The root object of the database.
+            The root object of the database. The trees are stored in root.trees, their feature index in root.feature_index,
+            and the window index of their skeletons, once it was requested, in root.window_index.
     """
 
-    def __init__(self, database_path):
+    def __init__(self, database_path, cache_size=400, in_memory=False):
         self.database_path = database_path
-        self.storage = ZODB.FileStorage.FileStorage(database_path)
-        self.db = ZODB.DB(self.storage)
+        self.in_memory = in_memory
+        if in_memory:
+            # the file is only read, the changes are kept in a MappingStorage on top of it
+            self.storage = ZODB.DemoStorage.DemoStorage(
+                base=ZODB.FileStorage.FileStorage(database_path, read_only=True),
+                changes=ZODB.MappingStorage.MappingStorage(),
+            )
+        else:
+            self.storage = ZODB.FileStorage.FileStorage(database_path)
+        self.db = ZODB.DB(self.storage, cache_size=cache_size)
         self.connection = self.db.open()
         self.root = self.connection.root
         self.is_open = True
@@ -48,6 +78,19 @@ class DatabaseReader:
             )
             return None
 
+    def get_tree_skeleton(self, tree_id):
+        """
+        Get a skeleton-only view of a tree from the database, using its id.
+        This is what the search functions work on, so that full trees are not copied.
+
+        :return: TreeSkeleton or None
+            The skeleton-only view of the tree, or None if the tree is not in the database.
+        """
+        tree = self.get_tree(tree_id)
+        if tree is None:
+            return None
+        return tree.get_skeleton_view()
+
     def get_num_trees(self):
         """
         Get the number of trees in the database.
@@ -55,10 +98,153 @@ class DatabaseReader:
         """
         return self.root.n_trees
 
+    def get_feature_index(self):
+        """
+        Get the feature index of the database, as a single NumPy structured array with one row per tree, sorted by tree id.
+        See utils.feature_index for the fields. Its rows are updated in place when trees are stored, copy it to keep the current values.
+        Databases created before the feature index existed, or with an older version of its fields, get it (re)built on the fly.
+        Databases storing it as a single array in root.features get it moved to root.feature_index.
+        """
+        if (
+            not hasattr(self.root, "feature_index")
+            or self.root.feature_index.dtype != feature_index.FEATURE_DTYPE
+        ):
+            if (
+                hasattr(self.root, "features")
+                and self.root.features.dtype == feature_index.FEATURE_DTYPE
+            ):
+                features = self.root.features
+            else:
+                print(
+                    "No up to date feature index found in the database. Building it from the trees."
+                )
+                features = feature_index.build_feature_index(self.root.trees.values())
+            self.root.feature_index = feature_index.FeatureIndex(features)
+            if hasattr(self.root, "features"):
+                del self.root.features
+        return self.root.feature_index.to_array()
+
+    def get_window_index(self):
+        """
+        Get the window index of the database, see utils.window_index. It is built from the feature index on the first call,
+        or if it was built with an older version of the windows, and then kept up to date by set_tree and remove_tree.
+        """
+        if (
+            not hasattr(self.root, "window_index")
+            or self.root.window_index.version != window_index.WINDOW_INDEX_VERSION
+        ):
+            print("No up to date window index found in the database. Building it.")
+            self.root.window_index = window_index.build_window_index(
+                self.get_feature_index()
+            )
+        return self.root.window_index
+
+    def build_indexes(self):
+        """
+        Build the feature index from the trees of the database, and the window index from it if it was already requested
+        (otherwise it is built on the first call of get_window_index).
+        This is how the indexes are updated after a batch of trees stored with set_tree(..., update_indexes=False).
+        """
+        if hasattr(self.root, "features"):
+            del self.root.features
+        self.root.feature_index = feature_index.FeatureIndex(
+            feature_index.build_feature_index(self.root.trees.values())
+        )
+        if hasattr(self.root, "window_index"):
+            self.root.window_index = window_index.build_window_index(
+                self.get_feature_index()
+            )
+
+    def set_tree(self, tree_id, tree, update_indexes=True):
+        """
+        Store a (modified) tree in the database and update its row in the feature index, and its windows in the window index.
+        The changes are only saved at the next transaction.commit().
+
+        :param update_indexes: bool, optional
+            Whether to update the indexes. When many trees are stored at once, they can be skipped,
+            and build_indexes called once at the end instead. The default is True.
+        """
+        self.root.trees[tree_id] = tree
+        if not update_indexes:
+            return
+        features = feature_index.compute_tree_features(tree)
+        self.get_feature_index()
+        self.root.feature_index.update_tree(features)
+        if hasattr(self.root, "window_index"):
+            self.get_window_index().update_tree(features[0])
+
+    def get_next_tree_id(self):
+        """
+        Get the id following the largest id given so far: to the trees of the database, to the scans ingested
+        (see utils.database_ingestion), and to the offcuts added (see add_tree). Ids of trees entirely used up are not given again.
+        """
+        used_ids = [getattr(self.root, "next_tree_id", 0) - 1]
+        if hasattr(self.root, "trees") and len(self.root.trees) > 0:
+            used_ids.append(self.root.trees.maxKey())
+        if hasattr(self.root, "scans"):
+            used_ids.extend(self.root.scans.values())
+        return max(used_ids) + 1
+
+    def add_tree(self, tree):
+        """
+        Add a new tree to the database, e.g. an offcut returned by Tree.trim, with the next free id.
+        The changes are only saved at the next transaction.commit().
+
+        :param tree: Tree
+            The tree to add. Its id is set to the new id.
+        :return: tree_id: int
+            The id of the tree in the database
+        """
+        tree.id = self.get_next_tree_id()
+        self.root.next_tree_id = tree.id + 1
+        self.set_tree(tree.id, tree)
+        self.root.n_trees += 1
+        return tree.id
+
+    def clear(self):
+        """
+        Remove all the trees of the database, with their indexes, the scans ingested and the ids given so far (offcuts included),
+        so that the database is as new and the next tree added gets the id 0.
+        The changes are only saved at the next transaction.commit().
+        """
+        self.root.trees = BTrees.OOBTree.BTree()
+        self.root.scans = BTrees.OOBTree.BTree()
+        self.root.n_trees = 0
+        self.root.next_tree_id = 0
+        for index_name in ("features", "window_index"):
+            if hasattr(self.root, index_name):
+                delattr(self.root, index_name)
+        self.root.feature_index = feature_index.FeatureIndex(
+            feature_index.build_feature_index([])
+        )
+
+    def remove_tree(self, tree_id):
+        """
+        Remove a tree from the database, from the feature index and from the window index.
+        The changes are only saved at the next transaction.commit().
+        """
+        self.root.trees.pop(tree_id)
+        self.root.n_trees -= 1
+        self.get_feature_index()
+        self.root.feature_index.remove_tree(tree_id)
+        if hasattr(self.root, "window_index"):
+            self.get_window_index().remove_tree(tree_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # uncommitted changes are discarded if something went wrong
+        if exc_type is not None:
+            transaction.abort()
+        self.close()
+
     def close(self):
         """
-        Close the connection to the database.
+        Close the connection to the database. Closing an already closed reader does nothing.
         """
+        if not self.is_open:
+            return
         self.connection.close()
         self.db.close()
         self.storage.close()
@@ -71,9 +257,75 @@ class DatabaseReader:
         self.db.pack()
         print("Database packed.")
 
+    def snapshot(self, snapshot_path, pack=True):
+        """
+        Save a snapshot of the committed state of the database to a file, to restore it later with restore_snapshot.
+        The database file is copied, with a reflink when the file system supports it.
+
+        :param snapshot_path: str
+            The path of the snapshot file (ends with .fs)
+        :param pack: bool, optional
+            Whether to pack the database first, so that the snapshot only holds the latest revision. The default is True.
+        """
+        if self.in_memory:
+            raise ValueError(
+                "The changes of an in-memory database are thrown away, snapshot a database opened from its file instead."
+            )
+        if pack:
+            self.db.pack()
+            if os.path.exists(self.database_path + ".old"):
+                self.delete_old()
+        _remove_storage_files(snapshot_path)
+        _copy_file(self.database_path, snapshot_path)
+        print(f"Snapshot saved to {snapshot_path}.")
+
+    @staticmethod
+    def restore_snapshot(snapshot_path, database_path):
+        """
+        Replace a database with a snapshot made by DatabaseReader.snapshot. The database must not be open.
+
+        :param snapshot_path: str
+            The path of the snapshot file
+        :param database_path: str
+            The path of the database file to replace
+        """
+        _remove_storage_files(database_path)
+        _copy_file(snapshot_path, database_path)
+
     def delete_old(self):
         """
         Delete the fs.old file containing the old revisions of the database.
         """
         os.remove(self.database_path + ".old")
         print("Old revisions deleted.")
+
+
+# ioctl request to clone a file on Linux file systems supporting it (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _copy_file(source_path, destination_path):
+    """
+    Copy a file, as a reflink (copy-on-write clone, instantaneous) when possible, or as a regular copy otherwise.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        with open(source_path, "rb") as source, open(
+            destination_path, "wb"
+        ) as destination:
+            try:
+                fcntl.ioctl(destination.fileno(), _FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source_path, destination_path)
+
+
+def _remove_storage_files(database_path):
+    """
+    Remove a database file and the index, lock and temporary files FileStorage keeps next to it.
+    """
+    for extension in ("", ".index", ".lock", ".tmp"):
+        if os.path.exists(database_path + extension):
+            os.remove(database_path + extension)
@@ -86,15 +86,41 @@ class Element(object):
             raise ValueError("The geometry of the target element is not supported.")
         return cylinder
 
+    def get_axis_polyline(self, n_segments: int = 10):
+        """
+        Get the axis of the element as a polyline, sampled along the same curve as create_bounding_cylinder.
+
+        :param n_segments: int
+            The number of segments of the polyline. Straight curves only give their two ends.
+        :return: list of list of float
+            The vertices of the polyline.
+        """
+        if self.type == ElementType.Line:
+            axis = self.geometry
+        elif self.type == ElementType.Brep:
+            axis = [
+                self.geometry.Edges[i]
+                for i in range(self.geometry.Edges.Count)
+                if not self.geometry.Edges[i].IsClosed
+            ][0]
+        else:
+            raise ValueError("The geometry of the target element is not supported.")
+        if axis.IsLinear(0.01):
+            parameters = [axis.Domain.T0, axis.Domain.T1]
+        else:
+            parameters = axis.DivideByCount(n_segments, True)
+        points = [axis.PointAt(t) for t in parameters]
+        return [[point.X, point.Y, point.Z] for point in points]
+
     def __str__(self):
         return f"Element with GUID {self.GUID} and of type {self.type}"
 
-    def allocate_trees(self, db_path: str, optimized: bool = False):
+    def allocate_trees(self, db_path, optimized: bool = False):
         """
         Allocate trees to the element.
 
-        :param db_path: str
-            The path to the tree database.
+        :param db_path: str or DatabaseReader
+            The path to the tree database, or an open DatabaseReader session shared by all the elements of the model.
 
         :return: best_tree: Tree.tree
             The best fitting tree allocated to the element.
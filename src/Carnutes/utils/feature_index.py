@@ -0,0 +1,623 @@
+"""
+Module for the feature index of the database.
+The feature index is a compact table stored next to the trees, with one row per tree.
+It holds what is needed to discard trees during a search, so that trees don't have to be loaded one by one.
+It is stored in blocks of rows (see FeatureIndex), so that storing a tree only rewrites the block of its row.
+
+The radii of each tree are also stored as range tables (sparse tables): level k holds the minimum and maximum radius
+over the 2**k circles starting at each circle, so the extrema over any run of consecutive circles is read in O(1)
+from two overlapping entries. This tells whether a window of the skeleton satisfies the diameter band without any geometry.
+
+The skeleton of each tree is stored as a pyramid of resolutions: the skeleton itself with its circles, from which
+skeleton-only views of the trees can be created without loading them (see get_skeleton_views), and coarser levels,
+level n holding n points spread evenly along the arc length of the skeleton. Trees can then be ranked against an element
+at the coarse levels, and only the best ones scored at full resolution (see packing_combinatorics.rank_candidates_coarse_to_fine).
+"""
+
+#! python3
+
+import bisect
+import typing
+
+import numpy as np
+import persistent
+
+import utils.tree as tree
+
+# The number of levels of the range tables of the radii
+RANGE_TABLE_LEVELS = int(np.log2(tree.SKELETON_LENGTH)) + 1
+
+# The tolerance on arc lengths when locating windows on the skeletons, in meters
+ARC_LENGTH_TOLERANCE = 1e-6
+
+# The number of rows of the blocks the feature index is stored in, see FeatureIndex
+FEATURE_BLOCK_SIZE = 32
+
+# The number of points of the coarse levels of the skeleton pyramid, from the coarsest. The finest level is the skeleton itself.
+# They must be increasing and below tree.SKELETON_LENGTH: the skeletons have at most SKELETON_LENGTH points whatever the length
+# of the log, so a level with more points would only interpolate them. FEATURE_DTYPE has a field per level, changing them
+# makes the feature index of existing databases outdated, and it is rebuilt on its next use (see DatabaseReader.get_feature_index).
+SKELETON_PYRAMID_LEVELS = (3, 6)
+
+
+def get_pyramid_field(n_points: int) -> str:
+    """
+    The name of the field of the feature index holding the level of the skeleton pyramid with @n_points points.
+    """
+    return f"skeleton_pyramid_{n_points}"
+
+
+# The structure of a row of the feature index. Rows of trees with shorter skeletons are padded with NaN.
+FEATURE_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("mean_diameter", np.float64),
+        ("height", np.float64),
+        ("skeleton_length", np.float64),
+        ("n_skeleton_points", np.int64),
+        ("n_circles", np.int64),
+        ("skeleton_points", np.float64, (tree.SKELETON_LENGTH, 3)),
+        ("circle_centers", np.float64, (tree.SKELETON_LENGTH, 3)),
+        ("cumulative_lengths", np.float64, (tree.SKELETON_LENGTH,)),
+        ("radii", np.float64, (tree.SKELETON_LENGTH,)),
+        (
+            "min_radius_table",
+            np.float64,
+            (RANGE_TABLE_LEVELS, tree.SKELETON_LENGTH),
+        ),
+        (
+            "max_radius_table",
+            np.float64,
+            (RANGE_TABLE_LEVELS, tree.SKELETON_LENGTH),
+        ),
+    ]
+    + [
+        (get_pyramid_field(n_points), np.float64, (n_points, 3))
+        for n_points in SKELETON_PYRAMID_LEVELS
+    ]
+)
+
+
+def compute_tree_features(tree_to_index: tree.Tree) -> np.ndarray:
+    """
+    Compute the row of the feature index corresponding to a tree.
+
+    :param tree_to_index: Tree
+        The tree to compute the features of
+    :return: features: np.ndarray
+        The features of the tree, as a structured array of shape (1,)
+    """
+    features = np.zeros(1, dtype=FEATURE_DTYPE)
+    features["id"] = tree_to_index.id
+    features["mean_diameter"] = tree_to_index.mean_diameter
+    features["height"] = tree_to_index.height
+
+    skeleton_points = np.asarray(tree_to_index.skeleton.points, dtype=np.float64)
+    n_points = min(len(skeleton_points), tree.SKELETON_LENGTH)
+    cumulative_lengths = np.full(tree.SKELETON_LENGTH, np.nan)
+    if n_points > 0:
+        segment_lengths = np.linalg.norm(np.diff(skeleton_points, axis=0), axis=1)
+        cumulative_lengths[:n_points] = np.concatenate(
+            [[0.0], np.cumsum(segment_lengths)]
+        )[:n_points]
+    radii = np.full(tree.SKELETON_LENGTH, np.nan)
+    n_circles = min(len(tree_to_index.skeleton_circles), tree.SKELETON_LENGTH)
+    radii[:n_circles] = [
+        circle[1] for circle in tree_to_index.skeleton_circles[:n_circles]
+    ]
+    padded_skeleton_points = np.full((tree.SKELETON_LENGTH, 3), np.nan)
+    padded_skeleton_points[:n_points] = skeleton_points[:n_points]
+    circle_centers = np.full((tree.SKELETON_LENGTH, 3), np.nan)
+    if n_circles > 0:
+        circle_centers[:n_circles] = [
+            circle[0] for circle in tree_to_index.skeleton_circles[:n_circles]
+        ]
+
+    features["n_skeleton_points"] = n_points
+    features["n_circles"] = n_circles
+    features["skeleton_points"] = padded_skeleton_points
+    features["circle_centers"] = circle_centers
+    features["skeleton_length"] = cumulative_lengths[n_points - 1] if n_points else 0.0
+    features["cumulative_lengths"] = cumulative_lengths
+    features["radii"] = radii
+    features["min_radius_table"], features["max_radius_table"] = build_range_tables(
+        radii
+    )
+    for n_level_points in SKELETON_PYRAMID_LEVELS:
+        level = np.full((n_level_points, 3), np.nan)
+        if n_points >= 2:
+            level_arc_lengths = np.linspace(
+                0.0, cumulative_lengths[n_points - 1], n_level_points
+            )
+            level = np.stack(
+                [
+                    np.interp(
+                        level_arc_lengths,
+                        cumulative_lengths[:n_points],
+                        skeleton_points[:n_points, k],
+                    )
+                    for k in range(3)
+                ],
+                axis=1,
+            )
+        features[get_pyramid_field(n_level_points)] = level
+    return features
+
+
+def get_skeleton_views(features: np.ndarray) -> typing.List[tree.TreeSkeleton]:
+    """
+    Create the skeleton-only views of trees from their rows of the feature index, without loading the trees.
+    They hold the same skeletons and circles as Tree.get_skeleton_view.
+
+    :param features: np.ndarray
+        The rows of the trees in the feature index
+    :return: list of TreeSkeleton
+        The skeleton-only views of the trees, in the order of the rows
+    """
+    # the columns are converted once for all the rows, accessing the fields row by row is much slower
+    ids = features["id"].tolist()
+    n_skeleton_points = features["n_skeleton_points"].tolist()
+    n_circles = features["n_circles"].tolist()
+    skeleton_points = features["skeleton_points"].tolist()
+    circle_centers = features["circle_centers"].copy()
+    radii = features["radii"].tolist()
+    mean_diameters = features["mean_diameter"].tolist()
+    heights = features["height"].tolist()
+    return [
+        tree.TreeSkeleton(
+            ids[row],
+            tree.Pointcloud(skeleton_points[row][: n_skeleton_points[row]]),
+            list(
+                zip(
+                    circle_centers[row, : n_circles[row]],
+                    radii[row][: n_circles[row]],
+                )
+            ),
+            mean_diameters[row],
+            heights[row],
+        )
+        for row in range(len(features))
+    ]
+
+
+def build_feature_index(trees: typing.Iterable[tree.Tree]) -> np.ndarray:
+    """
+    Build the feature index of a collection of trees.
+
+    :param trees: iterable of Tree
+        The trees to index, e.g. root.trees.values()
+    :return: feature_index: np.ndarray
+        The feature index, as a structured array sorted by tree id
+    """
+    rows = [compute_tree_features(tree_to_index) for tree_to_index in trees]
+    if len(rows) == 0:
+        return np.zeros(0, dtype=FEATURE_DTYPE)
+    feature_index = np.concatenate(rows)
+    return feature_index[np.argsort(feature_index["id"])]
+
+
+class FeatureBlock(persistent.Persistent):
+    """
+    Persistent object holding consecutive rows of the feature index, sorted by tree id.
+    It is stored as its own record in the database, so a change of a row only rewrites its block.
+
+    :param rows: np.ndarray
+        The rows of the block
+    """
+
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+
+
+class FeatureIndex(persistent.Persistent):
+    """
+    The feature index of a database, stored in root.feature_index (see DatabaseReader.get_feature_index).
+    The rows are stored in FeatureBlocks of FEATURE_BLOCK_SIZE to 2 * FEATURE_BLOCK_SIZE rows, ordered by tree id,
+    so that storing a tree only rewrites the block of its row, and not the whole index.
+    The whole index is assembled into a single structured array the first time it is read after being loaded (see to_array),
+    and then kept up to date along with the blocks: changed rows are updated in place, and the rows of new trees
+    with the largest ids (e.g. offcuts) are appended in amortized O(1).
+
+    :param feature_index: np.ndarray
+        The rows of the index, sorted by tree id, as built by build_feature_index
+    """
+
+    def __init__(self, feature_index: np.ndarray):
+        self.dtype = feature_index.dtype
+        self.n_rows = len(feature_index)
+        self.blocks = [
+            FeatureBlock(feature_index[start : start + FEATURE_BLOCK_SIZE].copy())
+            for start in range(0, len(feature_index), FEATURE_BLOCK_SIZE)
+        ]
+        self.first_ids = [int(block.rows["id"][0]) for block in self.blocks]
+
+    def __len__(self):
+        return self.n_rows
+
+    def to_array(self) -> np.ndarray:
+        """
+        Get the whole feature index, as a single structured array sorted by tree id.
+        The array is kept between calls, and its rows are updated in place when trees change: copy it to keep the current values.
+
+        :return: feature_index: np.ndarray
+            The feature index
+        """
+        # the _v_ attributes are not stored in the database, and are dropped when the object is reloaded
+        array = getattr(self, "_v_array", None)
+        if array is None:
+            if len(self.blocks) == 0:
+                array = np.zeros(0, dtype=self.dtype)
+            else:
+                array = np.concatenate([block.rows for block in self.blocks])
+            self._v_array = array
+            self._v_buffer = array
+        return array
+
+    def _find_block(self, tree_id: int) -> int:
+        """
+        The index of the block holding (or that would hold) the row of a tree.
+        """
+        return max(bisect.bisect_right(self.first_ids, tree_id) - 1, 0)
+
+    def update_tree(self, features: np.ndarray):
+        """
+        Update (or add) the row of a tree.
+
+        :param features: np.ndarray
+            The features of the tree, as computed by compute_tree_features
+        """
+        row = features.reshape(-1)[0]
+        tree_id = int(row["id"])
+        # the index is marked as changed as well, so that it is reloaded, without its assembled array, if the transaction is aborted
+        self._p_changed = True
+        if len(self.blocks) == 0:
+            self.blocks.append(FeatureBlock(features.reshape(-1).copy()))
+            self.first_ids.append(tree_id)
+            self.n_rows = 1
+            self._v_array = None
+            return
+        block_index = self._find_block(tree_id)
+        block = self.blocks[block_index]
+        position = int(np.searchsorted(block.rows["id"], tree_id))
+        array = getattr(self, "_v_array", None)
+        if position < len(block.rows) and block.rows["id"][position] == tree_id:
+            block.rows[position] = row
+            block._p_changed = True
+            if array is not None:
+                array[np.searchsorted(array["id"], tree_id)] = row
+            return
+
+        block.rows = np.insert(block.rows, position, row)
+        self.first_ids[block_index] = int(block.rows["id"][0])
+        if len(block.rows) > 2 * FEATURE_BLOCK_SIZE:
+            self.blocks.insert(
+                block_index + 1, FeatureBlock(block.rows[FEATURE_BLOCK_SIZE:].copy())
+            )
+            self.first_ids.insert(
+                block_index + 1, int(block.rows["id"][FEATURE_BLOCK_SIZE])
+            )
+            block.rows = block.rows[:FEATURE_BLOCK_SIZE].copy()
+        self.n_rows += 1
+        if array is None:
+            return
+        if len(array) > 0 and tree_id < array["id"][-1]:
+            # the rows after it would have to move, the array is assembled again when needed
+            self._v_array = None
+            return
+        buffer = self._v_buffer
+        if len(array) == len(buffer):
+            buffer = np.empty(max(2 * len(array), FEATURE_BLOCK_SIZE), dtype=self.dtype)
+            buffer[: len(array)] = array
+            self._v_buffer = buffer
+        buffer[len(array)] = row
+        self._v_array = buffer[: len(array) + 1]
+
+    def remove_tree(self, tree_id: int):
+        """
+        Remove the row of a tree, if it is in the index.
+
+        :param tree_id: int
+            The id of the tree to remove
+        """
+        if len(self.blocks) == 0:
+            return
+        block_index = self._find_block(tree_id)
+        block = self.blocks[block_index]
+        position = int(np.searchsorted(block.rows["id"], tree_id))
+        if position == len(block.rows) or block.rows["id"][position] != tree_id:
+            return
+        self._p_changed = True
+        block.rows = np.delete(block.rows, position)
+        if len(block.rows) == 0:
+            del self.blocks[block_index]
+            del self.first_ids[block_index]
+        else:
+            self.first_ids[block_index] = int(block.rows["id"][0])
+        self.n_rows -= 1
+        array = getattr(self, "_v_array", None)
+        if array is not None:
+            # a new array, so that the arrays returned before keep their rows
+            array = np.delete(array, np.searchsorted(array["id"], tree_id))
+            self._v_array = array
+            self._v_buffer = array
+
+
+def build_range_tables(radii: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the range tables of the radii of one or many trees.
+    The entry (k, i) of the tables is the minimum (resp. maximum) of radii[i : i + 2**k].
+    NaN radii are ignored, and the entries of runs going beyond the last circle are NaN.
+
+    :param radii: np.array (..., n_circles)
+        The radii of the circles of the skeletons, padded with NaN
+    :return: min_tables: np.array (..., n_levels, n_circles)
+        The minimum radius of each run of 2**k circles, with n_levels = floor(log2(n_circles)) + 1
+    :return: max_tables: np.array (..., n_levels, n_circles)
+        The maximum radius of each run of 2**k circles
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    n_circles = radii.shape[-1]
+    n_levels = int(np.log2(n_circles)) + 1 if n_circles > 0 else 0
+    min_tables = np.full(radii.shape[:-1] + (n_levels, n_circles), np.nan)
+    max_tables = min_tables.copy()
+    if n_levels == 0:
+        return min_tables, max_tables
+    min_tables[..., 0, :] = radii
+    max_tables[..., 0, :] = radii
+    with np.errstate(invalid="ignore"):
+        for level in range(1, n_levels):
+            half = 1 << (level - 1)
+            n_runs = n_circles - (1 << level) + 1
+            min_tables[..., level, :n_runs] = np.fmin(
+                min_tables[..., level - 1, :n_runs],
+                min_tables[..., level - 1, half : half + n_runs],
+            )
+            max_tables[..., level, :n_runs] = np.fmax(
+                max_tables[..., level - 1, :n_runs],
+                max_tables[..., level - 1, half : half + n_runs],
+            )
+    return min_tables, max_tables
+
+
+def query_range_tables(
+    min_tables: np.ndarray,
+    max_tables: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the minimum and maximum radius over runs of consecutive circles, in O(1) per run.
+    The run [start, end) is covered by the two runs of 2**k circles starting at start and ending at end,
+    with k the largest level such that 2**k <= end - start.
+
+    :param min_tables: np.array (n_trees, n_levels, n_circles)
+        The minimum range tables, see build_range_tables
+    :param max_tables: np.array (n_trees, n_levels, n_circles)
+        The maximum range tables
+    :param starts: np.array (n_trees, ...)
+        The index of the first circle of each run
+    :param ends: np.array (n_trees, ...)
+        The index after the last circle of each run
+    :return: minima: np.array (n_trees, ...)
+        The minimum radius of each run, inf for the empty runs
+    :return: maxima: np.array (n_trees, ...)
+        The maximum radius of each run, -inf for the empty runs
+    """
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    n_circles = min_tables.shape[-1]
+    lengths = ends - starts
+    is_empty = lengths <= 0
+    levels = np.floor(np.log2(np.maximum(lengths, 1))).astype(int)
+    first_starts = np.clip(starts, 0, max(n_circles - 1, 0))
+    second_starts = np.clip(ends - (1 << levels), 0, max(n_circles - 1, 0))
+    rows = np.arange(len(min_tables)).reshape((-1,) + (1,) * (starts.ndim - 1))
+    with np.errstate(invalid="ignore"):
+        minima = np.fmin(
+            min_tables[rows, levels, first_starts],
+            min_tables[rows, levels, second_starts],
+        )
+        maxima = np.fmax(
+            max_tables[rows, levels, first_starts],
+            max_tables[rows, levels, second_starts],
+        )
+    return np.where(is_empty, np.inf, minima), np.where(is_empty, -np.inf, maxima)
+
+
+def is_in_diameter_band(
+    minima: np.ndarray, maxima: np.ndarray, reference_diameter: float
+) -> np.ndarray:
+    """
+    Whether runs of circles have all their diameters within 25% of the reference diameter.
+    As in the original per-circle check, NaN radii are not considered out of the band.
+
+    :param minima: np.array
+        The minimum radius of each run, see query_range_tables
+    :param maxima: np.array
+        The maximum radius of each run
+    :param reference_diameter: float
+        The diameter of the model element
+    :return: is_in_band: np.array of bool
+    """
+    return ~(
+        (2 * minima < 0.75 * reference_diameter)
+        | (2 * maxima > 1.25 * reference_diameter)
+    )
+
+
+def locate_windows_in_diameter_band(
+    feature_index: np.ndarray,
+    reference_diameter: float,
+    element_length: float,
+    window_step: float = None,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Locate the windows of each tree, anchored at one of its ends or starting every window_step meters
+    (in both directions, as evaluated by packing_combinatorics.compute_best_trees_element_matching), and check whether
+    they are long enough for the model element and have all the circles of the window within the diameter band.
+    The windows are located on the skeleton from the cumulative lengths of the index, slightly shrunk by ARC_LENGTH_TOLERANCE,
+    so that a window is only rejected if the matching would reject it.
+    The band is not checked for the trees whose circles don't match their skeleton points one to one.
+
+    :param feature_index: np.ndarray
+        The rows of the feature index of the trees to check
+    :param reference_diameter: float
+        The diameter of the model element
+    :param element_length: float
+        The length of the model element, measured along its points
+    :param window_step: float, optional
+        The step between the start offsets of the windows. None (default) only checks the windows anchored at the ends.
+    :return: window_starts: np.array (n_trees, 2 * n_offsets)
+        The arc length of the start of each window along the skeleton in its stored direction:
+        the windows of the skeleton in its stored direction first, then those of the reversed skeleton.
+    :return: is_valid: np.array of bool (n_trees, 2 * n_offsets)
+    """
+    skeleton_lengths = feature_index["skeleton_length"]
+    n_points = feature_index["n_skeleton_points"]
+    if window_step is None or len(feature_index) == 0:
+        offsets = np.zeros(1)
+    else:
+        n_windows = int(
+            np.floor((np.max(skeleton_lengths) - element_length) / window_step)
+        )
+        offsets = window_step * np.arange(max(n_windows, 0) + 1)
+    offsets = offsets[np.newaxis]
+    is_long_enough = (
+        offsets + element_length
+        <= skeleton_lengths[:, np.newaxis] + ARC_LENGTH_TOLERANCE
+    )
+
+    # the arc lengths of the ends of the windows, along the skeleton in its stored direction
+    forward_starts = offsets
+    reversed_starts = skeleton_lengths[:, np.newaxis] - offsets - element_length
+    window_starts = np.concatenate(
+        np.broadcast_arrays(forward_starts, reversed_starts), axis=1
+    )
+    shrunk_starts = window_starts + ARC_LENGTH_TOLERANCE
+    shrunk_ends = shrunk_starts + element_length - 2 * ARC_LENGTH_TOLERANCE
+
+    # the segment containing an arc length, as located by packing_manipulations.batch_resample_skeletons
+    segment_ends = feature_index["cumulative_lengths"][:, np.newaxis, 1:]
+    max_segments = np.maximum(n_points - 2, 0)[:, np.newaxis]
+    with np.errstate(invalid="ignore"):
+        first_segments = np.minimum(
+            np.sum(segment_ends <= shrunk_starts[..., np.newaxis], axis=2), max_segments
+        )
+        last_segments = np.minimum(
+            np.sum(segment_ends <= shrunk_ends[..., np.newaxis], axis=2), max_segments
+        )
+    # the reversed skeleton is checked on the circles after the ends of its segments
+    shift = np.concatenate(
+        [np.zeros(offsets.shape[1], dtype=int), np.full(offsets.shape[1], 2)]
+    )
+    minima, maxima = query_range_tables(
+        feature_index["min_radius_table"],
+        feature_index["max_radius_table"],
+        first_segments + shift,
+        last_segments + shift,
+    )
+    # the circles of a tree are only matched to its skeleton points if there are as many of them
+    n_circles = np.sum(~np.isnan(feature_index["radii"]), axis=1)
+    is_in_band = (
+        is_in_diameter_band(minima, maxima, reference_diameter)
+        | (n_circles != n_points)[:, np.newaxis]
+    )
+    return window_starts, is_in_band & np.tile(is_long_enough, 2)
+
+
+def has_window_in_diameter_band(
+    feature_index: np.ndarray,
+    reference_diameter: float,
+    element_length: float,
+    window_step: float = None,
+) -> np.ndarray:
+    """
+    Whether each tree has at least one window long enough for the model element
+    and with all the circles of the window within the diameter band (see locate_windows_in_diameter_band).
+    The trees whose circles don't match their skeleton points one to one are kept.
+
+    :param feature_index: np.ndarray
+        The rows of the feature index of the trees to check
+    :param reference_diameter: float
+        The diameter of the model element
+    :param element_length: float
+        The length of the model element, measured along its points
+    :param window_step: float, optional
+        The step between the start offsets of the windows. None (default) only checks the windows anchored at the ends.
+    :return: has_window: np.array of bool (n_trees,)
+    """
+    if len(feature_index) == 0:
+        return np.zeros(0, dtype=bool)
+    _, is_valid = locate_windows_in_diameter_band(
+        feature_index, reference_diameter, element_length, window_step
+    )
+    n_circles = np.sum(~np.isnan(feature_index["radii"]), axis=1)
+    return np.any(is_valid, axis=1) | (n_circles != feature_index["n_skeleton_points"])
+
+
+def interpolate_skeleton_pyramid(
+    feature_index: np.ndarray, n_points: int, arc_lengths: np.ndarray
+) -> np.ndarray:
+    """
+    Get points of the skeletons at given arc lengths from a level of the skeleton pyramid, by linear interpolation
+    between the points of the level. The points of a level are evenly spread, so no search is needed.
+
+    :param feature_index: np.ndarray
+        The rows of the feature index of the trees
+    :param n_points: int
+        The number of points of the level, one of SKELETON_PYRAMID_LEVELS
+    :param arc_lengths: np.array (n_trees, ...)
+        The arc lengths along each skeleton, between 0 and its length
+    :return: points: np.array (n_trees, ..., 3)
+        The interpolated points, NaN for the trees with less than 2 skeleton points
+    """
+    level = feature_index[get_pyramid_field(n_points)]
+    arc_lengths = np.asarray(arc_lengths, dtype=np.float64)
+    steps = feature_index["skeleton_length"] / (n_points - 1)
+    steps = steps.reshape((-1,) + (1,) * (arc_lengths.ndim - 1))
+    positions = np.divide(
+        arc_lengths, steps, out=np.zeros_like(arc_lengths), where=steps > 0
+    )
+    segments = np.clip(np.floor(positions).astype(int), 0, n_points - 2)
+    ratios = (positions - segments)[..., np.newaxis]
+    rows = np.arange(len(level)).reshape((-1,) + (1,) * (arc_lengths.ndim - 1))
+    first_points = level[rows, segments]
+    return first_points + ratios * (level[rows, segments + 1] - first_points)
+
+
+def select_candidates(
+    feature_index: np.ndarray,
+    reference_diameter: float,
+    element_length: float,
+    window_step: float = None,
+    check_windows: bool = True,
+) -> np.ndarray:
+    """
+    Select the trees that can possibly match a model element.
+    A tree is discarded if its mean diameter is not within 25% of the reference diameter,
+    if its skeleton is shorter than the model element,
+    or if none of its windows has all its circles within the diameter band (see has_window_in_diameter_band).
+
+    :param feature_index: np.ndarray
+        The feature index of the database
+    :param reference_diameter: float
+        The diameter of the model element
+    :param element_length: float
+        The length of the model element, measured along its points
+    :param window_step: float, optional
+        The step between the start offsets of the windows evaluated by the matching. None (default) for the anchored windows only.
+    :param check_windows: bool
+        Whether to check the diameter band of the windows. The windows follow the batched KABSCH matching, so this should be False for other matchings.
+    :return: candidate_ids: np.ndarray
+        The ids of the candidate trees, in increasing order
+    """
+    mask = (
+        (feature_index["mean_diameter"] >= 0.75 * reference_diameter)
+        & (feature_index["mean_diameter"] <= 1.25 * reference_diameter)
+        & (feature_index["skeleton_length"] >= element_length)
+    )
+    if check_windows:
+        mask[mask] = has_window_in_diameter_band(
+            feature_index[mask], reference_diameter, element_length, window_step
+        )
+    return feature_index["id"][mask]
@@ -3,6 +3,7 @@ This module contains the various geometrical operations that are perfornmed thou
 """
 
 import typing
+import enum
 
 import numpy as np
 import open3d as o3d
@@ -24,20 +25,82 @@ def project_points_to_plane(
     :return: list of list of float
         The projected points.
     """
+    return project_points_to_plane_array(points, plane_origin, plane_normal).tolist()
+
+
+def project_points_to_plane_array(
+    points: np.ndarray,
+    plane_origin: typing.List[float],
+    plane_normal: typing.List[float],
+) -> np.ndarray:
+    """
+    Project points to a plane, as a single array operation.
+
+    :param points: np.array (N,3)
+        The points to project.
+    :param plane_origin: list of float
+        A point of the plane.
+    :param plane_normal: list of float
+        The normal of the plane. It does not need to be a unit vector.
+
+    :return: np.array (N,3)
+        The projected points.
+    """
     # Just checking the normal is a unit vector
-    plane_normal = np.array(plane_normal)
+    plane_normal = np.asarray(plane_normal, dtype=np.float64)
     plane_normal = plane_normal / np.linalg.norm(plane_normal)
 
-    projected_points = []
-    for point in points:
-        point_to_origin_vector = np.array(point) - np.array(plane_origin)
-        projection_along_normal = np.dot(point_to_origin_vector, plane_normal)
-        projection_vector = projection_along_normal * plane_normal
-        projected_point = np.array(point) - projection_vector
-        point = projected_point.tolist()
-        projected_points.append(point)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    projections_along_normal = (points - np.asarray(plane_origin)) @ plane_normal
+    return points - np.outer(projections_along_normal, plane_normal)
+
+
+def compute_polyline_length(points: typing.List[typing.List[float]]) -> float:
+    """
+    Compute the length of the polyline going through a list of points, in their order.
+
+    :param points: list of list of float
+        The points of the polyline.
 
-    return projected_points
+    :return: float
+        The length of the polyline.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        return 0.0
+    return float(np.sum(np.linalg.norm(np.diff(points, axis=0), axis=1)))
+
+
+def distance_to_polyline(points: np.ndarray, polyline: np.ndarray) -> np.ndarray:
+    """
+    Compute the distance of points to a polyline, i.e. to the closest of its segments.
+
+    :param points: np.array (N,3)
+        The points.
+    :param polyline: np.array (M,3)
+        The vertices of the polyline, in order. A single vertex is treated as a point.
+
+    :return: np.array (N,)
+        The distance of each point to the polyline.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    polyline = np.asarray(polyline, dtype=np.float64).reshape(-1, 3)
+    if len(polyline) == 1:
+        return np.linalg.norm(points - polyline[0], axis=1)
+
+    starts = polyline[:-1]
+    segments = polyline[1:] - starts
+    squared_lengths = np.maximum(np.sum(segments**2, axis=1), np.finfo(np.float64).tiny)
+    distances = np.full(len(points), np.inf)
+    # one segment at a time keeps the memory proportional to the number of points
+    for start, segment, squared_length in zip(starts, segments, squared_lengths):
+        to_points = points - start
+        parameters = np.clip(to_points @ segment / squared_length, 0.0, 1.0)
+        segment_distances = np.linalg.norm(
+            to_points - parameters[:, np.newaxis] * segment, axis=1
+        )
+        np.minimum(distances, segment_distances, out=distances)
+    return distances
 
 
 def fit_circle_with_open3d(
@@ -64,7 +127,7 @@ def fit_circle_with_open3d(
     # Assuming the points are approximately in a plane, we can project them to 2D
     centroid = np.mean(inlier_points, axis=0)
     centered_points = inlier_points - centroid
-    u, s, vh = np.linalg.svd(centered_points)
+    u, s, vh = np.linalg.svd(centered_points, full_matrices=False)
     normal = vh[2, :]
     projected_points = centered_points - np.outer(
         np.dot(centered_points, normal), normal
@@ -85,6 +148,193 @@ def fit_circle_with_open3d(
     return center_3d, radius
 
 
+class CircleFittingMethod(enum.Enum):
+    """
+    Enum for the method used to fit circles to the slices of a tree.
+    RANSAC fits each slice with fit_circle_with_open3d, ALGEBRAIC fits all the slices at once with fit_circles_algebraic.
+    """
+
+    RANSAC = 1
+    ALGEBRAIC = 2
+
+
+def fit_circles_algebraic(
+    points: np.ndarray,
+    slice_indexes: np.ndarray,
+    n_slices: int,
+    robust_iterations: int = 0,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit horizontal circles to several slices of points at once, with the algebraic (Kasa) least squares fit.
+    The 3x3 normal equations of every slice are accumulated with np.bincount and solved with a single call to np.linalg.solve.
+    The circles are fitted in the xy plane, the z coordinate of their center is the mean height of their slice.
+
+    :param points: np.array (N,3)
+        The points of all the slices.
+    :param slice_indexes: np.array (N,)
+        The index of the slice of each point, between 0 and n_slices - 1.
+    :param n_slices: int
+        The number of slices. Each slice needs at least 3 points that are not aligned.
+    :param robust_iterations: int, optional
+        The number of reweighted fits done after the first one. Points far from their circle get a lower (Cauchy) weight,
+        which makes the fit robust to the outliers of the scans. The default is 0 (plain least squares).
+
+    :return: centers: np.array (n_slices, 3)
+        The centers of the circles.
+    :return: radii: np.array (n_slices,)
+        The radii of the circles.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    slice_indexes = np.asarray(slice_indexes, dtype=np.int64)
+    counts = np.bincount(slice_indexes, minlength=n_slices)
+    centroids = (
+        np.stack(
+            [
+                np.bincount(slice_indexes, weights=points[:, k], minlength=n_slices)
+                for k in range(3)
+            ],
+            axis=1,
+        )
+        / counts[:, np.newaxis]
+    )
+
+    # the points are centered on their slice for a well conditioned system
+    x = points[:, 0] - centroids[slice_indexes, 0]
+    y = points[:, 1] - centroids[slice_indexes, 1]
+    squared_norms = x * x + y * y
+    weights = np.ones(len(points))
+
+    for iteration in range(robust_iterations + 1):
+
+        def weighted_sum(values):
+            return np.bincount(
+                slice_indexes, weights=weights * values, minlength=n_slices
+            )
+
+        # x^2 + y^2 = 2 a x + 2 b y + c, with (a, b) the center and c = r^2 - a^2 - b^2
+        sxx, sxy, syy = weighted_sum(x * x), weighted_sum(x * y), weighted_sum(y * y)
+        sx, sy, s1 = weighted_sum(x), weighted_sum(y), weighted_sum(1.0)
+        normal_matrices = np.stack(
+            [
+                np.stack([sxx, sxy, sx], axis=1),
+                np.stack([sxy, syy, sy], axis=1),
+                np.stack([sx, sy, s1], axis=1),
+            ],
+            axis=1,
+        )
+        right_hand_sides = np.stack(
+            [
+                weighted_sum(x * squared_norms),
+                weighted_sum(y * squared_norms),
+                weighted_sum(squared_norms),
+            ],
+            axis=1,
+        )
+        solutions = np.linalg.solve(normal_matrices, right_hand_sides[..., np.newaxis])[
+            ..., 0
+        ]
+        centers_2d = solutions[:, :2] / 2
+        radii = np.sqrt(
+            np.maximum(solutions[:, 2] + np.sum(centers_2d**2, axis=1), 0.0)
+        )
+
+        if iteration < robust_iterations:
+            residuals = np.abs(
+                np.hypot(
+                    x - centers_2d[slice_indexes, 0], y - centers_2d[slice_indexes, 1]
+                )
+                - radii[slice_indexes]
+            )
+            scales = (
+                2
+                * np.bincount(slice_indexes, weights=residuals, minlength=n_slices)
+                / counts
+                + np.finfo(np.float64).eps
+            )
+            weights = 1 / (1 + (residuals / scales[slice_indexes]) ** 2)
+
+    centers = centroids.copy()
+    centers[:, :2] += centers_2d
+    return centers, radii
+
+
+def kabsch_registration(
+    source_points: np.ndarray, target_points: np.ndarray, n_points: np.ndarray = None
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the rigid transformations that best align batches of source points to target points,
+    in the least squares sense, when the point-to-point correspondences are known (Kabsch/Umeyama, without scaling).
+    All the batches are solved with a single call to np.linalg.svd.
+
+    :param source_points: np.array (n_batches, n_points, 3)
+        The points to align. Point i of a batch corresponds to point i of the same batch in the targets.
+    :param target_points: np.array (n_batches, n_points, 3) or (n_points, 3)
+        The points to align to. A single set of points is used for all batches.
+    :param n_points: np.array (n_batches,), optional
+        The number of points of each batch, if they are padded to the same number. The padding points are ignored.
+        By default, all the points are used.
+
+    :return: transformations: np.array (n_batches, 4, 4)
+        The transformations from the source points to the target points
+    :return: rmse: np.array (n_batches,)
+        The root mean square distance between the transformed source points and the target points
+    """
+    source_points = np.asarray(source_points, dtype=np.float64)
+    target_points = np.broadcast_to(
+        np.asarray(target_points, dtype=np.float64), source_points.shape
+    )
+    if n_points is None:
+        weights = np.ones(source_points.shape[:2])
+    else:
+        weights = (
+            np.arange(source_points.shape[1])[np.newaxis]
+            < np.asarray(n_points)[:, np.newaxis]
+        ).astype(np.float64)
+        # the padding may be NaN
+        source_points = np.where(weights[:, :, np.newaxis] > 0, source_points, 0.0)
+        target_points = np.where(weights[:, :, np.newaxis] > 0, target_points, 0.0)
+    total_weights = np.sum(weights, axis=1)[:, np.newaxis, np.newaxis]
+    source_centroids = (
+        np.sum(weights[:, :, np.newaxis] * source_points, axis=1, keepdims=True)
+        / total_weights
+    )
+    target_centroids = (
+        np.sum(weights[:, :, np.newaxis] * target_points, axis=1, keepdims=True)
+        / total_weights
+    )
+    centered_sources = source_points - source_centroids
+    centered_targets = target_points - target_centroids
+
+    covariances = np.einsum(
+        "bn,bni,bnj->bij", weights, centered_sources, centered_targets
+    )
+    u, _, vh = np.linalg.svd(covariances)
+    # we make sure the result is a rotation and not a reflection
+    corrections = np.ones((len(source_points), 3))
+    corrections[:, 2] = np.sign(np.linalg.det(np.einsum("bij,bjk->bik", u, vh)))
+    corrections[corrections[:, 2] == 0, 2] = 1.0
+    rotations = np.einsum(
+        "bji,bj,bkj->bik", vh, corrections, u
+    )  # V @ diag(corrections) @ U.T
+    translations = target_centroids[:, 0] - np.einsum(
+        "bij,bj->bi", rotations, source_centroids[:, 0]
+    )
+
+    transformations = np.tile(np.eye(4), (len(source_points), 1, 1))
+    transformations[:, :3, :3] = rotations
+    transformations[:, :3, 3] = translations
+
+    residuals = (
+        np.einsum("bij,bnj->bni", rotations, source_points)
+        + translations[:, np.newaxis]
+        - target_points
+    )
+    rmse = np.sqrt(
+        np.sum(weights * np.sum(residuals**2, axis=2), axis=1) / total_weights[:, 0, 0]
+    )
+    return transformations, rmse
+
+
 def find_rotation_matrix_between_skeletons(first_skeleton, second_skeleton) -> int:
     """
     Find the rotation angle between two skeletons
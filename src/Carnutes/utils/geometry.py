@@ -5,6 +5,8 @@ module for geometry classes
 from dataclasses import dataclass
 import typing
 
+import numpy as np
+
 
 def sort_points(
     points_as_list: typing.List[typing.List[float]],
@@ -52,6 +54,209 @@ class Pointcloud:
     def __str__(self):
         return "Pointcloud with {} points".format(len(self.points))
 
+    @property
+    def points_array(self) -> np.ndarray:
+        """
+        The points as an array of shape (N,3)
+        """
+        return np.asarray(self.points, dtype=np.float64).reshape(-1, 3)
+
+    @property
+    def colors_array(self) -> np.ndarray:
+        """
+        The colors (floats between 0 and 1) as an uint8 array of shape (N,3). None if there are no colors.
+        """
+        if self.colors is None:
+            return None
+        return _colors_to_uint8(self.colors)
+
+
+def _colors_to_uint8(colors) -> np.ndarray:
+    """
+    Convert colors to an uint8 array of shape (N,3).
+    uint8 colors are kept as they are, other colors are expected as floats between 0 and 1 (as in open3d).
+    """
+    colors = np.asarray(colors)
+    if colors.dtype == np.uint8:
+        return colors.reshape(-1, 3)
+    return np.round(np.clip(colors, 0, 1) * 255).astype(np.uint8).reshape(-1, 3)
+
+
+class ArrayPointcloud(Pointcloud):
+    """
+    Pointcloud stored as numpy arrays, used for the point clouds of the trees.
+    The points are stored as a float32 array of shape (N,3) and the colors as an uint8 array of shape (N,3),
+    which pickles into the database far more compactly than lists of floats.
+    The points and colors attributes are still available as lists (colors as floats between 0 and 1), for the code expecting a Pointcloud.
+    The points can be grouped in segments (e.g. the slices of the skeleton of a tree): the points of segment k are
+    points_array[segment_offsets[k]:segment_offsets[k+1]], and the bounding box of each segment is kept in segment_bounds,
+    so that whole segments can be kept or dropped without testing their points. Setting the points ungroups them.
+    :param points
+        The points as an array-like of shape (N,3)
+    :param colors
+        The colors as an array-like of shape (N,3), either uint8 or floats between 0 and 1. None by default.
+    :param segment_offsets
+        The offsets of the segments in the points, an array-like of S+1 increasing integers from 0 to N. None by default.
+    """
+
+    def __init__(self, points, colors=None, segment_offsets=None):
+        self.points_array = points
+        self.colors_array = colors
+        self.set_segments(segment_offsets)
+
+    def __str__(self):
+        return "Pointcloud with {} points".format(len(self._points))
+
+    def __repr__(self):
+        return "ArrayPointcloud({} points, {}, {})".format(
+            len(self._points),
+            "no colors" if self._colors is None else "colors",
+            (
+                "ungrouped"
+                if self.segment_offsets is None
+                else "{} segments".format(len(self.segment_offsets) - 1)
+            ),
+        )
+
+    def __eq__(self, other):
+        """
+        Point clouds are equal if they have the same points, colors and segments, compared as arrays.
+        """
+        if not isinstance(other, ArrayPointcloud):
+            return NotImplemented
+        return all(
+            _optional_arrays_equal(array, other_array)
+            for array, other_array in (
+                (self._points, other._points),
+                (self._colors, other._colors),
+                (self.segment_offsets, other.segment_offsets),
+            )
+        )
+
+    __hash__ = None
+
+    @property
+    def points_array(self) -> np.ndarray:
+        """
+        The points as a float32 array of shape (N,3)
+        """
+        return self._points
+
+    @points_array.setter
+    def points_array(self, points):
+        self._points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        self._segment_offsets = None
+        self._segment_bounds = None
+
+    @property
+    def segment_offsets(self) -> np.ndarray:
+        """
+        The offsets of the segments in the points, as an int64 array of shape (S+1,). None if the points are not grouped.
+        Point clouds pickled before the segments existed are not grouped.
+        """
+        return self.__dict__.get("_segment_offsets")
+
+    @property
+    def segment_bounds(self) -> np.ndarray:
+        """
+        The bounding boxes of the segments, as a float64 array of shape (S,2,3) holding the minimum and maximum corners.
+        Empty segments have infinite bounds (+inf minimum and -inf maximum). None if the points are not grouped.
+        """
+        return self.__dict__.get("_segment_bounds")
+
+    def set_segments(self, segment_offsets):
+        """
+        Group the points in segments, and compute their bounding boxes.
+        It must be called again after the points are modified in place.
+
+        :param segment_offsets: array-like of S+1 int, or None
+            The offsets of the segments in the points, see segment_offsets. None to ungroup the points.
+        """
+        if segment_offsets is None:
+            self._segment_offsets = None
+            self._segment_bounds = None
+            return
+        segment_offsets = np.asarray(segment_offsets, dtype=np.int64).reshape(-1)
+        if (
+            len(segment_offsets) == 0
+            or segment_offsets[0] != 0
+            or segment_offsets[-1] != len(self._points)
+            or np.any(np.diff(segment_offsets) < 0)
+        ):
+            raise ValueError(
+                f"The segment offsets must increase from 0 to {len(self._points)}, got {segment_offsets}"
+            )
+        n_segments = len(segment_offsets) - 1
+        bounds = np.empty((n_segments, 2, 3), dtype=np.float64)
+        bounds[:, 0] = np.inf
+        bounds[:, 1] = -np.inf
+        non_empty = np.flatnonzero(np.diff(segment_offsets) > 0)
+        if len(non_empty) > 0:
+            starts = segment_offsets[non_empty]
+            bounds[non_empty, 0] = np.minimum.reduceat(self._points, starts, axis=0)
+            bounds[non_empty, 1] = np.maximum.reduceat(self._points, starts, axis=0)
+        self._segment_offsets = segment_offsets
+        self._segment_bounds = bounds
+
+    def select_segments(self, first: int, last: int) -> "ArrayPointcloud":
+        """
+        Get the points of a range of segments, only copying the points of these segments.
+
+        :param first: int
+            The first segment
+        :param last: int
+            The segment after the last one
+        :return: ArrayPointcloud
+            The points of the segments, grouped in the same segments
+        """
+        offsets = self.segment_offsets
+        if offsets is None:
+            raise ValueError("The points are not grouped in segments")
+        start, end = offsets[first], offsets[last]
+        return ArrayPointcloud(
+            self._points[start:end],
+            None if self._colors is None else self._colors[start:end],
+            offsets[first : last + 1] - start,
+        )
+
+    @property
+    def colors_array(self) -> np.ndarray:
+        """
+        The colors as an uint8 array of shape (N,3). None if there are no colors.
+        """
+        return self._colors
+
+    @colors_array.setter
+    def colors_array(self, colors):
+        self._colors = None if colors is None else _colors_to_uint8(colors)
+
+    @property
+    def points(self) -> typing.List[typing.List[float]]:
+        return self._points.tolist()
+
+    @points.setter
+    def points(self, points):
+        self.points_array = points
+
+    @property
+    def colors(self) -> typing.List[typing.List[float]]:
+        if self._colors is None:
+            return None
+        return (self._colors / 255.0).tolist()
+
+    @colors.setter
+    def colors(self, colors):
+        self.colors_array = colors
+
+
+def _optional_arrays_equal(first: np.ndarray, second: np.ndarray) -> bool:
+    """
+    Whether two arrays, each possibly None, are equal.
+    """
+    if first is None or second is None:
+        return first is None and second is None
+    return np.array_equal(first, second)
+
 
 @dataclass
 class Mesh:
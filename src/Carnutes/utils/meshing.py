@@ -34,17 +34,23 @@ def mesh_from_tree_pointcloud(
     """
     pcd = o3d.geometry.PointCloud()
     if meshing_method == MeshingMethod.POISSON:
-        pcd.points = o3d.utility.Vector3dVector(tree_pointcloud.points)
+        pcd.points = o3d.utility.Vector3dVector(
+            tree_pointcloud.points_array.astype(np.float64)
+        )
         o3d_mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(
             pcd, depth=9, width=0, scale=1.1, linear_fit=False
         )
     elif meshing_method == MeshingMethod.BALL_PIVOT:
-        pcd.points = o3d.utility.Vector3dVector(tree_pointcloud.points)
+        pcd.points = o3d.utility.Vector3dVector(
+            tree_pointcloud.points_array.astype(np.float64)
+        )
         o3d_mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_ball_pivoting(
             pcd, o3d.utility.DoubleVector([0.01, 0.1])
         )
     elif meshing_method == MeshingMethod.ALPHA:
-        pcd.points = o3d.utility.Vector3dVector(tree_pointcloud.points)
+        pcd.points = o3d.utility.Vector3dVector(
+            tree_pointcloud.points_array.astype(np.float64)
+        )
         o3d_mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_alpha_shape(
             pcd, alpha=alpha
         )
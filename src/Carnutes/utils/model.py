@@ -6,7 +6,8 @@ from dataclasses import dataclass
 import typing
 import numpy as np
 
-from utils import graphs, element
+from utils import graphs, element, geometry
+from packing import packing_combinatorics
 
 
 @dataclass
@@ -57,3 +58,60 @@ class Model(object):
         """
         for element in self.elements:
             element.allocate_trees()
+
+    def allocate_trees(
+        self,
+        database,
+        optimisation_basis: int = None,
+        commit_every: int = None,
+        mode: packing_combinatorics.AllocationMode = packing_combinatorics.AllocationMode.GREEDY,
+    ):
+        """
+        Allocate trees to all the elements of the model in one batch.
+        The database is trimmed in memory and committed at the end (or every @commit_every elements), instead of once per element.
+
+        :param database: str or DatabaseReader
+            The path to the tree database, or an open DatabaseReader session.
+        :param optimisation_basis: int, optional
+            If given, the optimized search is used with this optimisation basis. Only used in GREEDY mode.
+        :param commit_every: int, optional
+            The number of elements after which the changes are committed. By default, they are committed once at the end. Only used in GREEDY mode.
+        :param mode: AllocationMode
+            GREEDY (default) allocates the elements one after the other, in the order of the model.
+            GLOBAL allocates them all together, see packing_combinatorics.allocate_elements_globally.
+            PACKING packs several elements per tree, see packing_combinatorics.pack_elements_on_trees.
+
+        :return: allocated_elements: list of Element
+            The elements trees were searched for (point elements are skipped).
+        :return: allocations: list of tuples (best_tree, best_target, best_rmse, best_init_rotation)
+            The allocation of each of those elements, only None values if no tree was found.
+        """
+        allocated_elements = [
+            e for e in self.elements if e.type != element.ElementType.Point
+        ]
+        reference_skeletons = [
+            geometry.Pointcloud(geometry.sort_points(e.locations))
+            for e in allocated_elements
+        ]
+        if mode == packing_combinatorics.AllocationMode.GLOBAL:
+            allocations, _, _ = packing_combinatorics.allocate_elements_globally(
+                reference_skeletons,
+                [e.diameter for e in allocated_elements],
+                database,
+            )
+            return allocated_elements, allocations
+        if mode == packing_combinatorics.AllocationMode.PACKING:
+            allocations = packing_combinatorics.pack_elements_on_trees(
+                reference_skeletons,
+                [e.diameter for e in allocated_elements],
+                database,
+            )
+            return allocated_elements, allocations
+        allocations = packing_combinatorics.allocate_elements(
+            reference_skeletons,
+            [e.diameter for e in allocated_elements],
+            database,
+            optimisation_basis=optimisation_basis,
+            commit_every=commit_every,
+        )
+        return allocated_elements, allocations
@@ -5,10 +5,9 @@ Module storing the Tree class and the geometry classes
 #! python3
 
 import persistent
-from collections import defaultdict
 import copy
 
-from utils.geometry import Pointcloud, Mesh
+from utils.geometry import Pointcloud, ArrayPointcloud, Mesh
 from utils.geometrical_operations import *
 import utils.meshing as meshing
 
@@ -23,21 +22,90 @@ print("version of numpy is ", np.__version__)
 # The number of points of the tree skeleton
 SKELETON_LENGTH = 11
 
+# The parameters of the RANSAC fit of the circles of the skeleton
+RANSAC_DISTANCE_THRESHOLD = 0.01
+RANSAC_N = 3
+RANSAC_ITERATIONS = 1000
+
+
+class TreeSkeleton(object):
+    """
+    Lightweight view of a Tree, holding only what is needed to search the database.
+    The point cloud is not part of it, so it can be copied and modified freely during the search.
+
+    :param id: int
+        The id of the tree it was created from
+    :param skeleton: Pointcloud
+        A copy of the skeleton of the tree
+    :param skeleton_circles: list
+        A copy of the skeleton circles of the tree, as a list of tuples (center, radius)
+    :param mean_diameter: float
+        The mean diameter of the tree
+    :param height: float
+        The height of the tree
+    """
+
+    def __init__(
+        self,
+        id: int,
+        skeleton: Pointcloud,
+        skeleton_circles: list,
+        mean_diameter: float,
+        height: float,
+    ):
+        self.id = id
+        self.skeleton = skeleton
+        self.skeleton_circles = skeleton_circles
+        self.mean_diameter = mean_diameter
+        self.height = height
+
+    def __str__(self):
+        return f"Skeleton of tree {self.id}"
+
+
+def as_array_pointcloud(point_cloud: Pointcloud) -> ArrayPointcloud:
+    """
+    Convert a Pointcloud to an ArrayPointcloud. ArrayPointclouds (and None) are returned as they are.
+
+    :param point_cloud: Pointcloud
+        The point cloud to convert
+    :return: ArrayPointcloud
+        The point cloud stored as arrays
+    """
+    if point_cloud is None or isinstance(point_cloud, ArrayPointcloud):
+        return point_cloud
+    return ArrayPointcloud(point_cloud.points_array, point_cloud.colors_array)
+
+
+class PointcloudPayload(persistent.Persistent):
+    """
+    Persistent object holding the point cloud of a tree.
+    It is stored as its own record in the database, so it stays a ghost (not loaded) until the point cloud of the tree is accessed.
+
+    :param point_cloud: ArrayPointcloud
+        The point cloud of the tree
+    """
+
+    def __init__(self, point_cloud: ArrayPointcloud):
+        self.point_cloud = point_cloud
+
 
 class Tree(persistent.Persistent):
     """
     Tree class to store tree data.
-    The point cloud of the tree is stored as a list of points
+    The point cloud of the tree is stored as an ArrayPointcloud (float32 points and uint8 colors), in a separate PointcloudPayload.
+    Loading a tree from the database therefore only loads its skeleton and metadata, the points are loaded when point_cloud is accessed.
     :param tree_id
         The id of the tree
     :param tree_name
         The name of the tree
     :param tree_point_cloud
-        The point cloud of the tree as a list of lists of 3 coordinates
-    :param point_cloud_colors
-        The colors of the point cloud as a list of lists of 3 colors. None by default.
+        The point cloud of the tree. Other Pointclouds are converted to an ArrayPointcloud.
     :param tree_skeleton
         The skeleton of the tree as a list of lists of 3 coordinates. None by default.
+
+    The scan_hash attribute holds the hash of the scan the tree was created from, when it was ingested with utils.database_ingestion.
+    The parent_id attribute holds, for an offcut (see trim), the id of the scanned tree it was first cut from, None otherwise.
     """
 
     def __init__(
@@ -49,67 +117,148 @@ class Tree(persistent.Persistent):
         self.skeleton = skeleton
         self.mean_diameter = None
         self.height = None
+        self.scan_hash = None
+        self.parent_id = None
 
-    def _p_resolveConflict(self, oldState, savedState, newState):
+    @property
+    def point_cloud(self) -> ArrayPointcloud:
         """
-        Resolve conflicts when saving the object
+        The point cloud of the tree. Accessing it loads the payload from the database.
+        Trees of databases created before the payload existed store it inline, it is returned as it is.
         """
-        savedDiff = savedState["point_cloud"] - oldState["point_cloud"]
-        newDiff = newState["point_cloud"] - oldState["point_cloud"]
-
-        if savedDiff == newDiff:
-            return newState
+        payload = self.__dict__.get("_payload")
+        if payload is None:
+            return self.__dict__.get("point_cloud")
+        return payload.point_cloud
+
+    @point_cloud.setter
+    def point_cloud(self, point_cloud: Pointcloud):
+        point_cloud = as_array_pointcloud(point_cloud)
+        payload = self.__dict__.get("_payload")
+        if payload is None:
+            self.__dict__.pop("point_cloud", None)
+            self._payload = PointcloudPayload(point_cloud)
         else:
-            return oldState  # testing this one out
+            payload.point_cloud = point_cloud
 
-    def compute_skeleton(self):
+    @property
+    def original_id(self) -> int:
+        """
+        The id of the scanned tree this tree comes from: its parent_id for an offcut, its own id otherwise.
+        Trees of databases created before offcuts had a parent_id are their own original.
+        """
+        parent_id = getattr(self, "parent_id", None)
+        return self.id if parent_id is None else parent_id
+
+    def load_point_cloud(self) -> ArrayPointcloud:
+        """
+        Explicitly load the point cloud payload of the tree, e.g. before the tree is copied out of the database.
+
+        :return: ArrayPointcloud
+            The point cloud of the tree
+        """
+        payload = self.__dict__.get("_payload")
+        if payload is not None:
+            payload._p_activate()
+        return self.point_cloud
+
+    def compute_skeleton(
+        self,
+        circle_fitting_method: CircleFittingMethod = CircleFittingMethod.RANSAC,
+        robust_iterations: int = 0,
+    ):
         """
         Compute the skeleton of the point cloud .
         For now it is done in a rather sloppy way. this is because pc_skeletor is currently causing issues
 
         To Do: make this actually professional
+
+        :param circle_fitting_method: CircleFittingMethod, optional
+            The method used to fit the circles of the slices. The default is RANSAC.
+            ALGEBRAIC fits all the slices at once and is much faster.
+        :param robust_iterations: int, optional
+            The number of reweighted fits of the ALGEBRAIC method. The default is 0.
         """
         skeleton_points_as_list = []
         skeleton_circles_as_list = []  # list of tuples (center, radius)
 
         o3d_pc = o3d.geometry.PointCloud()
-        o3d_pc.points = o3d.utility.Vector3dVector(self.point_cloud.points)
+        o3d_pc.points = o3d.utility.Vector3dVector(
+            self.point_cloud.points_array.astype(np.float64)
+        )
 
         oriented_bounding_box = o3d_pc.get_oriented_bounding_box()
         min_bound = oriented_bounding_box.get_min_bound()[2]
         pc_height = oriented_bounding_box.get_max_bound()[2] - min_bound
         self.height = pc_height
 
-        segments = defaultdict(list)
-        for point in np.asarray(o3d_pc.points):
-            relative_height = point[2] - min_bound
-            # We create 10 indexes along the height of the point cloud (we assume the tree upwards)
-            index = int(round((SKELETON_LENGTH - 1) * relative_height / pc_height))
-            if index not in segments:
-                segments[index] = [point]
-            else:
-                segments[index].append(point)
-
-        for i in range(SKELETON_LENGTH):
-            # We compute the center of the segment
-            i_th_segment = segments[i]
-            center_point = i_th_segment[0]
-            for j in range(len(i_th_segment) - 1):
-                center_point += i_th_segment[j + 1]
-            center_point /= len(i_th_segment)
+        # We create 10 indexes along the height of the point cloud (we assume the tree upwards)
+        # Each point is put in its slice in one pass, rounding half to even like round()
+        points = np.asarray(o3d_pc.points)
+        relative_heights = points[:, 2] - min_bound
+        indexes = np.rint((SKELETON_LENGTH - 1) * relative_heights / pc_height).astype(
+            np.int64
+        )
+        counts = np.bincount(indexes, minlength=SKELETON_LENGTH)[:SKELETON_LENGTH]
+        if np.any(counts == 0):
+            raise ValueError(
+                f"The point cloud of tree {self.id} has empty slices, its skeleton can't be computed."
+            )
+
+        # We compute the center of each segment
+        center_points = (
+            np.stack(
+                [
+                    np.bincount(
+                        indexes, weights=points[:, k], minlength=SKELETON_LENGTH
+                    )[:SKELETON_LENGTH]
+                    for k in range(3)
+                ],
+                axis=1,
+            )
+            / counts[:, np.newaxis]
+        )
+
+        if circle_fitting_method == CircleFittingMethod.ALGEBRAIC:
+            in_skeleton = indexes < SKELETON_LENGTH
+            centers, radii = fit_circles_algebraic(
+                points[in_skeleton],
+                indexes[in_skeleton],
+                SKELETON_LENGTH,
+                robust_iterations=robust_iterations,
+            )
+            self.skeleton = Pointcloud(list(center_points))
+            self.skeleton_circles = [
+                (center, radius) for center, radius in zip(centers, radii)
+            ]
+            self.mean_diameter = np.mean(2 * radii)
+            self._group_points_by_slice(indexes)
+            return self.skeleton
+
+        # The points sorted by segment, keeping their order within each segment
+        order = np.argsort(indexes, kind="stable")
+        order = order[indexes[order] < SKELETON_LENGTH]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # The previous implementation accumulated the center into the first point of each segment,
+        # which then took part in the circle fit. It is kept so that the circles stay the same.
+        points = points.copy()
+        points[order[starts]] = center_points
+
+        for i, i_th_segment in enumerate(np.split(points[order], starts[1:])):
+            center_point = center_points[i]
             skeleton_points_as_list.append(center_point)
 
             # We project the segment to the plane defined by the center point and the z axis as normal
-            i_th_projected_points = project_points_to_plane(
+            i_th_projected_points = project_points_to_plane_array(
                 i_th_segment, center_point, [0, 0, 1]
             )
 
             # We fit a circle to the projected points
             i_th_circle_parameters = fit_circle_with_open3d(
                 i_th_projected_points,
-                distance_threshold=0.01,
-                ransac_n=3,
-                num_iterations=1000,
+                distance_threshold=RANSAC_DISTANCE_THRESHOLD,
+                ransac_n=RANSAC_N,
+                num_iterations=RANSAC_ITERATIONS,
             )
             skeleton_circles_as_list.append(i_th_circle_parameters)
 
@@ -118,9 +267,45 @@ class Tree(persistent.Persistent):
         self.mean_diameter = np.mean(
             [2 * circle[1] for circle in skeleton_circles_as_list]
         )
+        self._group_points_by_slice(indexes)
 
         return self.skeleton
 
+    def _group_points_by_slice(self, indexes: np.ndarray):
+        """
+        Sort the points of the tree by the slice of the skeleton they belong to, keeping their order within each slice,
+        and group them in one segment per skeleton point (see ArrayPointcloud.segment_offsets).
+        """
+        indexes = np.clip(indexes, 0, SKELETON_LENGTH - 1)
+        order = np.argsort(indexes, kind="stable")
+        counts = np.bincount(indexes, minlength=SKELETON_LENGTH)
+        point_cloud = as_array_pointcloud(self.point_cloud)
+        self.point_cloud = ArrayPointcloud(
+            point_cloud.points_array[order],
+            (
+                None
+                if point_cloud.colors_array is None
+                else point_cloud.colors_array[order]
+            ),
+            np.concatenate([[0], np.cumsum(counts)]),
+        )
+
+    def get_skeleton_view(self) -> TreeSkeleton:
+        """
+        Get a skeleton-only view of the tree, without its point cloud.
+        The skeleton and the circles are copied, so the view can be modified without affecting the tree.
+
+        :return: TreeSkeleton
+            The skeleton-only view of the tree
+        """
+        return TreeSkeleton(
+            self.id,
+            Pointcloud([list(point) for point in self.skeleton.points]),
+            [(copy.copy(circle[0]), circle[1]) for circle in self.skeleton_circles],
+            self.mean_diameter,
+            self.height,
+        )
+
     def align_to_skeleton(self, reference_skeleton, initial_rotation=None):
         """
         Align the tree to a reference skeleton using ICP
@@ -129,8 +314,6 @@ class Tree(persistent.Persistent):
         :param initial_rotation: np.array (4,4), optional
             The initial rotation matrix to use for the ICP registration. None by default.
         """
-        tree_pc = o3d.geometry.PointCloud()
-        tree_pc.points = o3d.utility.Vector3dVector(np.array(self.point_cloud.points))
         skeleton_pc = o3d.geometry.PointCloud()
         skeleton_pc.points = o3d.utility.Vector3dVector(np.array(self.skeleton.points))
         skeleton_pc.estimate_normals()
@@ -150,7 +333,6 @@ class Tree(persistent.Persistent):
         t_skeleton_to_origin[1, 3] = -skeleton_pc.points[0][1]
         t_skeleton_to_origin[2, 3] = -skeleton_pc.points[0][2]
 
-        tree_pc.translate(-skeleton_pc.points[0])
         skeleton_pc.translate(-skeleton_pc.points[0])
         reference_pc.translate(-reference_pc.points[0])
 
@@ -175,27 +357,38 @@ class Tree(persistent.Persistent):
         transformation = np.dot(
             t_origin_to_reference, np.dot(result.transformation, t_skeleton_to_origin)
         )
-        tree_pc = copy.deepcopy(tree_pc)
+        self.transform(transformation)
 
+    def transform(self, transformation):
+        """
+        Apply a rigid transformation to the tree, in place: its points, skeleton and skeleton circles.
+        Each of them is transformed with a single matrix product.
+
+        :param transformation: np.array (4,4)
+            The transformation matrix
+        """
         # Assuming an affine transformation
         rotation = transformation[:3, :3]
         translation = transformation[:3, 3]
 
-        new_pointcloud_as_list = []
-        new_colors_as_list = self.point_cloud.colors
-        new_skeleton_as_list = []
-
-        for point in self.point_cloud.points:
-            point = np.dot(rotation, point) + translation
-            new_pointcloud_as_list.append([point[0], point[1], point[2]])
-
-        self.point_cloud = Pointcloud(new_pointcloud_as_list, new_colors_as_list)
-
-        for point in self.skeleton.points:
-            point = np.dot(rotation, point) + translation
-            new_skeleton_as_list.append([point[0], point[1], point[2]])
+        point_cloud = as_array_pointcloud(self.point_cloud)
+        points = point_cloud.points_array
+        points[:] = points @ rotation.T + translation
+        point_cloud.set_segments(point_cloud.segment_offsets)
+        # assigning it again marks the payload as changed
+        self.point_cloud = point_cloud
 
-        self.skeleton = Pointcloud(new_skeleton_as_list)
+        skeleton_points = np.asarray(self.skeleton.points, dtype=np.float64)
+        self.skeleton = Pointcloud(
+            list(skeleton_points.reshape(-1, 3) @ rotation.T + translation)
+        )
+        if len(self.skeleton_circles) > 0:
+            centers = np.array([circle[0] for circle in self.skeleton_circles])
+            centers = centers @ rotation.T + translation
+            self.skeleton_circles = [
+                (center, circle[1])
+                for center, circle in zip(centers, self.skeleton_circles)
+            ]
 
     def create_mesh(self, alpha=2):
         """
@@ -207,77 +400,353 @@ class Tree(persistent.Persistent):
             self.point_cloud, meshing.MeshingMethod.ALPHA, alpha=alpha
         )
 
-    def trim(self, skeleton_to_remove):
+    def trim(self, skeleton_to_remove) -> list:
         """
-        Trim the tree by removing all the that are within the range of the skeleton_to_remove
+        Trim the tree by removing all the points that are within the range of the skeleton_to_remove.
+        If the range is in the middle of the tree, what is left is split in two offcuts instead of being kept as one
+        tree with a discontinuous skeleton: the tree keeps the part with the most skeleton points, and the other part
+        is returned as a new Tree with its own points, skeleton, circles, height and mean diameter (also recomputed for the tree).
+        Its id is None until it is added to a database (see DatabaseReader.add_tree), and its parent_id is the original_id of the tree.
+        Parts with less than 2 skeleton points are dropped.
+        When the points are grouped by skeleton slice, whole slices are kept or removed from their bounds, only the points
+        of the slices crossing the ends of the range are tested, and the kept points of a removed slice join the nearest kept slice.
         :param skeleton_to_remove: Pointcloud
             The skeleton to remove
+        :return: offcuts: list of Tree
+            The other part of the tree, if it was split. Empty otherwise.
         """
         # First indicate that the object has been changed
         self._p_changed = 1
 
-        # Then remove the points that are within the range of the skeleton_to_remove, with a 10% margin of safety:
-        x_max_bounds = max([point[0] for point in skeleton_to_remove.points])
-        x_min_bounds = min([point[0] for point in skeleton_to_remove.points])
-        delta_x = x_max_bounds - x_min_bounds
-        x_max_bounds += 0.1 * delta_x
-        x_min_bounds -= 0.1 * delta_x
-        y_max_bounds = max([point[1] for point in skeleton_to_remove.points])
-        y_min_bounds = min([point[1] for point in skeleton_to_remove.points])
-        delta_y = y_max_bounds - y_min_bounds
-        y_max_bounds += 0.1 * delta_y
-        y_min_bounds -= 0.1 * delta_y
-        z_max_bounds = max([point[2] for point in skeleton_to_remove.points])
-        z_min_bounds = min([point[2] for point in skeleton_to_remove.points])
-        delta_z = z_max_bounds - z_min_bounds
-        z_max_bounds += 0.1 * delta_z
-        z_min_bounds -= 0.1 * delta_z
-        new_skeleton = []
-        new_points = []
-        new_colors = []
-        new_circles = []
-        if delta_x > delta_y and delta_x > delta_z:  # meaning that the main axis is x
-            for i, point in enumerate(self.point_cloud.points):
-                if point[0] < x_min_bounds or x_max_bounds < point[0]:
-                    new_points.append(point)
-                    new_colors.append(self.point_cloud.colors[i])
-            for point in self.skeleton.points:
-                if point[0] < x_min_bounds or x_max_bounds < point[0]:
-                    new_skeleton.append(point)
-            for circle in self.skeleton_circles:
-                if circle[0][0] < x_min_bounds or x_max_bounds < circle[0][0]:
-                    new_circles.append(circle)
-        elif delta_y > delta_x and delta_y > delta_z:  # meaning that the main axis is y
-            for i, point in enumerate(self.point_cloud.points):
-                if point[1] < y_min_bounds or y_max_bounds < point[1]:
-                    new_points.append(point)
-                    new_colors.append(self.point_cloud.colors[i])
-            for point in self.skeleton.points:
-                if point[1] < y_min_bounds or y_max_bounds < point[1]:
-                    new_skeleton.append(point)
-            for circle in self.skeleton_circles:
-                if circle[0][1] < y_min_bounds or y_max_bounds < circle[0][1]:
-                    new_circles.append(circle)
-        elif delta_z > delta_x and delta_z > delta_y:  # meaning that the main axis is z
-            for i, point in enumerate(self.point_cloud.points):
-                if point[2] < z_min_bounds or z_max_bounds < point[2]:
-                    new_points.append(point)
-                    new_colors.append(self.point_cloud.colors[i])
-            for point in self.skeleton.points:
-                if point[2] < z_min_bounds or z_max_bounds < point[2]:
-                    new_skeleton.append(point)
-            for circle in self.skeleton_circles:
-                if circle[0][2] < z_min_bounds or z_max_bounds < circle[0][2]:
-                    new_circles.append(circle)
-        self.point_cloud.points = new_points
-        self.point_cloud.colors = new_colors
-        self.skeleton.points = new_skeleton
-        self.skeleton_circles = new_circles
-
-        if len(self.point_cloud.points) > 1:
-            self.height = max([point[2] for point in self.point_cloud.points]) - min(
-                [point[2] for point in self.point_cloud.points]
+        # Then remove the points that are within the range of the skeleton_to_remove along its main axis, with a 10% margin of safety:
+        skeleton_to_remove = np.asarray(skeleton_to_remove.points, dtype=np.float64)
+        max_bounds = np.max(skeleton_to_remove, axis=0)
+        min_bounds = np.min(skeleton_to_remove, axis=0)
+        deltas = max_bounds - min_bounds
+        max_bounds += 0.1 * deltas
+        min_bounds -= 0.1 * deltas
+        main_axis = int(np.argmax(deltas))
+        # without a single main axis, nothing is kept
+        has_main_axis = np.count_nonzero(deltas == deltas[main_axis]) == 1
+
+        def get_sides(coordinates):
+            """
+            Whether the coordinates are before and after the range, along the main axis.
+            """
+            coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+            return (
+                has_main_axis & (coordinates[:, main_axis] < min_bounds[main_axis]),
+                has_main_axis & (max_bounds[main_axis] < coordinates[:, main_axis]),
+            )
+
+        point_cloud = as_array_pointcloud(self.point_cloud)
+        skeleton_points = np.asarray(self.skeleton.points, dtype=np.float64)
+        skeleton_sides = get_sides(skeleton_points)
+        circles_sides = get_sides([circle[0] for circle in self.skeleton_circles])
+        is_grouped = _is_grouped_by_slice(point_cloud, len(skeleton_points))
+        if has_main_axis:
+            points_sides = _get_segment_sides(
+                point_cloud,
+                is_grouped,
+                main_axis,
+                min_bounds[main_axis],
+                max_bounds[main_axis],
+            )
+        else:
+            n_segments = len(skeleton_points) if is_grouped else 1
+            points_sides = tuple([_EMPTY_INDICES] * n_segments for _ in range(2))
+
+        # the parts that keep the tree and the offcut, if both sides hold skeleton points
+        n_skeleton_points = [np.count_nonzero(side) for side in skeleton_sides]
+        if min(n_skeleton_points) == 0:
+            parts = [
+                (
+                    [
+                        _merge_indices(before, after)
+                        for before, after in zip(*points_sides)
+                    ],
+                    skeleton_sides[0] | skeleton_sides[1],
+                    circles_sides[0] | circles_sides[1],
+                )
+            ]
+        else:
+            parts = list(zip(points_sides, skeleton_sides, circles_sides))
+            if n_skeleton_points[1] > n_skeleton_points[0]:
+                parts.reverse()
+
+        def take_part(points_to_keep, skeleton_to_keep, in_place=False):
+            """
+            The point cloud of a part, grouped by the slices of its skeleton if the tree is.
+            """
+            if not is_grouped or not np.any(skeleton_to_keep):
+                return _take_segments(point_cloud, points_to_keep, in_place=in_place)
+            return _take_segments(
+                point_cloud,
+                points_to_keep,
+                _get_nearest_kept_segments(skeleton_to_keep),
+                np.count_nonzero(skeleton_to_keep),
+                in_place,
             )
 
+        offcuts = []
+        for points_to_keep, skeleton_to_keep, circles_to_keep in parts[1:]:
+            if np.count_nonzero(skeleton_to_keep) < 2:
+                continue
+            offcut = Tree(
+                None,
+                f"{self.name}_offcut",
+                take_part(points_to_keep, skeleton_to_keep),
+            )
+            offcut.parent_id = self.original_id
+            offcut._keep_part(self, skeleton_to_keep, circles_to_keep)
+            offcuts.append(offcut)
+
+        points_to_keep, skeleton_to_keep, circles_to_keep = parts[0]
+        # assigning it again marks the payload as changed
+        self.point_cloud = take_part(points_to_keep, skeleton_to_keep, in_place=True)
+        self._keep_part(self, skeleton_to_keep, circles_to_keep, len(parts) > 1)
+        return offcuts
+
+    def _keep_part(
+        self,
+        tree,
+        skeleton_to_keep: np.ndarray,
+        circles_to_keep: np.ndarray,
+        update_mean_diameter: bool = True,
+    ):
+        """
+        Set the skeleton and circles of this tree to a part of those of a tree (possibly itself), and update its height
+        from its point cloud, as well as its mean diameter if asked.
+        """
+        self.skeleton = Pointcloud(
+            [
+                point
+                for point, keep in zip(tree.skeleton.points, skeleton_to_keep)
+                if keep
+            ]
+        )
+        self.skeleton_circles = [
+            circle
+            for circle, keep in zip(tree.skeleton_circles, circles_to_keep)
+            if keep
+        ]
+        point_cloud = self.point_cloud
+        points = point_cloud.points_array
+        if len(points) > 1 and point_cloud.segment_bounds is not None:
+            self.height = float(
+                np.max(point_cloud.segment_bounds[:, 1, 2])
+                - np.min(point_cloud.segment_bounds[:, 0, 2])
+            )
+        elif len(points) > 1:
+            self.height = float(np.ptp(points[:, 2]))
+        elif self.height is None:
+            self.height = 0.0
+        if update_mean_diameter:
+            self.mean_diameter = (
+                float(np.mean([2 * circle[1] for circle in self.skeleton_circles]))
+                if len(self.skeleton_circles) > 0
+                else tree.mean_diameter
+            )
+
+    def crop(self, axis_polyline, radius: float):
+        """
+        Crop the tree to the capsule around a polyline, e.g. the axis of the element it was allocated to, in place.
+        The points further than @radius from the polyline are removed.
+        When the points are grouped by skeleton slice, the slices whose bounding box is entirely outside or inside
+        the capsule are dropped or kept without testing their points.
+
+        :param axis_polyline: list of list of float or np.array (M,3)
+            The vertices of the polyline
+        :param radius: float
+            The radius of the capsule
+        """
+        point_cloud = as_array_pointcloud(self.point_cloud)
+        points = point_cloud.points_array
+        offsets = point_cloud.segment_offsets
+        if offsets is None:
+            points_to_keep = [
+                np.flatnonzero(distance_to_polyline(points, axis_polyline) <= radius)
+            ]
+            self.point_cloud = _take_segments(
+                point_cloud, points_to_keep, in_place=True
+            )
+            return
+
+        bounds = point_cloud.segment_bounds
+        is_empty = offsets[1:] == offsets[:-1]
+        centers = np.where(is_empty[:, np.newaxis], 0.0, bounds.mean(axis=1))
+        half_diagonals = np.where(
+            is_empty, 0.0, np.linalg.norm(bounds[:, 1] - bounds[:, 0], axis=1) / 2
+        )
+        center_distances = distance_to_polyline(centers, axis_polyline)
+        points_to_keep = []
+        for k, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            if is_empty[k] or center_distances[k] - half_diagonals[k] > radius:
+                points_to_keep.append(_EMPTY_INDICES)
+            elif center_distances[k] + half_diagonals[k] <= radius:
+                points_to_keep.append(slice(start, end))
+            else:
+                distances = distance_to_polyline(points[start:end], axis_polyline)
+                points_to_keep.append(start + np.flatnonzero(distances <= radius))
+        # assigning it again marks the payload as changed
+        self.point_cloud = _take_segments(
+            point_cloud,
+            points_to_keep,
+            np.arange(len(is_empty)),
+            len(is_empty),
+            in_place=True,
+        )
+
     def __str__(self):
         return f"Tree {self.id} - {self.name}"
+
+
+_EMPTY_INDICES = np.empty(0, dtype=np.int64)
+
+
+def _is_grouped_by_slice(point_cloud: ArrayPointcloud, n_skeleton_points: int) -> bool:
+    """
+    Whether the points of a tree are grouped in one segment per skeleton point.
+    Trees created before the points were grouped are not.
+    """
+    offsets = point_cloud.segment_offsets
+    return offsets is not None and len(offsets) == n_skeleton_points + 1
+
+
+def _get_segment_sides(
+    point_cloud: ArrayPointcloud,
+    is_grouped: bool,
+    axis: int,
+    min_bound: float,
+    max_bound: float,
+) -> tuple:
+    """
+    Find the points before and after a range along an axis, segment by segment.
+    A segment whose bounding box is entirely on one side of the range, or within it, is classified as a whole,
+    only the points of the segments crossing the ends of the range are tested.
+    The points of a point cloud which is not grouped are all tested, as a single segment.
+
+    :return: before, after: lists of slices or np.array of int
+        The points before and after the range of each segment, as slices for whole segments and sorted indices otherwise
+    """
+    points = point_cloud.points_array
+    if is_grouped:
+        offsets = point_cloud.segment_offsets
+        bounds = point_cloud.segment_bounds[:, :, axis]
+    else:
+        offsets = np.array([0, len(points)])
+        bounds = np.array([[-np.inf, np.inf]])
+
+    before, after = [], []
+    for (start, end), (lower, upper) in zip(zip(offsets[:-1], offsets[1:]), bounds):
+        if upper < min_bound:
+            before.append(slice(start, end))
+            after.append(_EMPTY_INDICES)
+        elif max_bound < lower:
+            before.append(_EMPTY_INDICES)
+            after.append(slice(start, end))
+        elif min_bound <= lower and upper <= max_bound:
+            before.append(_EMPTY_INDICES)
+            after.append(_EMPTY_INDICES)
+        else:
+            coordinates = points[start:end, axis].astype(np.float64)
+            before.append(start + np.flatnonzero(coordinates < min_bound))
+            after.append(start + np.flatnonzero(max_bound < coordinates))
+    return before, after
+
+
+def _count_indices(indices) -> int:
+    """
+    The number of points selected by a slice or an array of indices.
+    """
+    if isinstance(indices, slice):
+        return indices.stop - indices.start
+    return len(indices)
+
+
+def _merge_indices(first, second):
+    """
+    Merge two selections of distinct points (slices or sorted arrays of indices) into one, sorted.
+    """
+    if _count_indices(second) == 0:
+        return first
+    if _count_indices(first) == 0:
+        return second
+    return np.sort(
+        np.concatenate(
+            [
+                (
+                    np.arange(indices.start, indices.stop)
+                    if isinstance(indices, slice)
+                    else indices
+                )
+                for indices in (first, second)
+            ]
+        )
+    )
+
+
+def _get_nearest_kept_segments(skeleton_to_keep: np.ndarray) -> np.ndarray:
+    """
+    For each skeleton point, the index among the kept skeleton points of the nearest one (the first one on ties).
+    It is the slice the points of each slice go to when some skeleton points are removed.
+    """
+    kept = np.flatnonzero(skeleton_to_keep)
+    positions = np.arange(len(skeleton_to_keep))
+    next_kept = np.minimum(np.searchsorted(kept, positions), len(kept) - 1)
+    previous_kept = np.maximum(next_kept - 1, 0)
+    return np.where(
+        np.abs(kept[previous_kept] - positions) <= np.abs(kept[next_kept] - positions),
+        previous_kept,
+        next_kept,
+    )
+
+
+def _take_segments(
+    point_cloud: ArrayPointcloud,
+    points_to_keep: list,
+    new_segments: np.ndarray = None,
+    n_new_segments: int = 0,
+    in_place: bool = False,
+) -> ArrayPointcloud:
+    """
+    Create a point cloud from some of the points of each segment of a point cloud.
+
+    :param point_cloud: ArrayPointcloud
+        The point cloud
+    :param points_to_keep: list of slices or np.array of int
+        The points to keep of each segment, as a slice or sorted indices
+    :param new_segments: np.array of int, optional
+        The segment of the new point cloud the points of each segment go to, in increasing order.
+        The new point cloud is not grouped without it.
+    :param n_new_segments: int, optional
+        The number of segments of the new point cloud
+    :param in_place: bool, optional
+        Whether to replace the points of @point_cloud instead of creating a new point cloud. False by default.
+    :return: ArrayPointcloud
+        The new point cloud, or @point_cloud if in place
+    """
+    segment_offsets = None
+    if new_segments is not None:
+        counts = np.bincount(
+            new_segments,
+            weights=[_count_indices(indices) for indices in points_to_keep],
+            minlength=n_new_segments,
+        ).astype(np.int64)
+        segment_offsets = np.concatenate([[0], np.cumsum(counts)])
+    # whole segments are copied as blocks
+    points = np.concatenate(
+        [point_cloud.points_array[_EMPTY_INDICES]]
+        + [point_cloud.points_array[indices] for indices in points_to_keep]
+    )
+    colors = point_cloud.colors_array
+    if colors is not None:
+        colors = np.concatenate(
+            [colors[_EMPTY_INDICES]] + [colors[indices] for indices in points_to_keep]
+        )
+    if not in_place:
+        return ArrayPointcloud(points, colors, segment_offsets)
+    point_cloud.points_array = points
+    point_cloud.colors_array = colors
+    point_cloud.set_segments(segment_offsets)
+    return point_cloud
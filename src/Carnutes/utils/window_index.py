@@ -0,0 +1,464 @@
+"""
+Module for the window index of the database.
+The window index holds a descriptor of windows of the skeletons of the trees, of several lengths and starting at regular steps
+along the skeletons, in a k-d tree, so that the windows most similar to a model element are retrieved in logarithmic time,
+without scanning the trees of the database.
+
+The descriptor of a window only depends on its shape, not on its position or orientation in space. The window is resampled
+at DESCRIPTOR_POINTS points evenly spread along it, and described by its arc length, the turning angles at the inner points,
+the ratio of its chord to its arc length and its diameter at each point. Each component is divided by its scale
+(see DESCRIPTOR_SCALES), so that the euclidean distance between descriptors weighs them evenly.
+
+```
+window of length l:       descriptor:
+p0                        l, the arc length
+ \                        a1, a2, a3, the turning angles at p1, p2, p3
+  p1                      |p0 p4| / l, the chord / arc length ratio
+  |  <- a1                d0 ... d4, the diameters at p0 ... p4
+  p2
+ /
+p3
+|
+p4
+```
+
+The k-d tree is not rebuilt each time a tree of the database changes: the windows of the trees stored since the last build
+are kept aside and compared to the queries one by one, and the windows of the trees changed or removed since are skipped.
+It is rebuilt once the windows kept aside or skipped reach REBUILD_FRACTION of the windows of the k-d tree.
+"""
+
+#! python3
+
+import typing
+
+import numpy as np
+import persistent
+
+# Bump this when the windows or their descriptors change, to rebuild the window indexes of the databases
+WINDOW_INDEX_VERSION = 1
+
+# The number of points each window is resampled at to compute its descriptor
+DESCRIPTOR_POINTS = 5
+
+# The length of the shortest windows, in meters. The next lengths grow by WINDOW_LENGTH_RATIO, up to the whole skeleton.
+MIN_WINDOW_LENGTH = 1.0
+WINDOW_LENGTH_RATIO = 1.5
+
+# The step between the starts of the windows of the same length, as a fraction of that length.
+# The windows anchored at the end of the skeleton are indexed as well.
+WINDOW_STEP_RATIO = 0.5
+
+# The scales of the components of the descriptors: arc length (m), turning angles (rad), chord / arc length ratio, diameters (m)
+DESCRIPTOR_SCALES = (0.1, 0.05, 0.01, 0.05)
+
+# The fraction of the windows of the k-d tree that can be changed before it is rebuilt
+REBUILD_FRACTION = 0.1
+
+# The size of a descriptor: arc length, inner turning angles, chord / arc length ratio, diameters
+DESCRIPTOR_SIZE = 1 + (DESCRIPTOR_POINTS - 2) + 1 + DESCRIPTOR_POINTS
+
+
+def compute_descriptors(
+    points: np.ndarray, arc_lengths: np.ndarray, diameters: np.ndarray
+) -> np.ndarray:
+    """
+    Compute the scaled descriptors of windows from their resampled points.
+
+    :param points: np.array (n_windows, DESCRIPTOR_POINTS, 3)
+        The points of each window, evenly spread along its arc length
+    :param arc_lengths: np.array (n_windows,)
+        The arc length of each window
+    :param diameters: np.array (n_windows, DESCRIPTOR_POINTS)
+        The diameter of the skeleton at each point
+    :return: descriptors: np.array (n_windows, DESCRIPTOR_SIZE)
+        The descriptors, divided by DESCRIPTOR_SCALES
+    """
+    arc_length_scale, angle_scale, ratio_scale, diameter_scale = DESCRIPTOR_SCALES
+    segments = np.diff(points, axis=1)
+    segment_lengths = np.linalg.norm(segments, axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        directions = segments / segment_lengths[..., np.newaxis]
+        cosines = np.sum(directions[:, :-1] * directions[:, 1:], axis=2)
+        chord_ratios = (
+            np.linalg.norm(points[:, -1] - points[:, 0], axis=1) / arc_lengths
+        )
+    # the points of a window of zero length have no direction, it is considered straight
+    turning_angles = np.arccos(np.clip(np.nan_to_num(cosines, nan=1.0), -1.0, 1.0))
+    chord_ratios = np.nan_to_num(chord_ratios, nan=1.0)
+    return np.concatenate(
+        [
+            arc_lengths[:, np.newaxis] / arc_length_scale,
+            turning_angles / angle_scale,
+            chord_ratios[:, np.newaxis] / ratio_scale,
+            diameters / diameter_scale,
+        ],
+        axis=1,
+    )
+
+
+def compute_element_descriptors(
+    element_points: np.ndarray, reference_diameter: float
+) -> np.ndarray:
+    """
+    Compute the descriptors of a model element, as if it were a window of a skeleton of the reference diameter,
+    in its given order and reversed, since the windows of the index are only described in the direction of their skeleton.
+
+    :param element_points: np.array (n_points, 3)
+        The points of the model element, e.g. its locations
+    :param reference_diameter: float
+        The diameter of the model element
+    :return: descriptors: np.array (2, DESCRIPTOR_SIZE)
+        The descriptors of the model element and of the reversed model element
+    """
+    element_points = np.asarray(element_points, dtype=np.float64)
+    element_points = np.stack([element_points, element_points[::-1]])
+    cumulative_lengths = _compute_cumulative_lengths(element_points[0])
+    element_length = cumulative_lengths[-1]
+    arc_positions = np.linspace(0.0, element_length, DESCRIPTOR_POINTS)
+    points = np.stack(
+        [
+            _interpolate_polyline(points, cumulative_lengths, arc_positions)
+            for points in element_points
+        ]
+    )
+    return compute_descriptors(
+        points,
+        np.full(2, element_length),
+        np.full((2, DESCRIPTOR_POINTS), reference_diameter),
+    )
+
+
+def compute_tree_windows(
+    features: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the windows of the skeleton of a tree and their descriptors, from its row of the feature index.
+    The trees whose circles don't match their skeleton points one to one are described with their mean diameter.
+
+    :param features: np.ndarray
+        The row of the tree in the feature index, see utils.feature_index
+    :return: starts: np.array (n_windows,)
+        The arc length from the first point of the skeleton to the start of each window
+    :return: lengths: np.array (n_windows,)
+        The arc length of each window
+    :return: descriptors: np.array (n_windows, DESCRIPTOR_SIZE)
+        The descriptors of the windows
+    """
+    n_points = int(features["n_skeleton_points"])
+    skeleton_length = float(features["skeleton_length"])
+    if n_points < 2 or not skeleton_length > 0:
+        return np.zeros(0), np.zeros(0), np.zeros((0, DESCRIPTOR_SIZE))
+    cumulative_lengths = features["cumulative_lengths"][:n_points]
+    skeleton_points = features["skeleton_points"][:n_points]
+
+    # the lengths of the grid shorter than the skeleton, and the whole skeleton
+    n_lengths = np.log(max(skeleton_length / MIN_WINDOW_LENGTH, 1.0)) / np.log(
+        WINDOW_LENGTH_RATIO
+    )
+    window_lengths = MIN_WINDOW_LENGTH * WINDOW_LENGTH_RATIO ** np.arange(
+        int(np.ceil(n_lengths))
+    )
+    window_lengths = np.append(
+        window_lengths[window_lengths < skeleton_length], skeleton_length
+    )
+    starts = []
+    lengths = []
+    for window_length in window_lengths:
+        last_start = skeleton_length - window_length
+        window_starts = np.arange(0.0, last_start, WINDOW_STEP_RATIO * window_length)
+        window_starts = np.append(window_starts, last_start)
+        starts.append(window_starts)
+        lengths.append(np.full(len(window_starts), window_length))
+    starts = np.concatenate(starts)
+    lengths = np.concatenate(lengths)
+
+    arc_positions = (
+        starts[:, np.newaxis]
+        + lengths[:, np.newaxis] * np.linspace(0.0, 1.0, DESCRIPTOR_POINTS)[np.newaxis]
+    )
+    points = _interpolate_polyline(skeleton_points, cumulative_lengths, arc_positions)
+    if int(features["n_circles"]) == n_points:
+        diameters = 2 * np.interp(
+            arc_positions, cumulative_lengths, features["radii"][:n_points]
+        )
+    else:
+        diameters = np.full(arc_positions.shape, float(features["mean_diameter"]))
+    return starts, lengths, compute_descriptors(points, lengths, diameters)
+
+
+def _compute_cumulative_lengths(points: np.ndarray) -> np.ndarray:
+    """
+    The arc length from the first point of a polyline to each of its points.
+    """
+    segment_lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    return np.concatenate([[0.0], np.cumsum(segment_lengths)])
+
+
+def _interpolate_polyline(
+    points: np.ndarray, cumulative_lengths: np.ndarray, arc_positions: np.ndarray
+) -> np.ndarray:
+    """
+    The points of a polyline at given arc lengths from its first point, of shape arc_positions.shape + (3,).
+    """
+    return np.stack(
+        [np.interp(arc_positions, cumulative_lengths, points[:, k]) for k in range(3)],
+        axis=-1,
+    )
+
+
+class WindowTable(persistent.Persistent):
+    """
+    Persistent object holding the windows of a build of the k-d tree, sorted by tree id.
+    It is stored as its own record in the database, so it is only written when the k-d tree is rebuilt.
+
+    :param tree_ids: np.array (n_windows,)
+        The id of the tree of each window
+    :param starts: np.array (n_windows,)
+        The start of each window along the skeleton of its tree
+    :param lengths: np.array (n_windows,)
+        The length of each window
+    :param descriptors: np.array (n_windows, DESCRIPTOR_SIZE)
+        The descriptors of the windows, kept in the k-d tree
+    """
+
+    def __init__(
+        self,
+        tree_ids: np.ndarray,
+        starts: np.ndarray,
+        lengths: np.ndarray,
+        descriptors: np.ndarray,
+    ):
+        import scipy.spatial
+
+        order = np.argsort(tree_ids, kind="stable")
+        self.tree_ids = tree_ids[order]
+        self.starts = starts[order]
+        self.lengths = lengths[order]
+        self.kd_tree = scipy.spatial.cKDTree(
+            descriptors[order].reshape(-1, DESCRIPTOR_SIZE)
+        )
+
+    def __len__(self):
+        return len(self.tree_ids)
+
+    @property
+    def descriptors(self) -> np.ndarray:
+        """
+        The descriptors of the windows, as stored in the k-d tree.
+        """
+        return self.kd_tree.data
+
+    def count_tree_windows(self, tree_id: int) -> int:
+        """
+        The number of windows of a tree in the table, in O(log n_windows).
+        """
+        return int(
+            np.searchsorted(self.tree_ids, tree_id, side="right")
+            - np.searchsorted(self.tree_ids, tree_id, side="left")
+        )
+
+
+class WindowIndex(persistent.Persistent):
+    """
+    The window index of a database: the windows of the skeletons of its trees and their descriptors (see the module documentation).
+    It is stored in root.window_index, see DatabaseReader.get_window_index.
+
+    Attributes:
+        version: int
+            The WINDOW_INDEX_VERSION the index was built with
+        table: WindowTable
+            The windows of the k-d tree
+        removed_ids: frozenset
+            The ids of the trees whose windows in the k-d tree are outdated
+        n_removed: int
+            The number of windows of the k-d tree that are outdated
+        pending_tree_ids, pending_starts, pending_lengths, pending_descriptors: np.array
+            The windows of the trees stored since the k-d tree was built
+
+    :param feature_index: np.ndarray
+        The feature index of the trees to index
+    """
+
+    def __init__(self, feature_index: np.ndarray):
+        self.version = WINDOW_INDEX_VERSION
+        windows = [_compute_windows_with_ids(features) for features in feature_index]
+        self._build(*_concatenate_windows(windows))
+
+    def _build(
+        self,
+        tree_ids: np.ndarray,
+        starts: np.ndarray,
+        lengths: np.ndarray,
+        descriptors: np.ndarray,
+    ):
+        """
+        Build the k-d tree from all the windows, and empty the windows kept aside.
+        """
+        self.table = WindowTable(tree_ids, starts, lengths, descriptors)
+        self.removed_ids = frozenset()
+        self.n_removed = 0
+        (
+            self.pending_tree_ids,
+            self.pending_starts,
+            self.pending_lengths,
+            self.pending_descriptors,
+        ) = _concatenate_windows([])
+
+    def __len__(self):
+        return len(self.table) - self.n_removed + len(self.pending_tree_ids)
+
+    def update_tree(self, features: np.ndarray):
+        """
+        Replace (or add) the windows of a tree.
+
+        :param features: np.ndarray
+            The row of the tree in the feature index
+        """
+        self.remove_tree(int(features["id"]))
+        tree_ids, starts, lengths, descriptors = _compute_windows_with_ids(features)
+        self.pending_tree_ids = np.concatenate([self.pending_tree_ids, tree_ids])
+        self.pending_starts = np.concatenate([self.pending_starts, starts])
+        self.pending_lengths = np.concatenate([self.pending_lengths, lengths])
+        self.pending_descriptors = np.concatenate(
+            [self.pending_descriptors, descriptors]
+        )
+        self._rebuild_if_needed()
+
+    def remove_tree(self, tree_id: int):
+        """
+        Remove the windows of a tree.
+
+        :param tree_id: int
+            The id of the tree
+        """
+        if tree_id not in self.removed_ids:
+            n_windows = self.table.count_tree_windows(tree_id)
+            if n_windows > 0:
+                self.removed_ids = self.removed_ids | {tree_id}
+                self.n_removed += n_windows
+        is_kept = self.pending_tree_ids != tree_id
+        if not np.all(is_kept):
+            self.pending_tree_ids = self.pending_tree_ids[is_kept]
+            self.pending_starts = self.pending_starts[is_kept]
+            self.pending_lengths = self.pending_lengths[is_kept]
+            self.pending_descriptors = self.pending_descriptors[is_kept]
+        self._rebuild_if_needed()
+
+    def _rebuild_if_needed(self):
+        """
+        Rebuild the k-d tree with the windows kept aside, once they are too many compared to the windows of the k-d tree.
+        """
+        n_changed = self.n_removed + len(self.pending_tree_ids)
+        if n_changed <= REBUILD_FRACTION * len(self.table):
+            return
+        is_kept = ~np.isin(self.table.tree_ids, list(self.removed_ids))
+        self._build(
+            np.concatenate([self.table.tree_ids[is_kept], self.pending_tree_ids]),
+            np.concatenate([self.table.starts[is_kept], self.pending_starts]),
+            np.concatenate([self.table.lengths[is_kept], self.pending_lengths]),
+            np.concatenate([self.table.descriptors[is_kept], self.pending_descriptors]),
+        )
+
+    def query(
+        self, descriptors: np.ndarray, n_windows: int
+    ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the windows closest to any of the given descriptors.
+
+        :param descriptors: np.array (n_descriptors, DESCRIPTOR_SIZE)
+            The descriptors to search, e.g. those of a model element (see compute_element_descriptors)
+        :param n_windows: int
+            The number of windows to get
+        :return: tree_ids: np.array (n,)
+            The id of the tree of each window, with n = min(n_windows, len(self))
+        :return: starts: np.array (n,)
+            The start of each window along the skeleton of its tree
+        :return: lengths: np.array (n,)
+            The length of each window
+        :return: distances: np.array (n,)
+            The distance of each window to the closest descriptor, in increasing order
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float64).reshape(
+            -1, DESCRIPTOR_SIZE
+        )
+        # the outdated windows of the k-d tree are skipped, so more of them are retrieved until there are enough up to date ones
+        n_queried = min(n_windows, len(self.table))
+        distances, rows = np.zeros(0), np.zeros(0, dtype=int)
+        while n_queried > 0:
+            distances, rows = self.table.kd_tree.query(descriptors, k=max(n_queried, 1))
+            distances = distances.reshape(-1)
+            rows = rows.reshape(-1)
+            is_found = rows < len(self.table)
+            distances, rows = distances[is_found], rows[is_found]
+            if self.n_removed > 0:
+                is_kept = ~np.isin(self.table.tree_ids[rows], list(self.removed_ids))
+                distances, rows = distances[is_kept], rows[is_kept]
+            if len(np.unique(rows)) >= n_windows or n_queried >= len(self.table):
+                break
+            n_queried = min(2 * n_queried, len(self.table))
+
+        # the windows kept aside are few, they are compared one by one
+        pending_distances = np.min(
+            np.linalg.norm(
+                self.pending_descriptors[np.newaxis] - descriptors[:, np.newaxis],
+                axis=2,
+            ),
+            axis=0,
+            initial=np.inf,
+        )
+        tree_ids = np.concatenate([self.table.tree_ids[rows], self.pending_tree_ids])
+        starts = np.concatenate([self.table.starts[rows], self.pending_starts])
+        lengths = np.concatenate([self.table.lengths[rows], self.pending_lengths])
+        distances = np.concatenate([distances, pending_distances])
+        # a window close to several descriptors is only kept once, at its smallest distance
+        order = np.argsort(distances, kind="stable")
+        _, first_rows = np.unique(
+            np.stack([tree_ids[order], starts[order], lengths[order]], axis=1),
+            axis=0,
+            return_index=True,
+        )
+        order = order[np.sort(first_rows)][:n_windows]
+        return tree_ids[order], starts[order], lengths[order], distances[order]
+
+
+def _compute_windows_with_ids(
+    features: np.ndarray,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The windows of a tree (see compute_tree_windows), with the id of the tree for each window.
+    """
+    starts, lengths, descriptors = compute_tree_windows(features)
+    return (
+        np.full(len(starts), int(features["id"]), dtype=np.int64),
+        starts,
+        lengths,
+        descriptors,
+    )
+
+
+def _concatenate_windows(
+    windows: typing.List[typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]],
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Concatenate the windows of several trees, see _compute_windows_with_ids.
+    """
+    if len(windows) == 0:
+        return (
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0),
+            np.zeros(0),
+            np.zeros((0, DESCRIPTOR_SIZE)),
+        )
+    return tuple(np.concatenate(arrays) for arrays in zip(*windows))
+
+
+def build_window_index(feature_index: np.ndarray) -> WindowIndex:
+    """
+    Build the window index of the trees of a feature index.
+
+    :param feature_index: np.ndarray
+        The feature index of the database, see utils.feature_index
+    :return: WindowIndex
+        The window index
+    """
+    return WindowIndex(feature_index)
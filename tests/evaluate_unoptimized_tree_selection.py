@@ -4,6 +4,7 @@
 # r: open3d==0.18.0
 # r: ZODB==6.0
 # r: igraph==0.11.6
+# r: scipy==1.13.1
 
 import os, sys, csv, argparse
 
@@ -13,20 +14,25 @@ sys.path.append(current_dir + "/../src/Carnutes")
 sys.path.append(current_dir)
 
 import generate_elements
-from packing import packing_combinatorics
-from utils import geometry
+from packing import packing_combinatorics, packing_manipulations
+from utils import geometry, database_reader
 from reset_database import main as reset_database
 
 import numpy as np
 
 
 def evaluate_unoptimized_tree_selection(
-    type: str, n_frames: int, reference_diameter: float
+    type: str,
+    n_frames: int,
+    reference_diameter: float,
+    registration_method: packing_manipulations.RegistrationMethod = packing_manipulations.RegistrationMethod.ICP,
 ):
     """
     we generate a number of frames, apply the tree selection, and evaluate the performance according to two metrics:
     - The number of trees used and their degree of use (% of the tree that is used)
     - The mean RMSE of the fitting over all the frames
+    The registration method is ICP by default, as for the published results: its rmse is the nearest neighbour inlier rmse of open3d,
+    while the KABSCH one is computed between the points matched by index, so the two are not comparable.
     """
 
     csv_file_elementwise = open("unoptimized_tree_selection_elementwise.csv", mode="w")
@@ -42,9 +48,10 @@ def evaluate_unoptimized_tree_selection(
         ["Tree", "number of elements", "length used", "initial tree length"]
     )
 
+    # the usage is counted on the scanned trees: the offcuts added to the database by the trims get new ids,
+    # their usage goes to the tree they were cut from (see Tree.original_id), relative to its length before any trim
     tree_number_usage = {}
     tree_length_usage = {}
-    tree_initial_length = {}
 
     RMSEs = []
 
@@ -71,43 +78,50 @@ def evaluate_unoptimized_tree_selection(
     elif type == "tower":
         list_of_elements_locations = generate_elements.generate_tower(n_floors=n_frames)
 
-    for element_locations in list_of_elements_locations:
-        element_length = np.linalg.norm(
-            np.asarray(element_locations[0]) - np.asarray(element_locations[-1])
+    # the database is opened once for the whole evaluation. The trims are kept in memory,
+    # so every evaluation starts from the same inventory and the database file is never modified.
+    with database_reader.DatabaseReader(db_path, in_memory=True) as reader:
+        features = reader.get_feature_index()
+        tree_initial_length = dict(
+            zip(features["id"].tolist(), features["height"].tolist())
         )
-        print(f"Element length: {element_length}")
-        element_pc = geometry.Pointcloud(element_locations)
-        (
-            best_tree,
-            best_target,
-            best_rmse,
-            best_init_rotation,
-        ) = packing_combinatorics.find_best_tree_unoptimized(
-            element_pc,
-            reference_diameter=reference_diameter,
-            database_path=db_path,
-            return_rmse=True,
-            update_database=True,
-        )
-        if best_tree is None:
-            csv_writer_elementwise.writerow([element_locations, "Failed", "Failed"])
-            print("No tree found. Skiping this element.")
-            continue
-        tree_length = best_tree.height
-        if best_tree.id not in tree_initial_length:
-            tree_initial_length[best_tree.id] = tree_length
-        csv_writer_elementwise.writerow(
-            [element_locations, element_length / tree_length, best_rmse]
-        )
-        print(f"Best tree: {best_tree}")
-        print(f"Best RMSE: {best_rmse}")
-        RMSEs.append(best_rmse)
-        if best_tree.id not in tree_number_usage and best_tree != None:
-            tree_number_usage[best_tree.id] = 1
-            tree_length_usage[best_tree.id] = element_length
-        else:
-            tree_number_usage[best_tree.id] += 1
-            tree_length_usage[best_tree.id] += element_length
+        for element_locations in list_of_elements_locations:
+            element_length = np.linalg.norm(
+                np.asarray(element_locations[0]) - np.asarray(element_locations[-1])
+            )
+            print(f"Element length: {element_length}")
+            element_pc = geometry.Pointcloud(element_locations)
+            (
+                best_tree,
+                best_target,
+                best_rmse,
+                best_init_rotation,
+            ) = packing_combinatorics.find_best_tree_unoptimized(
+                element_pc,
+                reference_diameter=reference_diameter,
+                database_path=reader,
+                return_rmse=True,
+                update_database=True,
+                registration_method=registration_method,
+            )
+            if best_tree is None:
+                csv_writer_elementwise.writerow([element_locations, "Failed", "Failed"])
+                print("No tree found. Skiping this element.")
+                continue
+            tree_length = best_tree.height
+            csv_writer_elementwise.writerow(
+                [element_locations, element_length / tree_length, best_rmse]
+            )
+            print(f"Best tree: {best_tree}")
+            print(f"Best RMSE: {best_rmse}")
+            RMSEs.append(best_rmse)
+            original_id = best_tree.original_id
+            if original_id not in tree_number_usage:
+                tree_number_usage[original_id] = 1
+                tree_length_usage[original_id] = element_length
+            else:
+                tree_number_usage[original_id] += 1
+                tree_length_usage[original_id] += element_length
 
     for tree_id in tree_number_usage:
         csv_writer_treewise.writerow(
@@ -165,6 +179,23 @@ if __name__ == "__main__":
         help="The number of frames to generate.",
     )
 
+    parser.add_argument(
+        "--reset_database",
+        "-r",
+        action="store_true",
+        help="Rebuild the database from the dataset before the evaluation. Not needed to start from a pristine inventory, the evaluation does not modify the database. "
+        "The database is always built when it does not exist yet, e.g. in a fresh checkout.",
+    )
+
+    parser.add_argument(
+        "--registration_method",
+        "-m",
+        type=str,
+        default="ICP",
+        choices=[method.name for method in packing_manipulations.RegistrationMethod],
+        help="The registration method of the skeletons. ICP by default, which the RMSE badge is computed with.",
+    )
+
     args = parser.parse_args()
     reference_diameter = args.reference_diameter
     type = args.type
@@ -182,10 +213,17 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
-    reset_database(
-        voxel_size=0.03,
-        working_dir=os.path.dirname(os.path.realpath(__file__)) + "/../src/Carnutes",
+    working_dir = os.path.dirname(os.path.realpath(__file__)) + "/../src/Carnutes"
+    # the database file is not versioned, it is built from the dataset
+    if args.reset_database or not os.path.exists(
+        working_dir + "/database/tree_database.fs"
+    ):
+        reset_database(voxel_size=0.03, working_dir=working_dir, n_workers=None)
+    evaluate_unoptimized_tree_selection(
+        type,
+        n_frames,
+        reference_diameter,
+        packing_manipulations.RegistrationMethod[args.registration_method],
     )
-    evaluate_unoptimized_tree_selection(type, n_frames, reference_diameter)
     print("Evaluation done.")
     sys.exit(0)
@@ -4,13 +4,16 @@ import copy
 
 import pytest
 import numpy as np
+import transaction
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(current_dir + "/..")
 sys.path.append(current_dir + "/../src/Carnutes")
 
 from utils import geometry as geo
-from utils import database_reader, tree, geometrical_operations
+from utils import database_reader, tree, geometrical_operations, feature_index
+from utils import window_index
+from utils import database_ingestion
 
 
 @pytest.fixture
@@ -33,6 +36,32 @@ def test_Pointcloud():
     assert point_cloud.colors == None
 
 
+def test_ArrayPointcloud():
+    point_cloud = geo.ArrayPointcloud(
+        [[1, 2, 3], [4, 5, 6]], [[0.0, 0.5, 1.0], [1.0, 1.0, 1.0]]
+    )
+    assert point_cloud.points_array.dtype == np.float32
+    assert point_cloud.colors_array.dtype == np.uint8
+    assert point_cloud.points == [[1, 2, 3], [4, 5, 6]]
+    assert np.allclose(
+        point_cloud.colors, [[0.0, 0.5, 1.0], [1.0, 1.0, 1.0]], atol=1e-2
+    )
+    # compared and printed as arrays
+    same_point_cloud = geo.ArrayPointcloud(
+        point_cloud.points_array, point_cloud.colors_array
+    )
+    assert point_cloud == same_point_cloud
+    same_point_cloud.colors_array = None
+    assert point_cloud != same_point_cloud
+    assert repr(point_cloud) == "ArrayPointcloud(2 points, colors, ungrouped)"
+    point_cloud.points = [[7, 8, 9]]
+    assert point_cloud.points_array.shape == (1, 3)
+
+    converted = tree.as_array_pointcloud(geo.Pointcloud([[1, 2, 3], [4, 5, 6]]))
+    assert isinstance(converted, geo.ArrayPointcloud)
+    assert converted.colors is None
+
+
 def test_Mesh():
     vertices_list = [[1, 0, 0], [0, 1, 0], [0, 0, 1], [0, 0, 0]]
     faces_list = [[0, 1, 2], [0, 1, 3]]
@@ -80,6 +109,31 @@ def test_project_points_to_plane():
     assert projected_points == [[1, 1, 0], [2, 2, 0], [3, 3, 0]]
 
 
+def test_distance_to_polyline():
+    polyline = [[0, 0, 0], [0, 0, 2], [2, 0, 2]]
+    points = [[1, 0, 0], [0, 0, -1], [1, 1, 2], [3, 0, 2], [0.5, 0, 1.5]]
+    distances = geometrical_operations.distance_to_polyline(points, polyline)
+    assert np.allclose(distances, [1, 1, 1, 1, 0.5])
+
+
+def test_tree_crop():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-2, 2, (50000, 3))
+    my_tree = tree.Tree(
+        0,
+        "crop",
+        geo.ArrayPointcloud(points, rng.integers(0, 255, (50000, 3), dtype=np.uint8)),
+    )
+    my_tree.crop([[0, 0, -1], [0, 0, 1]], radius=0.5)
+    kept_points = my_tree.point_cloud.points_array
+    assert len(kept_points) == len(my_tree.point_cloud.colors_array)
+    assert 0 < len(kept_points) < 50000
+    # capsule: cylinder between the ends of the axis, and half spheres beyond them
+    radial = np.linalg.norm(kept_points[:, :2], axis=1)
+    assert np.all(radial <= 0.5 + 1e-6)
+    assert np.all(np.abs(kept_points[:, 2]) <= 1.5 + 1e-6)
+
+
 def test_fit_circle_with_open3d():
     points = [
         [
@@ -94,3 +148,903 @@ def test_fit_circle_with_open3d():
     assert center[1] == pytest.approx(2, abs=2e-1)
     assert center[2] == pytest.approx(3, abs=2e-1)
     assert radius == pytest.approx(2, abs=3e-1)
+
+
+def test_fit_circles_algebraic():
+    angles = np.linspace(0, 2 * np.pi, 50, endpoint=False)
+    first_slice = np.stack(
+        [2 * np.cos(angles) + 1, 2 * np.sin(angles) + 2, np.full(50, 3.0)], axis=1
+    )
+    second_slice = np.stack(
+        [0.5 * np.cos(angles), 0.5 * np.sin(angles) - 1, np.full(50, 4.0)], axis=1
+    )
+    points = np.concatenate([first_slice, second_slice])
+    slice_indexes = np.repeat([0, 1], 50)
+    centers, radii = geometrical_operations.fit_circles_algebraic(
+        points, slice_indexes, 2
+    )
+    assert np.allclose(centers, [[1, 2, 3], [0, -1, 4]])
+    assert np.allclose(radii, [2, 0.5])
+
+    # a few outliers are mostly ignored with the robust reweighting
+    outliers = np.array([[1.5, 2.5, 3.0], [1.2, 2.1, 3.0], [0.8, 1.7, 3.0]])
+    points = np.concatenate([points, outliers])
+    slice_indexes = np.concatenate([slice_indexes, [0, 0, 0]])
+    _, plain_radii = geometrical_operations.fit_circles_algebraic(
+        points, slice_indexes, 2
+    )
+    _, robust_radii = geometrical_operations.fit_circles_algebraic(
+        points, slice_indexes, 2, robust_iterations=5
+    )
+    assert abs(robust_radii[0] - 2) < abs(plain_radii[0] - 2)
+    assert robust_radii[0] == pytest.approx(2, abs=2e-2)
+
+
+def test_compute_skeleton(get_skeleton_length):
+    # a cylinder of radius 0.2 along z, from 0 to 10
+    heights, angles = np.meshgrid(
+        np.linspace(0, 10, 201), np.linspace(0, 2 * np.pi, 40)
+    )
+    points = np.stack(
+        [
+            0.2 * np.cos(angles.ravel()) + 1,
+            0.2 * np.sin(angles.ravel()) + 2,
+            heights.ravel(),
+        ],
+        axis=1,
+    )
+    cylinder = tree.Tree(0, "cylinder", geo.Pointcloud(points.tolist()))
+    skeleton = cylinder.compute_skeleton()
+
+    assert len(skeleton.points) == get_skeleton_length
+    assert np.allclose(np.array(skeleton.points)[:, :2], [1, 2], atol=1e-2)
+    assert np.allclose(
+        np.array(skeleton.points)[:, 2],
+        np.linspace(0, 10, get_skeleton_length),
+        atol=0.3,
+    )
+    assert cylinder.mean_diameter == pytest.approx(0.4, abs=5e-2)
+
+    cylinder.compute_skeleton(
+        circle_fitting_method=geometrical_operations.CircleFittingMethod.ALGEBRAIC
+    )
+    assert np.allclose(np.array(skeleton.points), np.array(cylinder.skeleton.points))
+    assert cylinder.mean_diameter == pytest.approx(0.4, abs=1e-2)
+    assert np.allclose([circle[0][:2] for circle in cylinder.skeleton_circles], [1, 2])
+
+
+def test_tree_trim_and_transform():
+    heights, angles = np.meshgrid(
+        np.linspace(0, 10, 101), np.linspace(0, 2 * np.pi, 20)
+    )
+    points = np.stack(
+        [0.2 * np.cos(angles.ravel()), 0.2 * np.sin(angles.ravel()), heights.ravel()],
+        axis=1,
+    )
+    cylinder = tree.Tree(0, "cylinder", geo.Pointcloud(points.tolist(), None))
+    cylinder.compute_skeleton()
+    point_cloud = cylinder.point_cloud
+
+    transformation = np.eye(4)
+    transformation[:3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 1]]
+    transformation[:3, 3] = [1, 2, 3]
+    cylinder.transform(transformation)
+    # the points are transformed in place
+    assert cylinder.point_cloud is point_cloud
+    assert np.allclose(
+        np.min(point_cloud.points_array, axis=0), [0.8, 1.8, 3], atol=1e-2
+    )
+    assert np.allclose(np.array(cylinder.skeleton.points)[:, :2], [1, 2], atol=1e-2)
+    assert np.allclose(
+        [circle[0][2] for circle in cylinder.skeleton_circles],
+        np.array(cylinder.skeleton.points)[:, 2],
+        atol=1e-2,
+    )
+
+    cylinder.trim(geo.Pointcloud([[1, 2, 3], [1, 2, 8]]))
+    remaining_heights = point_cloud.points_array[:, 2]
+    assert np.all((remaining_heights < 2.5) | (remaining_heights > 8.5))
+    assert len(cylinder.skeleton.points) == 5
+    assert len(cylinder.skeleton_circles) == 5
+    assert cylinder.height == pytest.approx(4.4, abs=1e-3)
+
+
+def test_tree_trim_offcuts():
+    import transaction
+
+    heights, angles = np.meshgrid(
+        np.linspace(0, 10, 101), np.linspace(0, 2 * np.pi, 20)
+    )
+    points = np.stack(
+        [0.2 * np.cos(angles.ravel()), 0.2 * np.sin(angles.ravel()), heights.ravel()],
+        axis=1,
+    )
+    cylinder = tree.Tree(0, "cylinder", geo.Pointcloud(points.tolist(), None))
+    cylinder.compute_skeleton()
+    n_skeleton_points = len(cylinder.skeleton.points)
+
+    # cutting the middle of the tree splits it in two
+    offcuts = cylinder.trim(geo.Pointcloud([[0, 0, 3], [0, 0, 5]]))
+    assert len(offcuts) == 1
+    offcut = offcuts[0]
+    assert offcut.id is None
+    assert cylinder.parent_id is None and cylinder.original_id == 0
+    assert offcut.parent_id == offcut.original_id == 0
+    assert np.all(cylinder.point_cloud.points_array[:, 2] > 5.19)
+    assert np.all(offcut.point_cloud.points_array[:, 2] < 2.81)
+    assert np.all(np.array(offcut.skeleton.points)[:, 2] < 2.81)
+    assert len(cylinder.skeleton.points) > len(offcut.skeleton.points) >= 2
+    assert (
+        len(cylinder.skeleton.points) + len(offcut.skeleton.points) < n_skeleton_points
+    )
+    assert len(offcut.skeleton_circles) == len(offcut.skeleton.points)
+    assert offcut.height == pytest.approx(2.8, abs=0.1)
+    assert cylinder.height == pytest.approx(4.7, abs=1e-3)
+    assert offcut.mean_diameter == pytest.approx(0.4, abs=0.05)
+    # cutting an end does not
+    assert cylinder.trim(geo.Pointcloud([[0, 0, 9], [0, 0, 10]])) == []
+
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        n_trees = reader.get_num_trees()
+        next_id = reader.get_next_tree_id()
+        assert reader.add_tree(offcut) == next_id == offcut.id
+        # the usage of an offcut is mapped back to the tree it was cut from
+        assert offcut.original_id == 0
+        assert reader.get_num_trees() == n_trees + 1
+        assert offcut.id in reader.get_feature_index()["id"]
+        # the id of a removed offcut is not given again
+        reader.remove_tree(offcut.id)
+        assert reader.get_next_tree_id() == next_id + 1
+        transaction.abort()
+
+    # the offcuts of an offcut are mapped back to the same scanned tree
+    stored_offcut = tree.Tree(next_id, "offcut", geo.Pointcloud(points.tolist(), None))
+    stored_offcut.parent_id = 0
+    stored_offcut.compute_skeleton()
+    offcuts = stored_offcut.trim(geo.Pointcloud([[0, 0, 3], [0, 0, 5]]))
+    assert len(offcuts) == 1
+    assert offcuts[0].parent_id == offcuts[0].original_id == 0
+
+
+def test_tree_write_conflict(tmp_path):
+    import transaction
+    import ZODB
+    import ZODB.FileStorage
+    import ZODB.POSException
+
+    db = ZODB.DB(ZODB.FileStorage.FileStorage(str(tmp_path / "tree_database.fs")))
+    with db.transaction() as connection:
+        connection.root.tree = tree.Tree(
+            0, "tree", geo.Pointcloud([[0, 0, 0], [0, 0, 1]]), [[0, 0, 0], [0, 0, 1]]
+        )
+    managers = [transaction.TransactionManager() for _ in range(2)]
+    connections = [db.open(manager) for manager in managers]
+    for i, connection in enumerate(connections):
+        connection.root.tree.height = i + 1.0
+    managers[0].commit()
+    # concurrent writes of a tree are not merged, the second one has to be retried
+    with pytest.raises(ZODB.POSException.ConflictError):
+        managers[1].commit()
+    managers[1].abort()
+    for connection in connections:
+        connection.close()
+    db.close()
+
+
+def test_tree_point_segments(get_skeleton_length):
+    rng = np.random.default_rng(0)
+    heights = rng.uniform(0, 10, 20000)
+    angles = rng.uniform(0, 2 * np.pi, 20000)
+    points = np.stack(
+        [0.2 * np.cos(angles), 0.2 * np.sin(angles), heights],
+        axis=1,
+    )
+    cylinder = tree.Tree(0, "cylinder", geo.ArrayPointcloud(points))
+    cylinder.compute_skeleton(geometrical_operations.CircleFittingMethod.ALGEBRAIC)
+    point_cloud = cylinder.point_cloud
+    offsets = point_cloud.segment_offsets
+    assert len(offsets) == get_skeleton_length + 1
+    assert offsets[-1] == len(points)
+    # the points of each segment are in its slice of the height
+    slice_height = np.ptp(heights) / (get_skeleton_length - 1)
+    for k in range(get_skeleton_length):
+        segment = point_cloud.select_segments(k, k + 1).points_array
+        assert np.all(
+            np.abs(segment[:, 2] - heights.min() - k * slice_height)
+            <= slice_height / 2 + 1e-5
+        )
+        assert np.allclose(
+            point_cloud.segment_bounds[k], [segment.min(axis=0), segment.max(axis=0)]
+        )
+    with pytest.raises(ValueError):
+        point_cloud.set_segments([0, len(points) + 1])
+
+    # trimming the grouped points gives the same points as testing each of them
+    ungrouped = copy.deepcopy(cylinder)
+    ungrouped.point_cloud = geo.ArrayPointcloud(point_cloud.points_array)
+    to_remove = geo.Pointcloud([[0, 0, 3.2], [0, 0, 5.7]])
+    offcuts = cylinder.trim(to_remove)
+    ungrouped_offcuts = ungrouped.trim(to_remove)
+    for grouped_tree, ungrouped_tree in zip(
+        [cylinder] + offcuts, [ungrouped] + ungrouped_offcuts
+    ):
+        grouped_points = grouped_tree.point_cloud.points_array
+        assert np.array_equal(
+            np.unique(grouped_points, axis=0),
+            np.unique(ungrouped_tree.point_cloud.points_array, axis=0),
+        )
+        assert grouped_tree.height == pytest.approx(ungrouped_tree.height)
+        # the kept points of the removed slices join the nearest kept slice
+        offsets = grouped_tree.point_cloud.segment_offsets
+        assert len(offsets) == len(grouped_tree.skeleton.points) + 1
+        assert offsets[-1] == len(grouped_points)
+
+    cylinder.crop([[0, 0, 6], [0, 0, 8]], radius=0.5)
+    ungrouped.crop([[0, 0, 6], [0, 0, 8]], radius=0.5)
+    assert np.array_equal(
+        np.unique(cylinder.point_cloud.points_array, axis=0),
+        np.unique(ungrouped.point_cloud.points_array, axis=0),
+    )
+    assert cylinder.point_cloud.segment_offsets[-1] == len(
+        cylinder.point_cloud.points_array
+    )
+
+
+def test_tree_skeleton_view(get_skeleton_length, get_database):
+    reader = get_database
+    my_tree = reader.get_tree(0)
+    skeleton_view = reader.get_tree_skeleton(0)
+    assert skeleton_view.id == my_tree.id
+    assert len(skeleton_view.skeleton.points) == get_skeleton_length
+    assert len(skeleton_view.skeleton_circles) == get_skeleton_length
+    assert not hasattr(skeleton_view, "point_cloud")
+    # modifying the view should not modify the tree
+    skeleton_view.skeleton.points = skeleton_view.skeleton.points[::-1]
+    assert list(my_tree.skeleton.points[0]) != skeleton_view.skeleton.points[0]
+    # views of different trees are different, and can be used as keys
+    other_view = reader.get_tree_skeleton(1)
+    assert skeleton_view != other_view
+    assert len({skeleton_view, other_view}) == 2
+
+
+def test_feature_index(get_skeleton_length, get_database):
+    reader = get_database
+    features = reader.get_feature_index()
+    assert len(features) == len(reader.root.trees)
+    my_tree = reader.get_tree(int(features["id"][0]))
+    assert features["mean_diameter"][0] == pytest.approx(my_tree.mean_diameter)
+    assert features["cumulative_lengths"].shape == (len(features), get_skeleton_length)
+    assert features["skeleton_length"][0] == pytest.approx(
+        geometrical_operations.compute_polyline_length(my_tree.skeleton.points)
+    )
+    candidate_ids = feature_index.select_candidates(
+        features, my_tree.mean_diameter, features["skeleton_length"][0]
+    )
+    assert my_tree.id in candidate_ids
+    assert len(feature_index.select_candidates(features, 0.3, np.inf)) == 0
+
+
+def test_database_session():
+    from packing import packing_combinatorics
+
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 1], [0, 0, 2]])
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs"
+    ) as reader:
+        n_trees = reader.get_num_trees()
+        for _ in range(2):
+            best_tree = packing_combinatorics.find_best_tree_unoptimized(
+                model_element, 0.3, reader, update_database=False
+            )
+            assert reader.is_open
+        assert best_tree.id in reader.root.trees
+        assert reader.get_num_trees() == n_trees
+        # the registered skeleton is returned, not the one of the last tree scored
+        for find_best_tree, arguments in (
+            (packing_combinatorics.find_best_tree_unoptimized, {}),
+            (packing_combinatorics.find_best_tree_optimized, {"optimisation_basis": 3}),
+        ):
+            selected_tree, best_skeleton, _, _ = find_best_tree(
+                model_element,
+                0.3,
+                reader,
+                return_rmse=True,
+                update_database=False,
+                **arguments,
+            )
+            assert best_skeleton is selected_tree.skeleton
+    assert not reader.is_open
+
+    # an update which is not committed would be lost when closing the database opened from the path
+    for find_best_tree, arguments in (
+        (packing_combinatorics.find_best_tree_unoptimized, {}),
+        (packing_combinatorics.find_best_tree_optimized, {"optimisation_basis": 3}),
+    ):
+        with pytest.raises(ValueError):
+            find_best_tree(
+                model_element,
+                0.3,
+                current_dir + "/../src/Carnutes/database/tree_database.fs",
+                commit=False,
+                **arguments,
+            )
+
+
+def test_database_snapshot(tmp_path):
+    import shutil
+    import transaction
+
+    database_path = str(tmp_path / "tree_database.fs")
+    snapshot_path = str(tmp_path / "snapshot.fs")
+    shutil.copy(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", database_path
+    )
+    with database_reader.DatabaseReader(database_path) as reader:
+        n_trees = reader.get_num_trees()
+        reader.snapshot(snapshot_path)
+        reader.remove_tree(int(reader.get_feature_index()["id"][0]))
+        transaction.commit()
+        assert reader.get_num_trees() == n_trees - 1
+
+    database_reader.DatabaseReader.restore_snapshot(snapshot_path, database_path)
+    with database_reader.DatabaseReader(database_path, in_memory=True) as reader:
+        assert reader.get_num_trees() == n_trees
+        reader.remove_tree(int(reader.get_feature_index()["id"][0]))
+        transaction.commit()
+        assert reader.get_num_trees() == n_trees - 1
+        with pytest.raises(ValueError):
+            reader.snapshot(snapshot_path)
+    # the changes of the in-memory database are not written to the file
+    with database_reader.DatabaseReader(database_path) as reader:
+        assert reader.get_num_trees() == n_trees
+        assert len(reader.get_feature_index()) == n_trees
+
+
+def test_allocate_elements(tmp_path):
+    import shutil
+    from packing import packing_combinatorics
+
+    database_path = str(tmp_path / "tree_database.fs")
+    shutil.copy(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", database_path
+    )
+    model_elements = [
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1], [0, 0, 2]]),
+        geo.Pointcloud([[0, 0, 0], [1, 0, 0]]),
+    ]
+    with database_reader.DatabaseReader(database_path) as reader:
+        n_trees = reader.get_num_trees()
+        features = copy.deepcopy(reader.get_feature_index())
+
+        # a failing element rolls back the whole batch
+        with pytest.raises(TypeError):
+            packing_combinatorics.allocate_elements(
+                model_elements, [0.3, "0.3"], reader
+            )
+        assert reader.get_num_trees() == n_trees
+        assert np.array_equal(reader.get_feature_index()["id"], features["id"])
+
+        allocations = packing_combinatorics.allocate_elements(
+            model_elements, [0.3, 0.3], reader, commit_every=1
+        )
+    assert len(allocations) == 2
+    assert all(allocation[0] is not None for allocation in allocations)
+
+    with database_reader.DatabaseReader(database_path) as reader:
+        trimmed_ids = {allocation[0].id for allocation in allocations}
+        index = reader.get_feature_index()
+        for tree_id in trimmed_ids:
+            if tree_id in reader.root.trees:
+                row = index[index["id"] == tree_id][0]
+                assert (
+                    row["skeleton_length"]
+                    < features[features["id"] == tree_id][0]["skeleton_length"]
+                )
+        assert len(index) == reader.get_num_trees()
+
+
+def test_cost_matrix():
+    from packing import packing_combinatorics
+
+    model_elements = [
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1], [0, 0, 2]]),
+        geo.Pointcloud([[0, 0, 0], [1, 0, 0]]),
+    ]
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        costs = packing_combinatorics.CostMatrix(model_elements, [0.3, 0.3], reader)
+        assert costs.rmse.shape == (2, reader.get_num_trees())
+        assert np.any(costs.is_feasible)
+        assert np.all(costs.leftover_lengths[costs.is_feasible] >= 0)
+
+        # each entry is the matching of the element with the tree alone
+        column = costs.select_tree(0)
+        tree_skeleton = reader.get_tree_skeleton(int(costs.tree_ids[column]))
+        matching = packing_combinatorics.compute_best_trees_element_matching(
+            model_elements[0], 0.3, [tree_skeleton], np.inf
+        )[0]
+        assert costs.rmse[0, column] == pytest.approx(matching[1])
+
+        # after a trim, only the column of the trimmed tree changes
+        rmse = costs.rmse.copy()
+        trimmed_tree = copy.deepcopy(reader.get_tree(int(costs.tree_ids[column])))
+        trimmed_tree.trim(costs.skeleton_segments[0, column])
+        costs.update_tree(trimmed_tree.get_skeleton_view(), [1])
+        assert costs.is_stale[1, column] and not costs.is_stale[0, column]
+        costs.refresh()
+        assert not np.any(costs.is_stale)
+        other_columns = np.arange(rmse.shape[1]) != column
+        assert np.array_equal(costs.rmse[:, other_columns], rmse[:, other_columns])
+        assert costs.rmse[0, column] == rmse[0, column]
+
+
+def test_allocate_elements_globally():
+    from packing import packing_combinatorics
+
+    model_elements = [
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1], [0, 0, 2]]),
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1]]),
+        geo.Pointcloud([[0, 0, 0], [0.1, 0, 1], [0, 0, 2]]),
+    ]
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        features = copy.deepcopy(reader.get_feature_index())
+        (
+            allocations,
+            total_rmse,
+            stock_length,
+        ) = packing_combinatorics.allocate_elements_globally(
+            model_elements, [0.3, 0.3, 0.3], reader, stock_weight=0.01
+        )
+        assert len(allocations) == 3
+        assert all(allocation[0] is not None for allocation in allocations)
+        assert total_rmse == pytest.approx(sum(a[2] for a in allocations))
+        used_ids = {allocation[0].id for allocation in allocations}
+        assert stock_length == pytest.approx(
+            np.sum(features["skeleton_length"][np.isin(features["id"], list(used_ids))])
+        )
+        # the trees used were cut
+        index = reader.get_feature_index()
+        for tree_id in used_ids:
+            if tree_id in reader.root.trees:
+                assert (
+                    index[index["id"] == tree_id][0]["skeleton_length"]
+                    < features[features["id"] == tree_id][0]["skeleton_length"]
+                )
+
+
+def test_pack_elements_on_trees():
+    from packing import packing_combinatorics
+
+    model_elements = [
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1]]),
+        geo.Pointcloud([[0, 0, 0], [0, 0, 0.5], [0, 0, 1.5]]),
+        geo.Pointcloud([[0, 0, 0], [0, 0, 1]]),
+    ]
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        n_trees = reader.get_num_trees()
+        allocations = packing_combinatorics.pack_elements_on_trees(
+            model_elements,
+            [0.3, 0.3, 0.3],
+            reader,
+            strategy=packing_combinatorics.PackingStrategy.FIRST_FIT,
+        )
+        assert all(allocation[0] is not None for allocation in allocations)
+        # the elements are packed on a single tree, cut once
+        used_ids = {allocation[0].id for allocation in allocations}
+        assert len(used_ids) == 1
+        assert reader.get_num_trees() >= n_trees - 1
+        for model_element, allocation in zip(model_elements, allocations):
+            assert len(allocation[1].points) == len(model_element.points)
+
+
+def test_lazy_point_cloud(get_database):
+    tree_id = int(get_database.get_feature_index()["id"][-1])
+    get_database.connection.cacheMinimize()
+    get_database.get_tree_skeleton(tree_id)
+    my_tree = get_database.get_tree(tree_id)
+    # the points are not loaded by the search
+    assert my_tree._payload._p_status == "ghost"
+    assert len(my_tree.load_point_cloud().points_array) > 1000
+    assert my_tree._payload._p_status != "ghost"
+
+
+def test_ingest_scans(tmp_path):
+    dataset_dir = current_dir + "/../src/Carnutes/dataset"
+    scan_files = sorted(f for f in os.listdir(dataset_dir) if f.endswith(".ply"))[:3]
+    scans = [
+        (i, scan_file[:-4], os.path.join(dataset_dir, scan_file))
+        for i, scan_file in enumerate(scan_files)
+    ]
+    with database_reader.DatabaseReader(str(tmp_path / "tree_database.fs")) as reader:
+        n_ingested = database_ingestion.ingest_scans(
+            reader, scans, 0.05, n_workers=2, max_in_flight=2, commit_every=2
+        )
+        assert n_ingested == 3
+        assert reader.get_num_trees() == 3
+        # the feature index is built once, at the end of the ingestion, the window index only when it is requested
+        assert len(reader.root.feature_index) == 3
+        assert not hasattr(reader.root, "window_index")
+        assert list(reader.get_feature_index()["id"]) == [0, 1, 2]
+        # once requested, the window index is rebuilt with the feature index
+        requested_index = reader.get_window_index()
+        reader.build_indexes()
+        assert reader.root.window_index is not requested_index
+        assert set(reader.root.window_index.table.tree_ids) == {0, 1, 2}
+        transaction.commit()
+        serial_tree = database_ingestion.process_scan(*scans[1], 0.05)
+        assert np.array_equal(
+            reader.get_tree(1).point_cloud.points_array,
+            serial_tree.point_cloud.points_array,
+        )
+        assert reader.get_tree(1).name == scan_files[1][:-4]
+
+
+def test_ingestion_cache(tmp_path, monkeypatch):
+    import shutil
+    import database_creator
+
+    dataset_dir = current_dir + "/../src/Carnutes/dataset"
+    scan_files = sorted(f for f in os.listdir(dataset_dir) if f.endswith(".ply"))[:3]
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("dataset")
+    for scan_file in scan_files[:2]:
+        shutil.copy(os.path.join(dataset_dir, scan_file), "dataset")
+
+    database_creator.create_database(voxel_size=0.05, n_workers=1)
+    assert len(os.listdir("database/cache")) == 2
+    cached_tree = database_ingestion.process_scan(
+        0, "cached", "dataset/" + scan_files[0], 0.05, cache_dir="database/cache"
+    )
+    computed_tree = database_ingestion.process_scan(
+        0, "computed", "dataset/" + scan_files[0], 0.05
+    )
+    assert np.array_equal(
+        cached_tree.point_cloud.points_array, computed_tree.point_cloud.points_array
+    )
+    assert np.allclose(cached_tree.skeleton.points, computed_tree.skeleton.points)
+    assert cached_tree.mean_diameter == computed_tree.mean_diameter
+
+    # only the new scan is added
+    shutil.copy(os.path.join(dataset_dir, scan_files[2]), "dataset")
+    assert database_creator.augment_database(voxel_size=0.05, n_workers=1) == 1
+    assert database_creator.augment_database(voxel_size=0.05, n_workers=1) == 0
+    with database_reader.DatabaseReader("database/tree_database.fs") as reader:
+        assert reader.get_num_trees() == 3
+        assert sorted(reader.root.trees.keys()) == [0, 1, 2]
+
+
+def test_cached_tree_without_colors(tmp_path):
+    heights, angles = np.meshgrid(
+        np.linspace(0, 10, 201), np.linspace(0, 2 * np.pi, 40)
+    )
+    points = np.stack(
+        [0.2 * np.cos(angles.ravel()), 0.2 * np.sin(angles.ravel()), heights.ravel()],
+        axis=1,
+    )
+    cylinder = tree.Tree(0, "cylinder", tree.ArrayPointcloud(points))
+    cylinder.compute_skeleton(geometrical_operations.CircleFittingMethod.ALGEBRAIC)
+    cache_path = str(tmp_path / "cylinder.npz")
+    database_ingestion._save_cached_tree(cache_path, cylinder)
+    cached_tree = database_ingestion._load_cached_tree(cache_path, 0, "cylinder")
+    assert cached_tree.point_cloud.colors_array is None
+    assert np.array_equal(
+        cached_tree.point_cloud.points_array, cylinder.point_cloud.points_array
+    )
+    assert cached_tree.mean_diameter == cylinder.mean_diameter
+
+    # every processing parameter of the skeleton is part of the key
+    algebraic = geometrical_operations.CircleFittingMethod.ALGEBRAIC
+    assert database_ingestion.compute_cache_key(
+        "hash", 0.05, False, algebraic, 0
+    ) != database_ingestion.compute_cache_key("hash", 0.05, False, algebraic, 5)
+
+
+def test_reset_database(tmp_path):
+    import shutil
+    import transaction
+    import reset_database
+
+    dataset_dir = current_dir + "/../src/Carnutes/dataset"
+    scan_files = sorted(f for f in os.listdir(dataset_dir) if f.endswith(".ply"))[:2]
+    os.makedirs(tmp_path / "dataset")
+    for scan_file in scan_files:
+        shutil.copy(os.path.join(dataset_dir, scan_file), tmp_path / "dataset")
+    database_path = str(tmp_path / "database/tree_database.fs")
+
+    reset_database.main(
+        voxel_size=0.05, working_dir=str(tmp_path), n_workers=1, use_cache=False
+    )
+    with database_reader.DatabaseReader(database_path) as reader:
+        my_tree = reader.get_tree(0)
+        skeleton_points = np.array(my_tree.skeleton.points)
+        offcuts = my_tree.trim(geo.Pointcloud(skeleton_points[4:7].tolist()))
+        assert len(offcuts) == 1
+        reader.set_tree(0, my_tree)
+        assert reader.add_tree(offcuts[0]) == 2
+        transaction.commit()
+
+    # the offcut does not survive the reset, and the ids start again from 0
+    reset_database.main(
+        voxel_size=0.05, working_dir=str(tmp_path), n_workers=1, use_cache=False
+    )
+    with database_reader.DatabaseReader(database_path) as reader:
+        assert reader.get_num_trees() == 2
+        assert sorted(reader.root.trees.keys()) == [0, 1]
+        assert list(reader.get_feature_index()["id"]) == [0, 1]
+        assert reader.get_next_tree_id() == 2
+        assert len(reader.get_tree(0).skeleton.points) == len(skeleton_points)
+
+
+def test_feature_index_blocks(monkeypatch):
+    monkeypatch.setattr(feature_index, "FEATURE_BLOCK_SIZE", 4)
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        # the rows are padded with NaN, so they are compared bit by bit
+        features = copy.deepcopy(reader.get_feature_index())
+        index = feature_index.FeatureIndex(features[::2])
+        assert index.to_array().tobytes() == features[::2].tobytes()
+        expected = features[::2]
+        rng = np.random.default_rng(0)
+        for row in rng.permutation(len(features)):
+            tree_id = features["id"][row]
+            if tree_id in expected["id"] and rng.random() < 0.5:
+                index.remove_tree(int(tree_id))
+                expected = expected[expected["id"] != tree_id]
+            else:
+                changed_row = features[row : row + 1].copy()
+                changed_row["height"] += 1.0
+                index.update_tree(changed_row)
+                expected = np.concatenate(
+                    [expected[expected["id"] != tree_id], changed_row]
+                )
+                expected = expected[np.argsort(expected["id"])]
+            assert len(index) == len(expected)
+            assert index.to_array().tobytes() == expected.tobytes()
+        # the blocks hold the same rows as the assembled array
+        assert all(len(block.rows) <= 8 for block in index.blocks)
+        index._v_array = None
+        assert index.to_array().tobytes() == expected.tobytes()
+
+        # the changes of an aborted transaction are dropped along with the assembled array
+        reader.get_feature_index()
+        transaction.commit()
+        tree_id = int(reader.get_feature_index()["id"][0])
+        reader.remove_tree(tree_id)
+        assert tree_id not in reader.get_feature_index()["id"]
+        transaction.abort()
+        assert tree_id in reader.get_feature_index()["id"]
+
+
+def test_range_tables():
+    rng = np.random.default_rng(0)
+    radii = rng.uniform(0.05, 0.2, (3, 11))
+    radii[2, 7:] = np.nan
+    min_tables, max_tables = feature_index.build_range_tables(radii)
+    assert min_tables.shape == (3, feature_index.RANGE_TABLE_LEVELS, 11)
+    for start in range(11):
+        for end in range(start, 12):
+            minima, maxima = feature_index.query_range_tables(
+                min_tables, max_tables, np.full(3, start), np.full(3, end)
+            )
+            if end == start:
+                assert np.all(minima == np.inf) and np.all(maxima == -np.inf)
+                continue
+            with np.errstate(all="ignore"):
+                assert np.allclose(
+                    minima, np.nanmin(radii[:, start:end], axis=1), equal_nan=True
+                )
+                assert np.allclose(
+                    maxima, np.nanmax(radii[:, start:end], axis=1), equal_nan=True
+                )
+
+
+def test_window_diameter_band():
+    # a straight tree of 10 m, 0.4 m wide at the bottom and 0.1 m wide at the top
+    my_tree = tree.Tree(0, "tree_0", geo.Pointcloud([[0, 0, 0]]))
+    heights = np.linspace(0, 10, 11)
+    my_tree.skeleton = geo.Pointcloud([[0, 0, z] for z in heights])
+    my_tree.skeleton_circles = [(np.array([0, 0, z]), 0.2 - 0.015 * z) for z in heights]
+    my_tree.mean_diameter = 0.25
+    features = feature_index.compute_tree_features(my_tree)
+    # the thin top of the tree only matches with the reversed, anchored window
+    assert feature_index.has_window_in_diameter_band(features, 0.12, 2.0)[0]
+    # no window has a constant diameter over its whole length
+    assert not feature_index.has_window_in_diameter_band(features, 0.25, 9.0)[0]
+    # the middle of the tree only matches with sliding windows
+    assert not feature_index.has_window_in_diameter_band(features, 0.26, 1.5)[0]
+    assert feature_index.has_window_in_diameter_band(features, 0.26, 1.5, 0.5)[0]
+    assert len(feature_index.select_candidates(features, 0.26, 1.5)) == 0
+    assert len(feature_index.select_candidates(features, 0.26, 1.5, 0.5)) == 1
+
+
+def test_skeleton_pyramid(get_database):
+    features = get_database.get_feature_index()
+    views = feature_index.get_skeleton_views(features[:3])
+    for view in views:
+        loaded = get_database.get_tree_skeleton(view.id)
+        assert np.allclose(view.skeleton.points, loaded.skeleton.points)
+        assert len(view.skeleton_circles) == len(loaded.skeleton_circles)
+        for circle, loaded_circle in zip(
+            view.skeleton_circles, loaded.skeleton_circles
+        ):
+            assert np.allclose(circle[0], loaded_circle[0])
+            assert circle[1] == pytest.approx(loaded_circle[1])
+    # the ends of the skeleton are kept at every level
+    for n_level_points in feature_index.SKELETON_PYRAMID_LEVELS:
+        level = features[feature_index.get_pyramid_field(n_level_points)][0]
+        assert np.allclose(level[0], features["skeleton_points"][0][0])
+        n_points = features["n_skeleton_points"][0]
+        assert np.allclose(level[-1], features["skeleton_points"][0][n_points - 1])
+
+
+def test_coarse_to_fine_search(monkeypatch):
+    from packing import packing_combinatorics
+
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 0.5], [0.05, 0, 1.5]])
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        candidate_ids = feature_index.select_candidates(
+            reader.get_feature_index(), 0.3, 1.5
+        )
+        ranked_ids = packing_combinatorics.rank_candidates_coarse_to_fine(
+            model_element, 0.3, reader.get_feature_index(), candidate_ids, min_kept=2
+        )
+        assert 2 <= len(ranked_ids) < len(candidate_ids)
+        assert set(ranked_ids) <= set(candidate_ids)
+        # keeping all the trees gives the same result as the exhaustive search
+        monkeypatch.setattr(packing_combinatorics, "COARSE_TO_FINE_KEEP_FRACTION", 1.0)
+        results = []
+        for strategy in (
+            packing_combinatorics.SearchStrategy.EXHAUSTIVE,
+            packing_combinatorics.SearchStrategy.COARSE_TO_FINE,
+        ):
+            results.append(
+                packing_combinatorics.find_best_tree_optimized(
+                    model_element,
+                    0.3,
+                    reader,
+                    optimisation_basis=3,
+                    return_rmse=True,
+                    update_database=False,
+                    search_strategy=strategy,
+                )
+            )
+        assert results[0][2] == pytest.approx(results[1][2])
+
+
+def test_window_descriptors():
+    element_points = np.array([[0, 0, 0], [0, 0, 1], [0.2, 0, 2], [0.2, 0.1, 2.5]])
+    descriptors = window_index.compute_element_descriptors(element_points, 0.3)
+    assert descriptors.shape == (2, window_index.DESCRIPTOR_SIZE)
+    # the descriptors don't depend on the position and orientation of the element
+    c, s = np.cos(0.7), np.sin(0.7)
+    rotation = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]) @ np.array(
+        [[1, 0, 0], [0, c, -s], [0, s, c]]
+    )
+    moved_points = element_points @ rotation.T + [4, -2, 7]
+    assert np.allclose(
+        window_index.compute_element_descriptors(moved_points, 0.3), descriptors
+    )
+    # the windows of a straight skeleton are straight, and cover it up to its end
+    my_tree = tree.Tree(0, "tree_0", geo.Pointcloud([[0, 0, 0]]))
+    heights = np.linspace(0, 10, 11)
+    my_tree.skeleton = geo.Pointcloud([[0, 0, z] for z in heights])
+    my_tree.skeleton_circles = [(np.array([0, 0, z]), 0.15) for z in heights]
+    my_tree.mean_diameter = 0.3
+    starts, lengths, window_descriptors = window_index.compute_tree_windows(
+        feature_index.compute_tree_features(my_tree)[0]
+    )
+    assert np.max(starts + lengths) == pytest.approx(10)
+    assert np.min(lengths) == window_index.MIN_WINDOW_LENGTH
+    straight_descriptors = window_index.compute_element_descriptors(
+        [[0, 0, 0], [0, 0, 2]], 0.3
+    )[0]
+    assert np.allclose(
+        window_descriptors[lengths == 10], window_descriptors[lengths == 10][0]
+    )
+    assert np.allclose(
+        window_descriptors[lengths == 10][0, 1:], straight_descriptors[1:]
+    )
+
+
+def test_window_index(monkeypatch):
+    descriptors = window_index.compute_element_descriptors(
+        [[0, 0, 0], [0, 0, 1], [0.05, 0, 2]], 0.3
+    )
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        index = reader.get_window_index()
+        tree_ids, starts, lengths, distances = index.query(descriptors, 10)
+        assert len(tree_ids) == 10
+        assert np.all(np.diff(distances) >= 0)
+        # the k-d tree gives the same windows as comparing the query to all of them
+        all_distances = np.min(
+            np.linalg.norm(
+                index.table.descriptors[np.newaxis] - descriptors[:, np.newaxis], axis=2
+            ),
+            axis=0,
+        )
+        assert np.allclose(distances, np.sort(all_distances)[:10])
+
+        # the changes of the database are followed without rebuilding the k-d tree
+        removed_id = int(tree_ids[0])
+        changed_id = int(tree_ids[-1])
+        table = index.table
+        reader.remove_tree(removed_id)
+        changed_tree = reader.get_tree(changed_id)
+        changed_tree.skeleton = geo.Pointcloud(changed_tree.skeleton.points[:5])
+        changed_tree.skeleton_circles = changed_tree.skeleton_circles[:5]
+        reader.set_tree(changed_id, changed_tree)
+        assert index.table is table
+        rebuilt_index = window_index.build_window_index(reader.get_feature_index())
+        assert len(index) == len(rebuilt_index)
+        for query_index in (index, rebuilt_index):
+            tree_ids, starts, lengths, distances = query_index.query(descriptors, 20)
+            assert removed_id not in tree_ids
+            assert np.all(
+                starts[tree_ids == changed_id] + lengths[tree_ids == changed_id]
+                <= reader.get_feature_index()["skeleton_length"][
+                    reader.get_feature_index()["id"] == changed_id
+                ]
+                + 1e-9
+            )
+        assert np.allclose(
+            index.query(descriptors, 20)[3], rebuilt_index.query(descriptors, 20)[3]
+        )
+
+        # the k-d tree is rebuilt once enough windows changed
+        monkeypatch.setattr(window_index, "REBUILD_FRACTION", 0.0)
+        reader.remove_tree(int(tree_ids[0]))
+        assert index.table is not table
+        assert len(index.pending_tree_ids) == 0 and len(index.removed_ids) == 0
+        assert len(index) == len(index.table)
+        transaction.abort()
+
+
+def test_nearest_windows_search():
+    from packing import packing_combinatorics
+
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 0.5], [0.05, 0, 1.5]])
+    with database_reader.DatabaseReader(
+        current_dir + "/../src/Carnutes/database/tree_database.fs", in_memory=True
+    ) as reader:
+        candidate_ids, offsets = packing_combinatorics.retrieve_nearest_windows(
+            model_element,
+            0.3,
+            reader.get_window_index(),
+            reader.get_feature_index(),
+            n_windows=16,
+        )
+        assert 0 < len(candidate_ids) <= 16
+        assert offsets.shape[0] == len(candidate_ids)
+        assert np.all(np.isin(candidate_ids, reader.get_feature_index()["id"]))
+        selected_tree, _, rmse, _ = packing_combinatorics.find_best_tree_optimized(
+            model_element,
+            0.3,
+            reader,
+            optimisation_basis=3,
+            return_rmse=True,
+            search_strategy=packing_combinatorics.SearchStrategy.NEAREST_WINDOWS,
+        )
+        assert selected_tree is not None
+        assert rmse < 0.1
+        # the windows of the trimmed tree follow its new skeleton
+        features = reader.get_feature_index()
+        tree_ids, starts, lengths, _ = reader.get_window_index().query(
+            window_index.compute_element_descriptors(model_element.points, 0.3), 500
+        )
+        skeleton_lengths = features["skeleton_length"][
+            np.searchsorted(features["id"], tree_ids)
+        ]
+        assert np.all(np.isin(tree_ids, features["id"]))
+        assert np.all(starts + lengths <= skeleton_lengths + 1e-9)
@@ -0,0 +1,253 @@
+import sys
+import os
+
+import pytest
+import numpy as np
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(current_dir + "/..")
+sys.path.append(current_dir + "/../src/Carnutes")
+
+from utils import geometry as geo
+from utils import geometrical_operations, tree
+from packing import packing_manipulations, packing_combinatorics
+
+
+@pytest.fixture
+def get_straight_skeleton():
+    yield geo.Pointcloud([[0, 0, z] for z in range(11)])
+
+
+def test_match_skeletons(get_straight_skeleton):
+    model_element = geo.Pointcloud([[0, 0, 0], [3, 4, 0], [3, 4, 2.5]])
+    adapted_skeleton, n_segments = packing_manipulations.match_skeletons(
+        model_element, get_straight_skeleton
+    )
+    assert np.allclose(adapted_skeleton.points, [[0, 0, 0], [0, 0, 5], [0, 0, 7.5]])
+    assert n_segments == 7
+
+
+def test_match_skeletons_too_short(get_straight_skeleton):
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 11]])
+    adapted_skeleton, n_segments = packing_manipulations.match_skeletons(
+        model_element, get_straight_skeleton
+    )
+    assert adapted_skeleton is None
+    assert n_segments is None
+
+
+def test_batch_resample_skeletons(get_straight_skeleton):
+    short_skeleton = geo.Pointcloud([[0, 0, 0], [2, 0, 0], [2, 2, 0]])
+    skeletons, n_points = packing_manipulations.stack_skeletons(
+        [get_straight_skeleton, short_skeleton]
+    )
+    assert skeletons.shape == (2, 11, 3)
+    assert list(n_points) == [11, 3]
+    (
+        resampled_points,
+        segment_indices,
+        is_valid,
+    ) = packing_manipulations.batch_resample_skeletons(
+        skeletons, n_points, [0.0, 1.5, 3.0]
+    )
+    assert list(is_valid) == [True, True]
+    assert np.allclose(resampled_points[0], [[0, 0, 0], [0, 0, 1.5], [0, 0, 3]])
+    assert np.allclose(resampled_points[1], [[0, 0, 0], [1.5, 0, 0], [2, 1, 0]])
+    assert list(segment_indices[1]) == [0, 0, 1]
+    _, _, is_valid = packing_manipulations.batch_resample_skeletons(
+        skeletons, n_points, [0.0, 5.0]
+    )
+    assert list(is_valid) == [True, False]
+
+
+def test_kabsch_registration():
+    source_points = np.array(
+        [[[0, 0, 0], [1, 0, 0], [1, 2, 0], [0, 1, 3]]], dtype=float
+    )
+    rotation = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]], dtype=float)
+    target_points = source_points[0] @ rotation.T + [1, 2, 3]
+    transformations, rmse = geometrical_operations.kabsch_registration(
+        source_points, target_points
+    )
+    assert transformations.shape == (1, 4, 4)
+    assert np.allclose(transformations[0, :3, :3], rotation)
+    assert np.allclose(transformations[0, :3, 3], [1, 2, 3])
+    assert rmse[0] == pytest.approx(0, abs=1e-9)
+
+    # batches with fewer points are padded, the padding is ignored
+    padded_sources = np.concatenate(
+        [source_points, np.vstack([source_points[0, :3], [[np.nan] * 3]])[None]]
+    )
+    padded_targets = np.stack(
+        [target_points, np.vstack([target_points[:3], [[np.nan] * 3]])]
+    )
+    transformations, rmse = geometrical_operations.kabsch_registration(
+        padded_sources, padded_targets, [4, 3]
+    )
+    assert np.allclose(transformations[1], transformations[0])
+    assert np.allclose(rmse, 0)
+
+
+def test_compute_best_trees_element_matching(get_straight_skeleton):
+    circles = [([0, 0, z], 0.15) for z in range(11)]
+    straight_tree = tree.TreeSkeleton(0, get_straight_skeleton, circles, 0.3, 10)
+    thin_tree = tree.TreeSkeleton(
+        1, get_straight_skeleton, [(c, 0.05) for c, _ in circles], 0.1, 10
+    )
+    model_element = geo.Pointcloud([[5, 5, 0], [5, 7, 0], [5, 9, 0]])
+    matchings = packing_combinatorics.compute_best_trees_element_matching(
+        model_element, 0.3, [straight_tree, thin_tree], np.inf
+    )
+    best_skeleton, best_rmse, best_transformation = matchings[0]
+    assert best_rmse == pytest.approx(0, abs=1e-9)
+    assert best_transformation.shape == (4, 4)
+    assert len(best_skeleton.points) == 3
+    assert matchings[1] == (None, None, None)
+    icp_matching = packing_combinatorics.compute_best_tree_element_matching(
+        model_element,
+        0.3,
+        straight_tree,
+        np.inf,
+        registration_method=packing_manipulations.RegistrationMethod.ICP,
+    )
+    assert icp_matching[1] == pytest.approx(0, abs=1e-6)
+
+
+def test_sliding_window_matching():
+    # a tree whose straight section is in the middle of its skeleton
+    bent_skeleton = geo.Pointcloud(
+        [[2, 0, 0], [1, 0, 1]]
+        + [[0, 0, z] for z in range(2, 9)]
+        + [[1, 0, 9], [2, 0, 10]]
+    )
+    circles = [([0, 0, 0], 0.15)] * 11
+    bent_tree = tree.TreeSkeleton(0, bent_skeleton, circles, 0.3, 10)
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 2], [0, 0, 4]])
+    _, anchored_rmse, _ = packing_combinatorics.compute_best_trees_element_matching(
+        model_element, 0.3, [bent_tree], np.inf
+    )[0]
+    (
+        best_skeleton,
+        window_rmse,
+        _,
+        offset,
+    ) = packing_combinatorics.compute_best_trees_element_matching(
+        model_element, 0.3, [bent_tree], np.inf, window_step=0.1, return_offsets=True
+    )[
+        0
+    ]
+    assert anchored_rmse > 0.1
+    assert window_rmse == pytest.approx(0, abs=1e-9)
+    assert 2 * np.sqrt(2) - 1e-9 <= offset <= 2 * np.sqrt(2) + 2 + 1e-9
+    assert all(point[0] == pytest.approx(0) for point in best_skeleton.points)
+
+
+@pytest.mark.parametrize(
+    "executor",
+    [packing_combinatorics.Executor.THREADS, packing_combinatorics.Executor.PROCESSES],
+)
+def test_parallel_matching(get_straight_skeleton, executor):
+    circles = [([0, 0, z], 0.15) for z in range(11)]
+    trees = [
+        tree.TreeSkeleton(i, get_straight_skeleton, circles, 0.3, 10) for i in range(5)
+    ]
+    model_element = geo.Pointcloud([[5, 5, 0], [5, 7, 1], [5, 9, 0]])
+    serial_matchings = packing_combinatorics.compute_best_trees_element_matching(
+        model_element, 0.3, trees, np.inf
+    )
+    parallel_matchings = (
+        packing_combinatorics.compute_best_trees_element_matching_in_parallel(
+            model_element, 0.3, trees, np.inf, executor=executor, n_workers=2
+        )
+    )
+    packing_combinatorics.shutdown_pools()
+    assert len(parallel_matchings) == len(trees)
+    for serial_matching, parallel_matching in zip(serial_matchings, parallel_matchings):
+        assert parallel_matching[1] == pytest.approx(serial_matching[1])
+        assert np.allclose(parallel_matching[0].points, serial_matching[0].points)
+
+
+@pytest.mark.parametrize("batch_size", [1, packing_combinatorics.KABSCH_BATCH_SIZE])
+@pytest.mark.parametrize(
+    "executor",
+    [packing_combinatorics.Executor.SERIAL, packing_combinatorics.Executor.THREADS],
+)
+def test_elements_trees_matching(
+    get_straight_skeleton, monkeypatch, batch_size, executor
+):
+    monkeypatch.setattr(packing_combinatorics, "KABSCH_BATCH_SIZE", batch_size)
+    circles = [([0, 0, z], 0.15) for z in range(11)]
+    bent_skeleton = geo.Pointcloud(
+        [[0, 0, z] for z in range(6)] + [[z - 5, 0, 5] for z in range(6, 11)]
+    )
+    trees = [
+        tree.TreeSkeleton(0, get_straight_skeleton, circles, 0.3, 10),
+        tree.TreeSkeleton(1, bent_skeleton, circles, 0.3, 10),
+        tree.TreeSkeleton(2, get_straight_skeleton, circles[:5], 0.3, 4),
+    ]
+    # elements with different numbers of points are registered in the same batch
+    model_elements = [
+        geo.Pointcloud([[0, 0, 0], [0, 1, 1]]),
+        geo.Pointcloud([[5, 5, 0], [5, 7, 1], [5, 9, 0], [5, 10, 1]]),
+        geo.Pointcloud([[0, 0, 0], [0, 0, 3], [0, 0, 6]]),
+    ]
+    element_trees = [trees, [], trees[1:]]
+    element_matchings = (
+        packing_combinatorics.compute_best_elements_trees_matching_in_parallel(
+            model_elements,
+            [0.3] * 3,
+            element_trees,
+            np.inf,
+            executor=executor,
+            n_workers=2,
+            window_step=0.5,
+        )
+    )
+    packing_combinatorics.shutdown_pools()
+    assert [len(matchings) for matchings in element_matchings] == [3, 0, 2]
+    for model_element, trees_i, matchings in zip(
+        model_elements, element_trees, element_matchings
+    ):
+        expected_matchings = packing_combinatorics.compute_best_trees_element_matching(
+            model_element, 0.3, trees_i, np.inf, window_step=0.5
+        )
+        for matching, expected_matching in zip(matchings, expected_matchings):
+            if expected_matching[1] is None:
+                assert matching == expected_matching
+                continue
+            assert matching[1] == pytest.approx(expected_matching[1], abs=1e-9)
+            assert np.allclose(matching[0].points, expected_matching[0].points)
+            assert np.allclose(matching[2], expected_matching[2])
+
+
+def test_explicit_offsets_matching(get_straight_skeleton):
+    skeleton = tree.TreeSkeleton(
+        0,
+        get_straight_skeleton,
+        [(np.array([0, 0, z]), 0.1) for z in range(11)],
+        0.2,
+        10,
+    )
+    model_element = geo.Pointcloud([[0, 0, 0], [0, 0, 2]])
+    matching = packing_combinatorics.compute_best_trees_element_matching(
+        model_element,
+        0.2,
+        [skeleton],
+        np.inf,
+        return_offsets=True,
+        offsets=np.array([[3.5, np.nan]]),
+    )[0]
+    assert matching[3] == pytest.approx(3.5)
+    assert np.allclose(matching[0].points, [[0, 0, 3.5], [0, 0, 5.5]])
+    # windows going beyond the end of the skeleton are not valid
+    matching = packing_combinatorics.compute_best_trees_element_matching(
+        model_element, 0.2, [skeleton], np.inf, offsets=np.array([[9.0]])
+    )[0]
+    assert matching[0] is None
+
+
+def test_packing_offsets():
+    offsets = packing_combinatorics._compute_packing_offsets(
+        [(0.0, 2.0), (3.0, 3.5), (4.0, 10.0)], 1.0, window_step=2.0
+    )
+    assert np.allclose(offsets, [0.0, 1.0, 4.0, 6.0, 8.0, 9.0], atol=1e-5)